@@ -0,0 +1,7 @@
+-- Responsive image variants (WebP / AVIF at several widths)
+-- Shape: {"webp": {"480": "https://...", "960": "https://..."}, "avif": {...}}
+-- Apply before setting IMAGE_VARIANTS_ENABLED=true
+
+ALTER TABLE panels ADD COLUMN IF NOT EXISTS variants JSONB;
+ALTER TABLE students ADD COLUMN IF NOT EXISTS avatar_variants JSONB;
+ALTER TABLE chapters ADD COLUMN IF NOT EXISTS thumbnail_variants JSONB;
@@ -0,0 +1,5 @@
+-- Text-free panel art (PANEL_TEXT_RENDERING=local): the FLUX image before the
+-- speech bubbles are drawn, so the lettering can be redrawn when the script changes
+-- Apply before setting PANEL_TEXT_RENDERING=local
+
+ALTER TABLE panels ADD COLUMN IF NOT EXISTS art_image TEXT;
@@ -0,0 +1,35 @@
+-- Review telemetry: one row per reviewed panel candidate (every FLUX render
+-- that went through the quality check), used to tune the retry policy
+-- Apply before setting REVIEW_TELEMETRY_ENABLED=true
+
+CREATE TABLE IF NOT EXISTS panel_reviews (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    chapter_id UUID NOT NULL REFERENCES chapters(id) ON DELETE CASCADE,
+    classroom_id UUID NOT NULL REFERENCES classrooms(id) ON DELETE CASCADE,
+    panel_index INTEGER NOT NULL,
+    attempt INTEGER NOT NULL,
+    candidate INTEGER NOT NULL DEFAULT 1,
+    score REAL,
+    text_accuracy REAL,
+    character_accuracy REAL,
+    layout_readability REAL,
+    -- Model that decided the review, "prefilter" or NULL if the review failed
+    review_model TEXT,
+    latency_seconds REAL,
+    -- How the render was made: "initial", "regenerate" or "edit" (PANEL_RETRY_STRATEGY)
+    strategy TEXT NOT NULL DEFAULT 'initial',
+    -- FLUX queue + render + download time of the candidate
+    render_seconds REAL,
+    threshold REAL NOT NULL,
+    design_style TEXT,
+    -- This candidate became the panel image
+    accepted BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Tables created before the retry strategy columns were added
+ALTER TABLE panel_reviews ADD COLUMN IF NOT EXISTS strategy TEXT NOT NULL DEFAULT 'initial';
+ALTER TABLE panel_reviews ADD COLUMN IF NOT EXISTS render_seconds REAL;
+
+CREATE INDEX IF NOT EXISTS panel_reviews_classroom_idx ON panel_reviews (classroom_id, created_at);
+CREATE INDEX IF NOT EXISTS panel_reviews_chapter_idx ON panel_reviews (chapter_id, panel_index);
@@ -0,0 +1,6 @@
+-- Automatic resumes of interrupted chapters (RESUME_GENERATING_ON_STARTUP):
+-- counts resumes so a chapter that keeps failing is marked "failed" after
+-- RESUME_MAX_ATTEMPTS, and lets one worker claim each chapter
+-- Apply before setting RESUME_GENERATING_ON_STARTUP=true
+
+ALTER TABLE chapters ADD COLUMN IF NOT EXISTS resume_attempts INTEGER NOT NULL DEFAULT 0;
@@ -3,10 +3,14 @@ Database module for Supabase operations.
 Provides get and create functions for all tables.
 """
 
+import base64
 import os
-from typing import Optional, List, Dict, Any
-from supabase import create_client, Client
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
 from dotenv import load_dotenv
+from supabase import Client, create_client
 
 # Load environment variables
 load_dotenv()
@@ -102,6 +106,35 @@ def get_all_classrooms() -> List[Dict[str, Any]]:
     return response.data
 
 
+def _embedded_count(row: Dict[str, Any], relation: str) -> int:
+    """Pop a PostgREST embedded count ({relation: [{"count": n}]}) from a row."""
+    embedded = row.pop(relation, None) or []
+    return embedded[0].get("count", 0) if embedded else 0
+
+
+def get_all_classrooms_with_counts() -> List[Dict[str, Any]]:
+    """
+    Get all classrooms with their student and story counts in one query.
+
+    The counts come from PostgREST embedded aggregates, so no student or
+    chapter rows are fetched.
+
+    Returns:
+        List of classroom records with student_count and story_count
+    """
+    response = (
+        supabase.table("classrooms")
+        .select("*, student_classrooms(count), chapters(count)")
+        .order("created_at", desc=True)
+        .execute()
+    )
+    classrooms = response.data
+    for classroom in classrooms:
+        classroom["student_count"] = _embedded_count(classroom, "student_classrooms")
+        classroom["story_count"] = _embedded_count(classroom, "chapters")
+    return classrooms
+
+
 # ============================================
 # STUDENT FUNCTIONS
 # ============================================
@@ -257,6 +290,153 @@ def get_chapters_by_classroom(classroom_id: str) -> List[Dict[str, Any]]:
     return chapters
 
 
+# Columns of a chapter in the student feed (story_ideas only for story_title)
+STUDENT_CHAPTER_COLUMNS = (
+    "id, classroom_id, index, status, chapter_outline, original_prompt, "
+    "thumbnail_url, chosen_idea_id, story_ideas, created_at"
+)
+
+
+def _encode_chapter_cursor(chapter: Dict[str, Any]) -> str:
+    raw = f"{chapter['created_at']}|{chapter['id']}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _decode_chapter_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    Parse a cursor back into (created_at, id), normalized so they can be
+    placed in a PostgREST filter safely.
+
+    Raises:
+        ValueError: If the cursor is not a valid (ISO timestamp, UUID) pair
+    """
+    try:
+        created_at, chapter_id = (
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+        )
+        return datetime.fromisoformat(created_at).isoformat(), str(uuid.UUID(chapter_id))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def get_chapters_by_student(
+    student_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Get the chapters of every classroom a student is enrolled in, newest
+    first, in one query (inner-joined through student_classrooms).
+
+    Only the list-view columns are fetched, plus classroom_name,
+    classroom_subject and story_title.
+
+    Args:
+        student_id: UUID of the student
+        limit: Page size (all chapters if None)
+        cursor: next_cursor of the previous page
+
+    Returns:
+        (chapters, next_cursor) - next_cursor is None on the last page
+
+    Raises:
+        ValueError: If the cursor is invalid
+    """
+    query = (
+        supabase.table("chapters")
+        .select(
+            f"{STUDENT_CHAPTER_COLUMNS}, "
+            "classrooms!inner(name, subject, student_classrooms!inner(student_id))"
+        )
+        .eq("classrooms.student_classrooms.student_id", student_id)
+    )
+    if cursor:
+        # Keyset pagination on (created_at, id), so equal timestamps are not skipped
+        created_at, chapter_id = _decode_chapter_cursor(cursor)
+        query = query.or_(
+            f'created_at.lt."{created_at}",'
+            f'and(created_at.eq."{created_at}",id.lt."{chapter_id}")'
+        )
+    query = query.order("created_at", desc=True).order("id", desc=True)
+    if limit is not None:
+        # One extra row tells whether there is a next page
+        query = query.limit(limit + 1)
+    chapters = query.execute().data
+
+    next_cursor = None
+    if limit is not None and len(chapters) > limit:
+        chapters = chapters[:limit]
+        next_cursor = _encode_chapter_cursor(chapters[-1])
+
+    for chapter in chapters:
+        classroom = chapter.pop("classrooms", None) or {}
+        chapter["classroom_name"] = classroom.get("name")
+        chapter["classroom_subject"] = classroom.get("subject") or ""
+        _add_story_title(chapter)
+        chapter.pop("story_ideas", None)
+
+    return chapters, next_cursor
+
+
+def get_chapters_by_status(status: str) -> List[Dict[str, Any]]:
+    """
+    Get all chapters with a given status (e.g. chapters stuck in "generating").
+
+    Args:
+        status: Chapter status to filter on
+
+    Returns:
+        List of chapter records (id, classroom_id, index, chosen_idea_id)
+    """
+    response = (
+        supabase.table("chapters")
+        .select("id, classroom_id, index, chosen_idea_id")
+        .eq("status", status)
+        .execute()
+    )
+    return response.data
+
+
+def get_resumable_chapters() -> List[Dict[str, Any]]:
+    """
+    Get chapters left in "generating" or "regenerating" by a stopped worker
+    (needs add_resume_attempts.sql).
+
+    Returns:
+        List of chapter records (id, status, resume_attempts)
+    """
+    response = (
+        supabase.table("chapters")
+        .select("id, status, resume_attempts")
+        .in_("status", ["generating", "regenerating"])
+        .execute()
+    )
+    return response.data
+
+
+def claim_chapter_resume(chapter_id: str, attempts: int) -> bool:
+    """
+    Count one automatic resume of a chapter, unless another worker already
+    did. The update only matches while resume_attempts is still `attempts`,
+    so of several workers starting at once exactly one claims the chapter.
+
+    Args:
+        chapter_id: UUID of the chapter
+        attempts: resume_attempts value read before claiming
+
+    Returns:
+        True if this worker claimed the resume
+    """
+    response = (
+        supabase.table("chapters")
+        .update({"resume_attempts": attempts + 1})
+        .eq("id", chapter_id)
+        .eq("resume_attempts", attempts)
+        .execute()
+    )
+    return bool(response.data)
+
+
 def _add_story_title(chapter: Dict[str, Any]) -> None:
     """
     Helper to add the chosen story title to a chapter dict (in-place).
@@ -289,7 +469,9 @@ def _add_story_title(chapter: Dict[str, Any]) -> None:
 # ============================================
 
 
-def create_panel(chapter_id: str, index: int, image: str) -> Dict[str, Any]:
+def create_panel(
+    chapter_id: str, index: int, image: str, art_image: Optional[str] = None
+) -> Dict[str, Any]:
     """
     Create a new panel in a chapter.
 
@@ -297,16 +479,79 @@ def create_panel(chapter_id: str, index: int, image: str) -> Dict[str, Any]:
         chapter_id: UUID of the chapter
         index: Panel number within the chapter (starting from 1)
         image: URL of the panel image
+        art_image: URL of the text-free art, for locally lettered panels
+                   (needs add_panel_art.sql)
 
     Returns:
         Created panel record
     """
     data = {"chapter_id": chapter_id, "index": index, "image": image}
+    if art_image is not None:
+        data["art_image"] = art_image
 
     response = supabase.table("panels").insert(data).execute()
     return response.data[0] if response.data else None
 
 
+def replace_panel(
+    chapter_id: str, index: int, image: str, art_image: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Replace the image of a chapter's panel, creating the panel if it is missing.
+
+    Args:
+        chapter_id: UUID of the chapter
+        index: Panel number within the chapter
+        image: URL of the new panel image
+        art_image: URL of the new text-free art, for locally lettered panels
+
+    Returns:
+        Updated (or created) panel record
+    """
+    data = {"image": image}
+    if art_image is not None:
+        data["art_image"] = art_image
+    response = (
+        supabase.table("panels")
+        .update(data)
+        .eq("chapter_id", chapter_id)
+        .eq("index", index)
+        .execute()
+    )
+    if response.data:
+        return response.data[0]
+    return create_panel(chapter_id, index, image, art_image)
+
+
+def update_panel_variants(
+    chapter_id: str, index: int, image: str, variants: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """
+    Record the responsive variants of a panel image.
+
+    Only updates the panel while it still shows `image`, so variants of an
+    image that was regenerated in the meantime are dropped.
+
+    Args:
+        chapter_id: UUID of the chapter
+        index: Panel number within the chapter
+        image: URL of the panel image the variants were built from
+        variants: {"webp": {"480": url, ...}, "avif": {...}}
+
+    Returns:
+        Updated panel record or None if the panel image changed
+    """
+    response = (
+        supabase.table("panels")
+        .update({"variants": variants})
+        .eq("chapter_id", chapter_id)
+        .eq("index", index)
+        .eq("image", image)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
 def get_panel(panel_id: str) -> Optional[Dict[str, Any]]:
     """
     Get a panel by ID.
@@ -341,6 +586,54 @@ def get_panels_by_chapter(chapter_id: str) -> List[Dict[str, Any]]:
     return response.data
 
 
+# ============================================
+# PANEL REVIEW FUNCTIONS
+# ============================================
+
+
+def create_panel_reviews(reviews: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Record the reviews of a panel's candidates (see add_panel_reviews.sql).
+
+    Args:
+        reviews: Rows with chapter_id, classroom_id, panel_index, attempt,
+                 candidate, score, dimension scores, review_model,
+                 latency_seconds, threshold, design_style and accepted
+
+    Returns:
+        Created review records
+    """
+    if not reviews:
+        return []
+    response = supabase.table("panel_reviews").insert(reviews).execute()
+    return response.data
+
+
+def get_panel_reviews(
+    classroom_id: Optional[str] = None,
+    since: Optional[str] = None,
+    limit: int = 5000,
+) -> List[Dict[str, Any]]:
+    """
+    Get recorded panel reviews, newest first.
+
+    Args:
+        classroom_id: Only reviews of this classroom (optional)
+        since: Only reviews created at or after this ISO timestamp (optional)
+        limit: Maximum number of rows
+
+    Returns:
+        List of review records
+    """
+    query = supabase.table("panel_reviews").select("*")
+    if classroom_id:
+        query = query.eq("classroom_id", classroom_id)
+    if since:
+        query = query.gte("created_at", since)
+    response = query.order("created_at", desc=True).limit(limit).execute()
+    return response.data
+
+
 # ============================================
 # STUDENT-CLASSROOM RELATIONSHIP FUNCTIONS
 # ============================================
@@ -626,18 +919,29 @@ def get_classroom_full_story(classroom_id: str) -> Optional[Dict[str, Any]]:
     Returns:
         Classroom record with nested chapters (each with panels) and students
     """
-    classroom = get_classroom(classroom_id)
-    if not classroom:
+    # One request: students through the junction table, chapters with their
+    # panels, both ordered by index inside the embeds
+    response = (
+        supabase.table("classrooms")
+        .select("*, student_classrooms(students(*)), chapters(*, panels(*))")
+        .eq("id", classroom_id)
+        .order("index", foreign_table="chapters")
+        .order("index", foreign_table="chapters.panels")
+        .execute()
+    )
+    if not response.data:
         return None
+    classroom = response.data[0]
 
-    # Get students
-    classroom["students"] = get_students_by_classroom(classroom_id)
-
-    # Get chapters with panels
-    chapters = get_chapters_by_classroom(classroom_id)
+    classroom["students"] = [
+        item["students"]
+        for item in classroom.pop("student_classrooms", None) or []
+        if item.get("students")
+    ]
+    chapters = classroom.get("chapters") or []
     for chapter in chapters:
-        chapter["panels"] = get_panels_by_chapter(chapter["id"])
-
+        _add_story_title(chapter)
+        chapter["panels"] = chapter.get("panels") or []
     classroom["chapters"] = chapters
     return classroom
 
@@ -2,21 +2,32 @@
 FastAPI main application entry point.
 """
 
+import asyncio
+import os
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
 from fastapi import (
+    BackgroundTasks,
     FastAPI,
-    HTTPException,
     File,
-    UploadFile,
     Form,
+    HTTPException,
     Query,
-    BackgroundTasks,
+    UploadFile,
 )
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from dotenv import load_dotenv
-import os
+
+from services import bfl_client, image_variants
 from services.avatar import generate_avatar
-from services.comic_creation import commit_story_choice
+from services.comic_creation import (
+    PANEL_REFERENCE_MODES,
+    commit_story_choice,
+    regenerate_panels,
+    reletter_panels,
+    resume_chapter_generation,
+)
 from services.story_idea import start_chapter
 
 # Load environment variables
@@ -39,6 +50,153 @@ app.add_middleware(
 )
 
 
+# Resume chapters left in "generating" by a previous worker (needs
+# database/add_resume_attempts.sql). Each chapter is resumed by one worker at
+# most RESUME_MAX_ATTEMPTS times, then marked "failed".
+RESUME_GENERATING_ON_STARTUP = (
+    os.getenv("RESUME_GENERATING_ON_STARTUP", "false").lower() == "true"
+)
+RESUME_MAX_ATTEMPTS = int(os.getenv("RESUME_MAX_ATTEMPTS", "2"))
+
+# Keep references to startup resume tasks so they are not garbage collected
+_resume_tasks: set = set()
+
+
+async def _mark_chapter_failed(chapter_id: str):
+    """Set the terminal "failed" status so the chapter is not resumed again."""
+    from database.database import update_chapter
+
+    try:
+        await asyncio.to_thread(update_chapter, chapter_id, {"status": "failed"})
+    except Exception as e:
+        print(f"⚠️ Could not mark chapter {chapter_id} as failed: {e}")
+
+
+async def _commit_chapter_logged(chapter_id: str, chosen_idea_id: str, **options):
+    """Run commit_story_choice; log failures and mark the chapter failed."""
+    try:
+        await commit_story_choice(chapter_id, chosen_idea_id, **options)
+    except Exception as e:
+        print(f"❌ Failed to generate chapter {chapter_id}: {e}")
+        import traceback
+
+        traceback.print_exc()
+        await _mark_chapter_failed(chapter_id)
+
+
+async def _resume_chapter_logged(chapter_id: str, reset_resume_attempts: bool = False):
+    """
+    Run resume_chapter_generation; log failures and mark the chapter failed.
+    reset_resume_attempts clears the automatic resume counter on success.
+    """
+    from database.database import update_chapter
+
+    try:
+        await resume_chapter_generation(chapter_id)
+    except Exception as e:
+        print(f"❌ Failed to resume chapter {chapter_id}: {e}")
+        import traceback
+
+        traceback.print_exc()
+        await _mark_chapter_failed(chapter_id)
+        return
+
+    if reset_resume_attempts:
+        try:
+            await asyncio.to_thread(update_chapter, chapter_id, {"resume_attempts": 0})
+        except Exception as e:
+            print(f"⚠️ Could not reset resume attempts of chapter {chapter_id}: {e}")
+
+
+async def _regenerate_panels_logged(
+    chapter_id: str, panel_indices: list, correction_prompt: Optional[str] = None
+):
+    """Run regenerate_panels and log (not raise) failures."""
+    try:
+        await regenerate_panels(chapter_id, panel_indices, correction_prompt)
+    except Exception as e:
+        print(f"❌ Failed to regenerate panels of chapter {chapter_id}: {e}")
+        import traceback
+
+        traceback.print_exc()
+
+
+def _track_resume_task(coro):
+    task = asyncio.create_task(coro)
+    _resume_tasks.add(task)
+    task.add_done_callback(_resume_tasks.discard)
+
+
+@app.on_event("startup")
+async def resume_interrupted_chapters():
+    """
+    Continue every chapter that was still generating when the worker stopped.
+
+    A chapter is only resumed by the worker that claims it (so replicas in a
+    rolling deploy don't render it twice), and at most RESUME_MAX_ATTEMPTS
+    times: after that, interrupted generations are marked "failed" and
+    interrupted regenerations go back to "ready" with their old panels.
+    """
+    if not RESUME_GENERATING_ON_STARTUP:
+        return
+
+    from database.database import (
+        claim_chapter_resume,
+        get_chapter,
+        get_resumable_chapters,
+        update_chapter,
+    )
+
+    try:
+        chapters = get_resumable_chapters()
+    except Exception as e:
+        print(f"⚠️ Could not look up interrupted chapters: {e}")
+        return
+
+    for chapter in chapters:
+        chapter_id = chapter["id"]
+        attempts = chapter.get("resume_attempts") or 0
+        try:
+            if attempts >= RESUME_MAX_ATTEMPTS:
+                print(f"❌ Chapter {chapter_id} was resumed {attempts} times without finishing; giving up")
+                status = "failed" if chapter["status"] == "generating" else "ready"
+                update_chapter(chapter_id, {"status": status})
+                continue
+            if not claim_chapter_resume(chapter_id, attempts):
+                print(f"   Chapter {chapter_id} is being resumed by another worker")
+                continue
+        except Exception as e:
+            print(f"⚠️ Could not claim chapter {chapter_id} for resuming: {e}")
+            continue
+
+        if chapter["status"] == "generating":
+            print(f"🔁 Resuming interrupted chapter {chapter_id} (attempt {attempts + 1}/{RESUME_MAX_ATTEMPTS})")
+            _track_resume_task(_resume_chapter_logged(chapter_id, reset_resume_attempts=True))
+            continue
+
+        script = (get_chapter(chapter_id) or {}).get("story_script") or {}
+        pending = script.get("pending_regeneration")
+        if not pending:
+            # Nothing recorded to redo; the old panels are still there
+            update_chapter(chapter_id, {"status": "ready"})
+            continue
+        print(f"🔁 Resuming panel regeneration of chapter {chapter_id}")
+        _track_resume_task(
+            _regenerate_panels_logged(
+                chapter["id"],
+                pending["panel_indices"],
+                pending.get("correction_prompt"),
+            )
+        )
+
+
+@app.on_event("shutdown")
+async def close_shared_clients():
+    """Close pooled HTTP connections and image encoder processes on shutdown."""
+    await bfl_client.aclose()
+    image_variants.shutdown()
+
+
 @app.get("/")
 async def root():
     """Health check endpoint."""
@@ -56,6 +214,66 @@ async def health_check():
     }
 
 
+@app.get("/generation/stats")
+async def generation_stats():
+    """
+    Process-wide counters of the generation pipeline (for tuning).
+
+    Returns:
+        Shared FLUX poller stats (in-flight tasks, polls, expected render time)
+        script / review cache hit/miss counters, the reviews saved by the
+        local panel pre-filter, how often each review model tier decided
+        and the outcomes of edit vs. regenerate panel retries
+    """
+    import panel_prefilter
+    from panel_review import get_cascade_stats, review_cache
+    from services.comic_creation import get_retry_stats, script_cache
+
+    return {
+        "success": True,
+        "bfl": bfl_client.get_stats(),
+        "script_cache": script_cache.stats(),
+        "review_cache": review_cache.stats(),
+        "prefilter": panel_prefilter.get_stats(),
+        "review_cascade": get_cascade_stats(),
+        "retry_strategies": get_retry_stats(),
+    }
+
+
+@app.get("/reviews/stats")
+async def review_stats(
+    classroom_id: Optional[str] = Query(None),
+    since: Optional[str] = Query(None),
+    limit: int = Query(5000, ge=1, le=50000),
+):
+    """
+    Pass rates and retry counts of recorded panel reviews, per classroom,
+    design style and review threshold (needs REVIEW_TELEMETRY_ENABLED).
+
+    Args:
+        classroom_id: Only this classroom (optional)
+        since: Only reviews created at or after this ISO timestamp (optional)
+        limit: Most recent reviews to aggregate
+
+    Returns:
+        One summary per (classroom, design style, threshold) group
+    """
+    from database.database import get_panel_reviews
+    from services.review_telemetry import summarize_reviews
+
+    try:
+        rows = get_panel_reviews(classroom_id=classroom_id, since=since, limit=limit)
+        return {
+            "success": True,
+            "reviews": len(rows),
+            "groups": summarize_reviews(rows),
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Failed to fetch review stats: {str(e)}"
+        )
+
+
 @app.post("/classrooms")
 async def create_classroom_endpoint(
     name: str = Query(...),
@@ -103,21 +321,11 @@ async def get_classrooms():
     Returns:
         List of all classroom records with student counts
     """
-    from database.database import (
-        get_all_classrooms,
-        get_students_by_classroom,
-        get_chapters_by_classroom,
-    )
+    from database.database import get_all_classrooms_with_counts
 
     try:
-        classrooms = get_all_classrooms()
-
-        # Add student count and story count to each classroom
-        for classroom in classrooms:
-            students = get_students_by_classroom(classroom["id"])
-            chapters = get_chapters_by_classroom(classroom["id"])
-            classroom["student_count"] = len(students)
-            classroom["story_count"] = len(chapters)
+        # Student and story counts are aggregated in the same query
+        classrooms = get_all_classrooms_with_counts()
 
         return {"success": True, "classrooms": classrooms}
     except Exception as e:
@@ -196,6 +404,39 @@ async def get_classroom_chapters(classroom_id: str):
         )
 
 
+@app.get("/classrooms/{classroom_id}/timings")
+async def get_classroom_timings(classroom_id: str):
+    """
+    Stage timing summary of every generated chapter in a classroom.
+
+    Args:
+        classroom_id: UUID of the classroom
+
+    Returns:
+        Per-chapter stage totals (seconds), ordered by chapter index
+    """
+    from database.database import get_chapters_by_classroom
+    from services.timings import summarize
+
+    try:
+        chapters = get_chapters_by_classroom(classroom_id)
+        timings = [
+            {
+                "chapter_id": chapter["id"],
+                "index": chapter.get("index"),
+                "status": chapter.get("status"),
+                **summarize((chapter.get("story_script") or {})["timings"]),
+            }
+            for chapter in chapters
+            if (chapter.get("story_script") or {}).get("timings")
+        ]
+        return {"success": True, "timings": timings}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Failed to fetch timings: {str(e)}"
+        )
+
+
 @app.post("/students/create")
 async def create_student(name: str, interests: str, photo_url: str = None):
     """
@@ -646,6 +887,35 @@ class GenerateIdeasRequest(BaseModel):
 class CommitStoryRequest(BaseModel):
     chapter_id: str
     chosen_idea_id: str
+    # Optional overrides for concurrent panel generation (default: env config)
+    concurrency: Optional[int] = None
+    reference_mode: Optional[str] = None
+    # Ignore a cached script for the same context and ask OpenAI again
+    bypass_script_cache: bool = False
+    # Optional chapter budget: total seconds and/or FLUX renders; panels are
+    # rendered once, then retries go to the weakest panels while it lasts
+    deadline_seconds: Optional[float] = None
+    max_renders: Optional[int] = None
+
+
+class RegeneratePanelsRequest(BaseModel):
+    panel_indices: List[int]
+    # Extra instructions appended to the rebuilt FLUX prompts
+    correction_prompt: Optional[str] = None
+
+
+class PanelTextUpdate(BaseModel):
+    index: int
+    narration: Optional[str] = None
+    # [{"speaker": "Name", "text": "line of dialogue"}, ...]
+    dialogue: Optional[List[Dict[str, str]]] = None
+
+
+class ReletterPanelsRequest(BaseModel):
+    # Panels to redraw; every panel if empty and no text updates are given
+    panel_indices: Optional[List[int]] = None
+    # New narration / dialogue, saved to the chapter script before redrawing
+    text_updates: Optional[List[PanelTextUpdate]] = None
 
 
 @app.post("/chapters/ideas")
@@ -694,7 +964,11 @@ async def commit_chapter_endpoint(
     4. Stores everything in the database as panels are created
 
     Args:
-        request: Contains chapter_id and chosen_idea_id (e.g., "idea_1")
+        request: Contains chapter_id and chosen_idea_id (e.g., "idea_1"), plus
+            optional concurrency (max panels generated at once),
+            reference_mode ("previous", "keyframe" or "none"),
+            bypass_script_cache (regenerate the script even if cached) and a
+            budget: deadline_seconds and/or max_renders
         background_tasks: FastAPI background task manager
 
     Returns:
@@ -702,6 +976,18 @@ async def commit_chapter_endpoint(
     """
     from database.database import get_chapter, supabase
 
+    if request.reference_mode and request.reference_mode.lower() not in PANEL_REFERENCE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid reference_mode: {request.reference_mode}. Allowed: {', '.join(PANEL_REFERENCE_MODES)}",
+        )
+    if request.concurrency is not None and request.concurrency < 1:
+        raise HTTPException(status_code=400, detail="concurrency must be at least 1")
+    if request.deadline_seconds is not None and request.deadline_seconds <= 0:
+        raise HTTPException(status_code=400, detail="deadline_seconds must be positive")
+    if request.max_renders is not None and request.max_renders < 1:
+        raise HTTPException(status_code=400, detail="max_renders must be at least 1")
+
     try:
         # Verify chapter exists
         chapter = get_chapter(request.chapter_id)
@@ -715,7 +1001,14 @@ async def commit_chapter_endpoint(
 
         # Start the actual comic generation in the background
         background_tasks.add_task(
-            commit_story_choice, request.chapter_id, request.chosen_idea_id
+            _commit_chapter_logged,
+            request.chapter_id,
+            request.chosen_idea_id,
+            concurrency=request.concurrency,
+            reference_mode=request.reference_mode,
+            use_script_cache=not request.bypass_script_cache,
+            deadline_seconds=request.deadline_seconds,
+            max_renders=request.max_renders,
         )
 
         return {
@@ -734,6 +1027,156 @@ async def commit_chapter_endpoint(
         )
 
 
+@app.post("/chapters/{chapter_id}/resume")
+async def resume_chapter_endpoint(chapter_id: str, background_tasks: BackgroundTasks):
+    """
+    Continue an interrupted chapter generation from its last checkpoint.
+
+    Keeps the stored script, FLUX prompts and already accepted panels, and only
+    renders what is missing. Poll GET /chapters/{chapter_id} to track progress.
+
+    Args:
+        chapter_id: UUID of the chapter
+        background_tasks: FastAPI background task manager
+
+    Returns:
+        Immediate success response - use polling to track progress
+    """
+    from database.database import get_chapter, update_chapter
+
+    try:
+        chapter = get_chapter(chapter_id)
+        if not chapter:
+            raise HTTPException(status_code=404, detail="Chapter not found")
+        if not chapter.get("story_script") and not chapter.get("chosen_idea_id"):
+            raise HTTPException(
+                status_code=400, detail="Chapter has no checkpoint to resume from"
+            )
+
+        update_chapter(chapter_id, {"status": "generating"})
+        background_tasks.add_task(_resume_chapter_logged, chapter_id)
+
+        return {
+            "success": True,
+            "message": "Comic generation resumed",
+            "chapter_id": chapter_id,
+            "status": "generating",
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Failed to resume chapter generation: {str(e)}"
+        )
+
+
+@app.post("/chapters/{chapter_id}/panels/regenerate")
+async def regenerate_panels_endpoint(
+    chapter_id: str, request: RegeneratePanelsRequest, background_tasks: BackgroundTasks
+):
+    """
+    Regenerate selected panels of a chapter without redoing the whole chapter.
+
+    Reuses the story_script stored on the chapter, rebuilds only the FLUX prompts
+    of the requested panels (with the optional correction prompt appended) and
+    replaces only those panel rows. Poll GET /chapters/{chapter_id} until the
+    status is back to "ready".
+
+    Args:
+        chapter_id: UUID of the chapter
+        request: Contains panel_indices and an optional correction_prompt
+        background_tasks: FastAPI background task manager
+
+    Returns:
+        Immediate success response - use polling to track progress
+    """
+    from database.database import get_chapter, update_chapter
+
+    if not request.panel_indices:
+        raise HTTPException(status_code=400, detail="panel_indices must not be empty")
+
+    try:
+        chapter = get_chapter(chapter_id)
+        if not chapter:
+            raise HTTPException(status_code=404, detail="Chapter not found")
+        if chapter.get("status") in ("generating", "regenerating"):
+            raise HTTPException(
+                status_code=409, detail="Chapter is still being generated"
+            )
+
+        script = chapter.get("story_script") or {}
+        known = {int(p["index"]) for p in script.get("panels") or []}
+        if not known or script.get("script_incomplete"):
+            raise HTTPException(
+                status_code=400, detail="Chapter has no stored script to regenerate from"
+            )
+        unknown = sorted(set(request.panel_indices) - known)
+        if unknown:
+            raise HTTPException(
+                status_code=400, detail=f"Unknown panel indices: {unknown}"
+            )
+
+        update_chapter(chapter_id, {"status": "regenerating"})
+        background_tasks.add_task(
+            _regenerate_panels_logged,
+            chapter_id,
+            request.panel_indices,
+            request.correction_prompt,
+        )
+
+        return {
+            "success": True,
+            "message": "Panel regeneration started",
+            "chapter_id": chapter_id,
+            "panel_indices": sorted(set(request.panel_indices)),
+            "status": "regenerating",
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Failed to start panel regeneration: {str(e)}"
+        )
+
+
+@app.post("/chapters/{chapter_id}/panels/reletter")
+async def reletter_panels_endpoint(chapter_id: str, request: ReletterPanelsRequest):
+    """
+    Redraw the speech bubbles and narration boxes of locally lettered panels
+    (PANEL_TEXT_RENDERING=local) from their stored text-free art.
+
+    No FLUX render is involved, so script text fixes are applied in seconds
+    and for free. Panels generated with FLUX lettering have no stored art and
+    are reported as skipped.
+
+    Args:
+        chapter_id: UUID of the chapter
+        request: Optional panel_indices and text_updates (new narration / dialogue)
+
+    Returns:
+        New image URLs of the relettered panels and the skipped indices
+    """
+    from database.database import get_chapter
+
+    chapter = get_chapter(chapter_id)
+    if not chapter:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    if chapter.get("status") in ("generating", "regenerating"):
+        raise HTTPException(status_code=409, detail="Chapter is still being generated")
+
+    text_updates = [update.model_dump() for update in request.text_updates or []]
+    try:
+        result = await reletter_panels(chapter_id, request.panel_indices, text_updates)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Failed to reletter panels: {str(e)}"
+        )
+
+    return {"success": True, **result}
+
+
 @app.get("/classrooms/{classroom_id}/materials")
 async def get_classroom_materials(classroom_id: str):
     """
@@ -994,9 +1437,9 @@ async def choose_story_idea(chapter_id: str, idea_id: str, thumbnail_url: str =
     Returns:
         Updated chapter
     """
-    from database.database import supabase, get_chapter
-    import httpx
-    import uuid
+    from database.database import get_chapter, supabase, update_chapter
+    from services.image_store import store_image
+    from services.image_variants import schedule_variants
 
     try:
         # Verify chapter exists
@@ -1011,31 +1454,24 @@ async def choose_story_idea(chapter_id: str, idea_id: str, thumbnail_url: str =
             try:
                 print(f"Downloading thumbnail from: {thumbnail_url}")
 
-                # Download the image from Flux
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    response = await client.get(thumbnail_url)
-                    if response.status_code == 200:
-                        image_data = response.content
-
-                        # Generate unique filename
-                        filename = f"{chapter_id}/{uuid.uuid4()}.jpeg"
-
-                        print(f"Uploading thumbnail to Supabase: {filename}")
-
-                        # Upload to Supabase Thumbnails bucket
-                        upload_response = supabase.storage.from_("Thumbnails").upload(
-                            filename, image_data, {"content-type": "image/jpeg"}
-                        )
-
-                        # Get public URL
-                        stored_thumbnail_url = supabase.storage.from_(
-                            "Thumbnails"
-                        ).get_public_url(filename)
-                        print(
-                            f"✅ Thumbnail uploaded successfully: {stored_thumbnail_url}"
-                        )
-                    else:
-                        print(f"⚠️ Failed to download thumbnail: {response.status_code}")
+                # Download the image from Flux over the shared BFL connection pool
+                image_data = await bfl_client.download(thumbnail_url)
+
+                # Upload to Supabase Thumbnails bucket under the image's content hash
+                print(f"Uploading thumbnail of chapter {chapter_id} to Supabase")
+                stored_thumbnail_url = store_image("Thumbnails", image_data)
+                schedule_variants(
+                    image_data,
+                    "Thumbnails",
+                    "",
+                    lambda variants: update_chapter(
+                        chapter_id, {"thumbnail_variants": variants}
+                    ),
+                    label=f"thumbnail of chapter {chapter_id}",
+                )
+                print(
+                    f"✅ Thumbnail uploaded successfully: {stored_thumbnail_url}"
+                )
 
             except Exception as e:
                 print(f"⚠️ Failed to save thumbnail: {e}")
@@ -1099,6 +1535,47 @@ async def get_chapter_with_panels_endpoint(chapter_id: str):
         )
 
 
+@app.get("/chapters/{chapter_id}/timings")
+async def get_chapter_timings(chapter_id: str):
+    """
+    Stage timing breakdown of a chapter's generation.
+
+    Args:
+        chapter_id: UUID of the chapter
+
+    Returns:
+        Chapter stages (script, prompts, images, checkpoints, total), totals
+        across panels (FLUX queue / render, download, review, upload, DB
+        writes) and per-panel, per-attempt detail, all in seconds
+    """
+    from database.database import get_chapter
+
+    try:
+        chapter = get_chapter(chapter_id)
+        if not chapter:
+            raise HTTPException(status_code=404, detail="Chapter not found")
+
+        script = chapter.get("story_script") or {}
+        if not script.get("timings"):
+            raise HTTPException(
+                status_code=404, detail="No timings recorded for this chapter"
+            )
+
+        return {
+            "success": True,
+            "chapter_id": chapter_id,
+            "status": chapter.get("status"),
+            "timings": script["timings"],
+            "regeneration_timings": script.get("regeneration_timings"),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Failed to fetch timings: {str(e)}"
+        )
+
+
 @app.delete("/chapters/{chapter_id}")
 async def delete_chapter_endpoint(chapter_id: str):
     """
@@ -1134,40 +1611,32 @@ async def delete_chapter_endpoint(chapter_id: str):
 
 
 @app.get("/students/{student_id}/chapters")
-async def get_student_chapters(student_id: str):
+async def get_student_chapters(
+    student_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+):
     """
-    Get all chapters across all classrooms a student is enrolled in.
+    Get all chapters across all classrooms a student is enrolled in,
+    newest first.
 
     Args:
         student_id: UUID of the student
+        limit: Page size (all chapters if omitted)
+        cursor: next_cursor of the previous page
 
     Returns:
-        List of chapter records with classroom info
+        List of chapter list-view records with classroom info, and the
+        cursor of the next page (None on the last page)
     """
-    from database.database import (
-        get_classrooms_by_student,
-        get_chapters_by_classroom,
-        get_classroom,
-    )
+    from database.database import get_chapters_by_student
 
     try:
-        # Get all classrooms the student is enrolled in
-        classrooms = get_classrooms_by_student(student_id)
+        chapters, next_cursor = get_chapters_by_student(student_id, limit, cursor)
 
-        # Collect all chapters from all classrooms
-        all_chapters = []
-        for classroom in classrooms:
-            chapters = get_chapters_by_classroom(classroom["id"])
-            # Add classroom info to each chapter
-            for chapter in chapters:
-                chapter["classroom_name"] = classroom["name"]
-                chapter["classroom_subject"] = classroom.get("subject", "")
-                all_chapters.append(chapter)
-
-        # Sort by created_at descending (newest first)
-        all_chapters.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-
-        return {"success": True, "chapters": all_chapters}
+        return {"success": True, "chapters": chapters, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Failed to fetch student chapters: {str(e)}"
@@ -0,0 +1,259 @@
+"""
+panel_lettering.py
+
+Local (Pillow) comic lettering for PANEL_TEXT_RENDERING=local.
+
+In that mode FLUX renders text-free art with the characters in a fixed
+left-to-right order and the top of the frame left open, and the narration
+and dialogue of the script are drawn here: a narration box in the top-left
+corner and one speech bubble per line, placed above its speaker with the
+tail pointing down at them, in wrapped uppercase lettering.
+
+Text is therefore always spelled exactly as written, and the bubbles can be
+redrawn on the stored art whenever the script text changes.
+"""
+
+import io
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+# "flux" - FLUX draws the bubbles and text itself
+# "local" - FLUX draws text-free art and the lettering is added by this module
+PANEL_TEXT_RENDERING_MODES = ("flux", "local")
+PANEL_TEXT_RENDERING = os.getenv("PANEL_TEXT_RENDERING", "flux").lower()
+if PANEL_TEXT_RENDERING not in PANEL_TEXT_RENDERING_MODES:
+    print(f"[WARN] Unknown PANEL_TEXT_RENDERING '{PANEL_TEXT_RENDERING}'; using 'flux'.")
+    PANEL_TEXT_RENDERING = "flux"
+
+# TrueType/OpenType comic font; Pillow's built-in font if unset
+LETTERING_FONT_PATH = os.getenv("LETTERING_FONT_PATH")
+# Font size as a fraction of the panel height (shrunk if the text does not fit)
+LETTERING_FONT_SCALE = float(os.getenv("LETTERING_FONT_SCALE", "0.042"))
+
+_MIN_FONT_SIZE = 10
+_NARRATION_FILL = (255, 244, 196)
+_INK = (0, 0, 0)
+_PAPER = (255, 255, 255)
+
+Box = Tuple[int, int, int, int]
+
+
+def _speaker_order(panel: Dict[str, Any]) -> List[str]:
+    """Characters left to right: featured students, then other speakers."""
+    order: List[str] = []
+    for name in panel.get("featured_students") or []:
+        if name and name not in order:
+            order.append(name)
+    for line in panel.get("dialogue") or []:
+        speaker = (line.get("speaker") or "").strip()
+        if speaker and speaker not in order:
+            order.append(speaker)
+    return order
+
+
+def art_prompt_instructions(panel: Dict[str, Any]) -> str:
+    """
+    FLUX prompt text for the text-free art of a panel. The character order
+    given here is where letter_panel points the bubble tails.
+    """
+    instructions = (
+        "Do NOT draw any text, letters, words, captions, signs with writing, "
+        "speech bubbles or narration boxes; the lettering is added later. "
+    )
+    if (panel.get("narration") or "").strip() or panel.get("dialogue"):
+        instructions += (
+            "Leave the top third of the panel as plain, uncluttered background "
+            "with no faces or important details, to make room for speech bubbles. "
+        )
+    order = _speaker_order(panel)
+    if len(order) > 1:
+        instructions += (
+            "Arrange the characters from left to right in exactly this order: "
+            f"{', '.join(order)}. "
+        )
+    return instructions
+
+
+def _load_font(size: int) -> Any:
+    from PIL import ImageFont
+
+    if LETTERING_FONT_PATH:
+        try:
+            return ImageFont.truetype(LETTERING_FONT_PATH, size)
+        except OSError as e:
+            print(f"⚠️ Could not load lettering font {LETTERING_FONT_PATH}: {e}")
+    return ImageFont.load_default(size=size)
+
+
+def _break_word(draw: Any, word: str, font: Any, max_width: int) -> List[str]:
+    """Split a word wider than max_width pixels into pieces that fit."""
+    pieces: List[str] = []
+    while word:
+        end = 1
+        while end < len(word) and draw.textlength(word[:end + 1], font=font) <= max_width:
+            end += 1
+        pieces.append(word[:end])
+        word = word[end:]
+    return pieces
+
+
+def _wrap(draw: Any, text: str, font: Any, max_width: int) -> str:
+    """
+    Greedy word wrap to max_width pixels. Words wider than a line are broken
+    across lines, so a bubble never grows wider than max_width.
+    """
+    lines: List[str] = []
+    current = ""
+    words: List[str] = []
+    for word in text.split():
+        if draw.textlength(word, font=font) > max_width:
+            words.extend(_break_word(draw, word, font, max_width))
+        else:
+            words.append(word)
+    for word in words:
+        candidate = f"{current} {word}".strip()
+        if current and draw.textlength(candidate, font=font) > max_width:
+            lines.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        lines.append(current)
+    return "\n".join(lines)
+
+
+def _overlaps(a: Box, b: Box, gap: int) -> bool:
+    return not (
+        a[2] + gap <= b[0] or b[2] + gap <= a[0] or a[3] + gap <= b[1] or b[3] + gap <= a[1]
+    )
+
+
+def _place(
+    width: int, height: int, center_x: int, frame_width: int, margin: int, placed: List[Box]
+) -> Box:
+    """Highest free spot for a width x height box, centered on center_x if possible."""
+    left = min(max(margin, center_x - width // 2), max(margin, frame_width - margin - width))
+    box = (left, margin, left + width, margin + height)
+    while any(_overlaps(box, other, margin // 2) for other in placed):
+        below = max(other[3] for other in placed if _overlaps(box, other, margin // 2))
+        box = (box[0], below + margin // 2, box[2], below + margin // 2 + height)
+    return box
+
+
+def _layout(
+    draw: Any,
+    panel: Dict[str, Any],
+    size: Tuple[int, int],
+    font_size: int,
+) -> Tuple[Any, List[Dict[str, Any]], int]:
+    """
+    Boxes for the narration and each dialogue line at one font size.
+
+    Returns:
+        (font, items, bottom) where items are {"kind", "text", "box", "tail_x"}
+        and bottom is the lowest edge used
+    """
+    width, height = size
+    font = _load_font(font_size)
+    margin = max(4, width // 50)
+    pad = max(4, font_size // 2)
+    spacing = max(2, font_size // 5)
+    placed: List[Box] = []
+    items: List[Dict[str, Any]] = []
+
+    narration = (panel.get("narration") or "").strip().upper()
+    if narration:
+        text = _wrap(draw, narration, font, int(width * 0.6) - 2 * pad)
+        x0, y0, x1, y1 = draw.multiline_textbbox((0, 0), text, font=font, spacing=spacing)
+        box = (margin, margin, margin + x1 - x0 + 2 * pad, margin + y1 - y0 + 2 * pad)
+        placed.append(box)
+        items.append({"kind": "narration", "text": text, "box": box, "tail_x": None})
+
+    order = _speaker_order(panel)
+    for line in panel.get("dialogue") or []:
+        text = (line.get("text") or "").strip().upper()
+        if not text:
+            continue
+        speaker = (line.get("speaker") or "").strip()
+        if speaker in order:
+            tail_x: Optional[int] = int(width * (order.index(speaker) + 0.5) / len(order))
+        else:
+            tail_x = None
+        text = _wrap(draw, text, font, int(width * 0.38) - 2 * pad)
+        x0, y0, x1, y1 = draw.multiline_textbbox((0, 0), text, font=font, spacing=spacing)
+        box = _place(
+            x1 - x0 + 3 * pad,
+            y1 - y0 + 2 * pad,
+            tail_x if tail_x is not None else width // 2,
+            width,
+            margin,
+            placed,
+        )
+        placed.append(box)
+        items.append({"kind": "bubble", "text": text, "box": box, "tail_x": tail_x})
+
+    bottom = max((box[3] for box in placed), default=0)
+    return font, items, bottom
+
+
+def letter_panel(art: bytes, panel: Dict[str, Any]) -> bytes:
+    """
+    Draw the narration box and speech bubbles of `panel` onto its text-free
+    art. Blocking (Pillow); run it in a worker thread.
+
+    Args:
+        art: Text-free panel image bytes
+        panel: Panel script (narration, dialogue, featured_students)
+
+    Returns:
+        PNG bytes of the lettered panel
+    """
+    from PIL import Image, ImageDraw
+
+    with Image.open(io.BytesIO(art)) as img:
+        canvas = img.convert("RGB")
+    width, height = canvas.size
+    draw = ImageDraw.Draw(canvas)
+
+    # Keep the lettering in the top half; shrink the font until it fits
+    font_size = max(_MIN_FONT_SIZE, int(height * LETTERING_FONT_SCALE))
+    while True:
+        font, items, bottom = _layout(draw, panel, (width, height), font_size)
+        if bottom <= height // 2 or font_size <= _MIN_FONT_SIZE:
+            break
+        font_size = max(_MIN_FONT_SIZE, int(font_size * 0.85))
+
+    outline = max(2, font_size // 8)
+    spacing = max(2, font_size // 5)
+    tail_length = max(outline * 4, height // 10)
+
+    for item in items:
+        x0, y0, x1, y1 = item["box"]
+        if item["kind"] == "narration":
+            draw.rectangle(item["box"], fill=_NARRATION_FILL, outline=_INK, width=outline)
+        else:
+            radius = min(x1 - x0, y1 - y0) // 2
+            draw.rounded_rectangle(item["box"], radius=radius, fill=_PAPER, outline=_INK, width=outline)
+            if item["tail_x"] is not None:
+                # Tail from the bubble's bottom edge down toward the speaker
+                base_x = min(max(item["tail_x"], x0 + radius), x1 - radius)
+                base_half = max(outline * 2, (x1 - x0) // 10)
+                tip = (item["tail_x"], min(height - 1, y1 + tail_length))
+                left = (base_x - base_half, y1 - outline)
+                right = (base_x + base_half, y1 - outline)
+                draw.polygon([left, right, tip], fill=_PAPER)
+                draw.line([left, tip], fill=_INK, width=outline)
+                draw.line([right, tip], fill=_INK, width=outline)
+        draw.multiline_text(
+            ((x0 + x1) / 2, (y0 + y1) / 2),
+            item["text"],
+            font=font,
+            fill=_INK,
+            anchor="mm",
+            align="center",
+            spacing=spacing,
+        )
+
+    out = io.BytesIO()
+    canvas.save(out, format="PNG")
+    return out.getvalue()
@@ -0,0 +1,188 @@
+"""
+panel_prefilter.py
+
+Cheap local (CPU-only, Pillow) pre-check of generated panels, run before the
+paid vision review in panel_review.py.
+
+It rejects or short-circuits candidates that are obviously unusable:
+  - near-blank frames (low grayscale entropy)
+  - panels with dialogue but no bright, bubble-like region
+  - near-duplicates (perceptual hash distance) of an earlier attempt of the
+    same panel, which reuse a copy of that attempt's review (tagged
+    "prefilter_duplicate") instead of a new one
+
+Counters in `get_stats()` show how many paid reviews were saved.
+"""
+
+import io
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+# Opt-in until the thresholds below are tuned on real panels
+PANEL_PREFILTER_ENABLED = os.getenv("PANEL_PREFILTER_ENABLED", "false").lower() == "true"
+# Grayscale entropy (bits, 0–8) below which a frame counts as blank
+PREFILTER_MIN_ENTROPY = float(os.getenv("PREFILTER_MIN_ENTROPY", "2.0"))
+# Max Hamming distance (of 64 bits) between dHashes of near-duplicate images
+PREFILTER_DUPLICATE_DISTANCE = int(os.getenv("PREFILTER_DUPLICATE_DISTANCE", "4"))
+# Grayscale level (0–255) a grid cell must reach to count as bubble-white
+PREFILTER_BRIGHT_LEVEL = int(os.getenv("PREFILTER_BRIGHT_LEVEL", "235"))
+# Smallest connected bright region (fraction of the frame) that can be a bubble
+PREFILTER_MIN_BUBBLE_AREA = float(os.getenv("PREFILTER_MIN_BUBBLE_AREA", "0.004"))
+
+# Bright regions are found on a coarse grid of this many cells across
+_GRID_WIDTH = 96
+
+_stats: Dict[str, int] = {
+    "checked": 0,
+    "passed": 0,
+    "rejected_blank": 0,
+    "rejected_no_bubbles": 0,
+    "duplicates_reused": 0,
+}
+
+
+def get_stats() -> Dict[str, Any]:
+    """Pre-filter counters since process start (reviews_saved = paid reviews skipped)."""
+    saved = _stats["rejected_blank"] + _stats["rejected_no_bubbles"] + _stats["duplicates_reused"]
+    return {"enabled": PANEL_PREFILTER_ENABLED, **_stats, "reviews_saved": saved}
+
+
+def _dhash(gray: Any) -> int:
+    """64-bit difference hash of a grayscale image."""
+    from PIL import Image
+
+    small = gray.resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def _largest_bright_region(gray: Any) -> float:
+    """Area (fraction of the frame) of the largest 4-connected bright region."""
+    from PIL import Image
+
+    height = max(1, round(gray.height * _GRID_WIDTH / gray.width))
+    grid = gray.resize((_GRID_WIDTH, height), Image.BOX)
+    bright = [p >= PREFILTER_BRIGHT_LEVEL for p in grid.getdata()]
+
+    seen = [False] * len(bright)
+    largest = 0
+    for start, is_bright in enumerate(bright):
+        if not is_bright or seen[start]:
+            continue
+        seen[start] = True
+        stack = [start]
+        size = 0
+        while stack:
+            cell = stack.pop()
+            size += 1
+            row, col = divmod(cell, _GRID_WIDTH)
+            neighbours = []
+            if col > 0:
+                neighbours.append(cell - 1)
+            if col < _GRID_WIDTH - 1:
+                neighbours.append(cell + 1)
+            if row > 0:
+                neighbours.append(cell - _GRID_WIDTH)
+            if row < height - 1:
+                neighbours.append(cell + _GRID_WIDTH)
+            for n in neighbours:
+                if bright[n] and not seen[n]:
+                    seen[n] = True
+                    stack.append(n)
+        largest = max(largest, size)
+    return largest / len(bright)
+
+
+def analyze_image(data: bytes) -> Dict[str, Any]:
+    """
+    Compute the pre-filter features of an image. Blocking (Pillow); run it in
+    a worker thread.
+
+    Args:
+        data: Raw image bytes
+
+    Returns:
+        {"dhash": int, "entropy": float, "bright_region": float}
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        gray = img.convert("L")
+    gray.thumbnail((512, 512), Image.BOX)
+    return {
+        "dhash": _dhash(gray),
+        "entropy": gray.entropy(),
+        "bright_region": _largest_bright_region(gray),
+    }
+
+
+def _rejection_review(issue: str, fix: str) -> Dict[str, Any]:
+    """Review-shaped result for a candidate rejected without a vision call."""
+    return {
+        "score": 0.0,
+        "dimensions": {
+            "text_accuracy": 0.0,
+            "character_accuracy": 0.0,
+            "layout_readability": 0.0,
+        },
+        "issues": [issue],
+        "suggested_fix_prompt": fix,
+        "notes": "Rejected by the local pre-filter before vision review.",
+        "prefilter": True,
+    }
+
+
+def prefilter_panel(
+    features: Dict[str, Any],
+    panel: Dict[str, Any],
+    previous: List[Tuple[int, Dict[str, Any]]],
+) -> Optional[Dict[str, Any]]:
+    """
+    Decide whether a candidate still needs the paid vision review.
+
+    Args:
+        features: analyze_image() of the candidate
+        panel: Panel script (dialogue decides whether bubbles are expected)
+        previous: (dhash, review) of the panel's earlier reviewed candidates
+
+    Returns:
+        A review to use instead of calling review_panel_image, or None if the
+        candidate passed and should be reviewed
+    """
+    if not PANEL_PREFILTER_ENABLED:
+        return None
+    _stats["checked"] += 1
+
+    if features["entropy"] < PREFILTER_MIN_ENTROPY:
+        _stats["rejected_blank"] += 1
+        print(f"         🚫 Pre-filter: near-blank frame (entropy {features['entropy']:.2f})")
+        return _rejection_review(
+            "The image is almost blank or a flat color.",
+            "Render a complete, detailed comic panel with the full scene and characters.",
+        )
+
+    for dhash, review in previous:
+        distance = bin(dhash ^ features["dhash"]).count("1")
+        if distance <= PREFILTER_DUPLICATE_DISTANCE:
+            _stats["duplicates_reused"] += 1
+            print(f"         ♻️ Pre-filter: near-duplicate of an earlier attempt (distance {distance}), reusing its review")
+            # Tagged so telemetry doesn't count it as a vision model review
+            return {**review, "prefilter_duplicate": True}
+
+    has_dialogue = any((line.get("text") or "").strip() for line in panel.get("dialogue") or [])
+    if has_dialogue and features["bright_region"] < PREFILTER_MIN_BUBBLE_AREA:
+        _stats["rejected_no_bubbles"] += 1
+        print("         🚫 Pre-filter: dialogue expected but no bubble-like white region found")
+        return _rejection_review(
+            "The panel has dialogue but no visible speech bubbles.",
+            "Draw clearly visible white speech bubbles with black outlines for every dialogue line.",
+        )
+
+    _stats["passed"] += 1
+    return None
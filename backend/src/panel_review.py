@@ -1,261 +1,814 @@
-"""
-panel_review.py
-
-Multimodal quality check for generated comic panels.
-
-Given:
-  - image_url (from FLUX / BFL sample URL)
-  - panel script (narration, dialogue, featured students)
-  - classroom + students context
-
-It:
-  - Uses an OpenAI vision-capable model to inspect the image
-  - Compares it against the expected text and characters
-  - Returns a JSON score (0–10) plus concrete issues and a suggested fix prompt.
-"""
-
-import os
-import json
-from typing import Any, Dict, List, Optional
-
-from dotenv import load_dotenv
-from openai import OpenAI
-
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "YOUR_OPENAI_API_KEY_HERE")
-# Separate model for QA so you can tweak independently
-OPENAI_QA_MODEL = os.getenv("OPENAI_QA_MODEL", "gpt-4o")
-
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-
-def _expected_text_from_panel(panel: Dict[str, Any]) -> List[Dict[str, str]]:
-    """
-    Represent narration + dialogue as a structured list so the model can
-    judge text accuracy more easily.
-    """
-    out: List[Dict[str, str]] = []
-
-    narration = (panel.get("narration") or "").strip()
-    if narration:
-        out.append({"type": "narration", "text": narration})
-
-    for line in panel.get("dialogue") or []:
-        speaker = (line.get("speaker") or "").strip()
-        text = (line.get("text") or "").strip()
-        if not text:
-            continue
-        out.append(
-            {
-                "type": "dialogue",
-                "speaker": speaker,
-                "text": text,
-            }
-        )
-
-    return out
-
-
-def review_panel_image(
-    image_url: str,
-    panel: Dict[str, Any],
-    classroom: Dict[str, Any],
-    students: List[Dict[str, Any]],
-    min_score: float = 8.0,
-) -> Dict[str, Any]:
-    """
-    Ask a multimodal OpenAI model to review a single comic panel image.
-
-    Returns a dict like:
-    {
-      "score": 8.7,
-      "dimensions": {
-        "text_accuracy": 9.0,
-        "character_accuracy": 8.0,
-        "layout_readability": 9.0
-      },
-      "issues": [
-        "Speech bubble for LENA is missing",
-        "Text 'F=ma' is misspelled"
-      ],
-      "suggested_fix_prompt": "Add a speech bubble for LENA saying '...' and correct 'F=ma' text.",
-      "notes": "Additional free-form comments if needed."
-    }
-    """
-    
-    print(f"         🔍 Starting quality review...")
-    print(f"         → Image URL: {image_url[:60]}...")
-
-    if not OPENAI_API_KEY or OPENAI_API_KEY == "YOUR_OPENAI_API_KEY_HERE":
-        raise RuntimeError("OPENAI_API_KEY not set; cannot run panel review")
-
-    expected_text = _expected_text_from_panel(panel)
-    featured_students = panel.get("featured_students") or []
-    setting = (panel.get("setting") or "").strip()
-    description = (panel.get("description") or "").strip()
-
-    # Build a compact map of student info for the reviewer
-    students_by_name: Dict[str, Dict[str, Any]] = {
-        s["name"]: s for s in students if "name" in s
-    }
-
-    student_info = []
-    for name in featured_students:
-        s = students_by_name.get(name)
-        if not s:
-            continue
-        student_info.append(
-            {
-                "name": s["name"],
-                "interests": s.get("interests", ""),
-                "avatar_url": s.get("avatar_url"),
-            }
-        )
-
-    review_payload = {
-        "panel_index": panel.get("index"),
-        "expected_setting": setting,
-        "expected_visual_description": description,
-        "expected_text": expected_text,
-        "expected_featured_students": featured_students,
-        "classroom_subject": classroom.get("subject"),
-        "classroom_grade": classroom.get("grade_level"),
-        "classroom_story_theme": classroom.get("story_theme"),
-        "student_info": student_info,
-        "target_min_score": min_score,
-    }
-
-    system_prompt = (
-        "You are a strict, zero-tolerance art director for kid-friendly educational comic books.\n"
-        "You will be given the expected script for ONE panel (narration, dialogue, "
-        "featured student names) plus the rendered image of that panel.\n"
-        "Your job is to rate how well the image matches the script and suggest simple "
-        "prompt-level fixes so the panel can be regenerated by a text-to-image model.\n\n"
-        "Pay EXTREME attention to speech bubbles and text correctness:\n"
-        "- Each bubble's tail MUST clearly point to the correct speaker.\n"
-        "- No character may speak lines that belong to someone else.\n"
-        "- Characters must not speak about themselves in an unnatural way "
-        "(for example, referring to themselves in the third person or addressing "
-        "themselves by name) unless the script explicitly requires it.\n"
-        "- Text in narration and bubbles MUST match the expected text EXACTLY.\n"
-        "- ANY spelling error, garbled word, missing word, extra word, or paraphrasing "
-        "counts as a serious error.\n\n"
-        "Scoring rules for each dimension (0–10):\n"
-        "- text_accuracy:\n"
-        "  * 10 = every word in narration and speech bubbles is perfectly legible and "
-        "    exactly matches the expected text (no differences at all).\n"
-        "  * 5–9 = reserved ONLY for very minor visual imperfections (e.g. slightly odd "
-        "    font rendering) while the text content still matches exactly.\n"
-        "  * 0–3 = ANY mistake in content (spelling differences, missing or extra words, "
-        "    nonsense text, garbled text, or any line belonging to the wrong speaker). "
-        "    If you see even a single such issue, text_accuracy MUST be 3 or lower.\n"
-        "- character_accuracy:\n"
-        "  * 10 = all named students that should appear are clearly present, not merged, "
-        "    consistent with each other, and the bubbles attached to them are correct.\n"
-        "  * 5–9 = only very minor stylistic deviations, but the cast and bubble "
-        "    assignments are still clearly correct.\n"
-        "  * 0–3 = any missing required character, wrong character speaking a line, or "
-        "    bubble tails pointing at the wrong person. If you see any such issue, "
-        "    character_accuracy MUST be 3 or lower.\n"
-        "- layout_readability:\n"
-        "  * 10 = composition is clean, speech bubbles / narration boxes do not overlap "
-        "    faces, text is not cropped, and the panel is easy to read for kids.\n"
-        "  * Lower scores for clutter, overlapping text, tiny text, or cropped bubbles.\n\n"
-        "Overall 'score' must be a weighted average with MUCH more weight on "
-        "text_accuracy and character_accuracy than layout_readability.\n"
-        "If there is ANY text mistake, garbled text, or misaligned bubble (bubble tail "
-        "clearly pointing to the wrong character), the overall score MUST NOT exceed 5, "
-        "and can be as low as 0 for very poor matches.\n"
-    )
-
-    print(f"         → Building review prompt...")
-    print(f"         → Expected students: {featured_students}")
-    print(f"         → Expected text lines: {len(expected_text)}")
-    
-    user_prompt_text = (
-        "Here is the structured description of what this panel SHOULD contain.\n"
-        "Then you see the actual rendered image.\n\n"
-        "Tasks:\n"
-        "1) Carefully compare the text in the image (narration, bubbles, labels) to the "
-        "expected text. Note any missing, added, paraphrased, or unreadable words.\n"
-        "2) Check speech-bubble alignment:\n"
-        "   - For each dialogue line, is there a bubble whose tail clearly points to the "
-        "     correct character?\n"
-        "   - Are there any bubbles pointing to the wrong character, or characters speaking "
-        "     even though they have no dialogue defined for this panel?\n"
-        "   - Does any character talk in an obviously wrong way, such as referring to "
-        "     themselves in the third person or addressing themselves by name?\n"
-        "3) Check whether all named students that are supposed to appear are clearly present "
-        "   and consistent with their roles.\n"
-        "4) Check whether the layout makes the text easy to read (no cropping, no weird "
-        "   overlaps, text big enough for kids).\n\n"
-        "Then respond ONLY with a single JSON object with this structure:\n"
-        "{\n"
-        '  "score": float,                 // 0–10 overall\n'
-        '  "dimensions": {\n'
-        '    "text_accuracy": float,       // 0–10 (include correctness of text AND who says it)\n'
-        '    "character_accuracy": float,  // 0–10 (include whether bubbles attach to correct characters)\n'
-        '    "layout_readability": float   // 0–10\n'
-        "  },\n"
-        '  "issues": [ "string", ... ],    // list of concrete problems (mention bubble misalignment explicitly)\n'
-        '  "suggested_fix_prompt": "short text prompt to append to the image model prompt, '
-        "max 2–3 sentences, focusing on the most important fixes such as moving specific "
-        "bubbles to the right character, correcting mis-written text, or adding/removing "
-        'bubbles.",\n'
-        '  "notes": "optional extra comments or explanations"\n'
-        "}\n\n"
-        "Be concise and practical in 'issues' and 'suggested_fix_prompt'. For example, you "
-        "might say: \"Move the bubble with 'F = ma' so the tail points to LENA on the left; "
-        "replace the current text with 'F = m · a'; remove the extra bubble above the teacher.\"\n"
-        "If everything already looks perfect, you can still report a high score (e.g. 9.5–10) "
-        "and leave 'issues' empty and 'suggested_fix_prompt' as an empty string.\n\n"
-        f"PANEL SPEC JSON:\n{json.dumps(review_payload, ensure_ascii=False)}"
-    )
-
-    print(f"         → Calling OpenAI Vision API ({OPENAI_QA_MODEL})...")
-    
-    resp = openai_client.chat.completions.create(
-        model=OPENAI_QA_MODEL,
-        response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_prompt_text},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": image_url},
-                    },
-                ],
-            },
-        ],
-    )
-
-    print(f"         → Received response, parsing...")
-    raw = resp.choices[0].message.content
-    try:
-        data = json.loads(raw)
-    except json.JSONDecodeError as e:
-        raise RuntimeError(f"Panel review returned invalid JSON: {e}\nRaw: {raw}")
-
-    # Light normalization so caller can assume keys exist
-    data.setdefault("score", 0.0)
-    dims = data.setdefault("dimensions", {})
-    dims.setdefault("text_accuracy", 0.0)
-    dims.setdefault("character_accuracy", 0.0)
-    dims.setdefault("layout_readability", 0.0)
-    data.setdefault("issues", [])
-    data.setdefault("suggested_fix_prompt", "")
-    data.setdefault("notes", "")
-
-    print(f"         ✓ Review complete!")
-    print(f"         → Overall score: {data['score']:.1f}/10")
-    print(f"         → Text accuracy: {dims['text_accuracy']:.1f}/10")
-    print(f"         → Character accuracy: {dims['character_accuracy']:.1f}/10")
-    print(f"         → Layout readability: {dims['layout_readability']:.1f}/10")
-    if data['issues']:
-        print(f"         → Issues found: {len(data['issues'])}")
-
-    return data
+"""
+panel_review.py
+
+Multimodal quality check for generated comic panels.
+
+Given:
+  - image_url (from FLUX / BFL sample URL), or the image bytes, which are
+    downscaled and sent inline as a data URL
+  - panel script (narration, dialogue, featured students)
+  - classroom + students context
+
+It:
+  - Uses an OpenAI vision-capable model to inspect the image
+  - Compares it against the expected text and characters
+  - Returns a JSON score (0–10) plus concrete issues and a suggested fix prompt.
+
+review_panel_batch grades several images in one request by tiling them into
+a labelled contact sheet (one round trip and one system prompt for all).
+
+review_panel_image_async is the awaitable variant on a shared AsyncOpenAI
+client, limited to REVIEW_CONCURRENCY requests in flight.
+
+With the review cascade enabled, a cheaper vision model grades first and only
+near misses (up to REVIEW_CASCADE_BAND below the passing score) and marginal
+passes (less than REVIEW_CASCADE_PASS_MARGIN above it) are escalated to
+OPENAI_QA_MODEL.
+"""
+
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import string
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+from services.persistent_cache import PersistentCache, make_key
+
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "YOUR_OPENAI_API_KEY_HERE")
+# Separate model for QA so you can tweak independently
+OPENAI_QA_MODEL = os.getenv("OPENAI_QA_MODEL", "gpt-4o")
+
+# Review cascade: OPENAI_QA_FAST_MODEL grades first; a score from
+# REVIEW_CASCADE_BAND below the passing score up to REVIEW_CASCADE_PASS_MARGIN
+# above it is re-graded by OPENAI_QA_MODEL. Clear passes and clear failures
+# are decided by the fast model alone.
+# Opt-in: the fast model has not been validated against OPENAI_QA_MODEL yet
+REVIEW_CASCADE_ENABLED = os.getenv("REVIEW_CASCADE_ENABLED", "false").lower() == "true"
+OPENAI_QA_FAST_MODEL = os.getenv("OPENAI_QA_FAST_MODEL", "gpt-4o-mini")
+REVIEW_CASCADE_BAND = float(os.getenv("REVIEW_CASCADE_BAND", "1.5"))
+REVIEW_CASCADE_PASS_MARGIN = float(os.getenv("REVIEW_CASCADE_PASS_MARGIN", "0.5"))
+
+# Which tier decided each review (cached reviews are not counted)
+_cascade_stats: Dict[str, int] = {"fast": 0, "escalated": 0, "strong_only": 0}
+
+# Review cache: the same image bytes graded against the same panel spec with
+# the same model return the stored review. Bump REVIEW_PROMPT_VERSION whenever
+# the review prompts change.
+REVIEW_PROMPT_VERSION = "1"
+REVIEW_CACHE_ENABLED = os.getenv("REVIEW_CACHE_ENABLED", "true").lower() == "true"
+REVIEW_CACHE_MAX_ENTRIES = int(os.getenv("REVIEW_CACHE_MAX_ENTRIES", "2048"))
+REVIEW_CACHE_TTL_SECONDS = float(os.getenv("REVIEW_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+review_cache = PersistentCache(
+    "panel_reviews",
+    max_entries=REVIEW_CACHE_MAX_ENTRIES,
+    ttl_seconds=REVIEW_CACHE_TTL_SECONDS,
+    enabled=REVIEW_CACHE_ENABLED,
+    memory_entries=256,
+)
+
+# Inline review image: bytes are downscaled to REVIEW_IMAGE_MAX_SIDE (longest
+# side), encoded as jpeg/webp and sent as a data URL with this detail level
+# ("low", "high" or "auto"), so OpenAI never fetches the full-size BFL URL
+REVIEW_IMAGE_MAX_SIDE = int(os.getenv("REVIEW_IMAGE_MAX_SIDE", "1024"))
+REVIEW_IMAGE_FORMAT = os.getenv("REVIEW_IMAGE_FORMAT", "jpeg").lower()
+REVIEW_IMAGE_QUALITY = int(os.getenv("REVIEW_IMAGE_QUALITY", "85"))
+REVIEW_IMAGE_DETAIL = os.getenv("REVIEW_IMAGE_DETAIL", "high").lower()
+
+# Contact sheet (batched review) layout
+REVIEW_SHEET_TILE_WIDTH = int(os.getenv("REVIEW_SHEET_TILE_WIDTH", "768"))
+REVIEW_SHEET_MAX_TILES = int(os.getenv("REVIEW_SHEET_MAX_TILES", "4"))
+
+# Vision requests in flight at once per process (async reviews and batches),
+# and the timeout of each request
+REVIEW_CONCURRENCY = int(os.getenv("REVIEW_CONCURRENCY", "8"))
+REVIEW_TIMEOUT_SECONDS = float(os.getenv("REVIEW_TIMEOUT_SECONDS", "60"))
+
+openai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=REVIEW_TIMEOUT_SECONDS)
+# Shared by every async review (one connection pool for all chapters)
+async_openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=REVIEW_TIMEOUT_SECONDS)
+
+# (event loop, semaphore): asyncio semaphores belong to one loop
+_review_semaphore: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+
+REVIEW_SYSTEM_PROMPT = (
+    "You are a strict, zero-tolerance art director for kid-friendly educational comic books.\n"
+    "You will be given the expected script for ONE panel (narration, dialogue, "
+    "featured student names) plus the rendered image of that panel.\n"
+    "Your job is to rate how well the image matches the script and suggest simple "
+    "prompt-level fixes so the panel can be regenerated by a text-to-image model.\n\n"
+    "Pay EXTREME attention to speech bubbles and text correctness:\n"
+    "- Each bubble's tail MUST clearly point to the correct speaker.\n"
+    "- No character may speak lines that belong to someone else.\n"
+    "- Characters must not speak about themselves in an unnatural way "
+    "(for example, referring to themselves in the third person or addressing "
+    "themselves by name) unless the script explicitly requires it.\n"
+    "- Text in narration and bubbles MUST match the expected text EXACTLY.\n"
+    "- ANY spelling error, garbled word, missing word, extra word, or paraphrasing "
+    "counts as a serious error.\n\n"
+    "Scoring rules for each dimension (0–10):\n"
+    "- text_accuracy:\n"
+    "  * 10 = every word in narration and speech bubbles is perfectly legible and "
+    "    exactly matches the expected text (no differences at all).\n"
+    "  * 5–9 = reserved ONLY for very minor visual imperfections (e.g. slightly odd "
+    "    font rendering) while the text content still matches exactly.\n"
+    "  * 0–3 = ANY mistake in content (spelling differences, missing or extra words, "
+    "    nonsense text, garbled text, or any line belonging to the wrong speaker). "
+    "    If you see even a single such issue, text_accuracy MUST be 3 or lower.\n"
+    "- character_accuracy:\n"
+    "  * 10 = all named students that should appear are clearly present, not merged, "
+    "    consistent with each other, and the bubbles attached to them are correct.\n"
+    "  * 5–9 = only very minor stylistic deviations, but the cast and bubble "
+    "    assignments are still clearly correct.\n"
+    "  * 0–3 = any missing required character, wrong character speaking a line, or "
+    "    bubble tails pointing at the wrong person. If you see any such issue, "
+    "    character_accuracy MUST be 3 or lower.\n"
+    "- layout_readability:\n"
+    "  * 10 = composition is clean, speech bubbles / narration boxes do not overlap "
+    "    faces, text is not cropped, and the panel is easy to read for kids.\n"
+    "  * Lower scores for clutter, overlapping text, tiny text, or cropped bubbles.\n\n"
+    "Overall 'score' must be a weighted average with MUCH more weight on "
+    "text_accuracy and character_accuracy than layout_readability.\n"
+    "If there is ANY text mistake, garbled text, or misaligned bubble (bubble tail "
+    "clearly pointing to the wrong character), the overall score MUST NOT exceed 5, "
+    "and can be as low as 0 for very poor matches.\n"
+)
+
+
+def get_cascade_stats() -> Dict[str, Any]:
+    """How often each cascade tier decided a review, since process start."""
+    cascaded = _cascade_stats["fast"] + _cascade_stats["escalated"]
+    return {
+        "enabled": REVIEW_CASCADE_ENABLED,
+        "fast_model": OPENAI_QA_FAST_MODEL if REVIEW_CASCADE_ENABLED else None,
+        "strong_model": OPENAI_QA_MODEL,
+        "band": REVIEW_CASCADE_BAND,
+        "pass_margin": REVIEW_CASCADE_PASS_MARGIN,
+        **_cascade_stats,
+        "escalation_rate": round(_cascade_stats["escalated"] / cascaded, 3) if cascaded else None,
+    }
+
+
+@asynccontextmanager
+async def review_slot() -> AsyncIterator[None]:
+    """Hold one of the REVIEW_CONCURRENCY vision request slots."""
+    global _review_semaphore
+    loop = asyncio.get_running_loop()
+    if _review_semaphore is None or _review_semaphore[0] is not loop:
+        _review_semaphore = (loop, asyncio.Semaphore(max(1, REVIEW_CONCURRENCY)))
+    async with _review_semaphore[1]:
+        yield
+
+
+def _cascade_active() -> bool:
+    return REVIEW_CASCADE_ENABLED and bool(OPENAI_QA_FAST_MODEL) and OPENAI_QA_FAST_MODEL != OPENAI_QA_MODEL
+
+
+def _needs_escalation(score: float, min_score: float) -> bool:
+    """Whether a fast-model score is a near miss or a marginal pass."""
+    return min_score - REVIEW_CASCADE_BAND <= float(score) < min_score + REVIEW_CASCADE_PASS_MARGIN
+
+
+def _expected_text_from_panel(panel: Dict[str, Any]) -> List[Dict[str, str]]:
+    """
+    Represent narration + dialogue as a structured list so the model can
+    judge text accuracy more easily.
+    """
+    out: List[Dict[str, str]] = []
+
+    narration = (panel.get("narration") or "").strip()
+    if narration:
+        out.append({"type": "narration", "text": narration})
+
+    for line in panel.get("dialogue") or []:
+        speaker = (line.get("speaker") or "").strip()
+        text = (line.get("text") or "").strip()
+        if not text:
+            continue
+        out.append(
+            {
+                "type": "dialogue",
+                "speaker": speaker,
+                "text": text,
+            }
+        )
+
+    return out
+
+
+def _encode_image(image: Any) -> str:
+    """Encode a Pillow image as a data URL (REVIEW_IMAGE_FORMAT / QUALITY)."""
+    fmt = "webp" if REVIEW_IMAGE_FORMAT == "webp" else "jpeg"
+    out = io.BytesIO()
+    image.save(out, format=fmt.upper(), quality=REVIEW_IMAGE_QUALITY)
+    return f"data:image/{fmt};base64," + base64.b64encode(out.getvalue()).decode("ascii")
+
+
+def encode_review_image(data: bytes, max_side: int = REVIEW_IMAGE_MAX_SIDE) -> str:
+    """
+    Downscale an image for review and return it as an inline data URL.
+
+    Blocking (Pillow); callers run it in a worker thread with the review call.
+
+    Args:
+        data: Raw image bytes
+        max_side: Longest side of the review image (never upscaled)
+
+    Returns:
+        data:image/jpeg;base64,... (or image/webp)
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        return _encode_image(img)
+
+
+def _review_payload(
+    panel: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    min_score: float,
+) -> Dict[str, Any]:
+    """Structured spec of what a panel SHOULD contain, sent to the reviewer."""
+    expected_text = _expected_text_from_panel(panel)
+    featured_students = panel.get("featured_students") or []
+    setting = (panel.get("setting") or "").strip()
+    description = (panel.get("description") or "").strip()
+
+    # Build a compact map of student info for the reviewer
+    students_by_name: Dict[str, Dict[str, Any]] = {
+        s["name"]: s for s in students if "name" in s
+    }
+
+    student_info = []
+    for name in featured_students:
+        s = students_by_name.get(name)
+        if not s:
+            continue
+        student_info.append(
+            {
+                "name": s["name"],
+                "interests": s.get("interests", ""),
+                "avatar_url": s.get("avatar_url"),
+            }
+        )
+
+    return {
+        "panel_index": panel.get("index"),
+        "expected_setting": setting,
+        "expected_visual_description": description,
+        "expected_text": expected_text,
+        "expected_featured_students": featured_students,
+        "classroom_subject": classroom.get("subject"),
+        "classroom_grade": classroom.get("grade_level"),
+        "classroom_story_theme": classroom.get("story_theme"),
+        "student_info": student_info,
+        "target_min_score": min_score,
+    }
+
+
+def _review_cache_key(image_bytes: bytes, review_payload: Dict[str, Any], mode: str = "single") -> str:
+    """
+    Cache key of one review: image hash + panel spec hash + model + prompt
+    version + how the image is sent. mode is "single" (one image per call)
+    or "sheet" (a tile of a batched contact sheet); the two requests differ,
+    so they don't share verdicts.
+    """
+    return make_key(
+        hashlib.sha256(image_bytes).hexdigest(),
+        make_key(review_payload),
+        OPENAI_QA_MODEL,
+        REVIEW_PROMPT_VERSION,
+        mode,
+        REVIEW_IMAGE_MAX_SIDE,
+        REVIEW_IMAGE_DETAIL,
+        REVIEW_IMAGE_FORMAT,
+        REVIEW_IMAGE_QUALITY,
+        (OPENAI_QA_FAST_MODEL, REVIEW_CASCADE_BAND, REVIEW_CASCADE_PASS_MARGIN) if _cascade_active() else None,
+    )
+
+
+def _normalize_review(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Light normalization so callers can assume every review key exists."""
+    data.setdefault("score", 0.0)
+    dims = data.setdefault("dimensions", {})
+    dims.setdefault("text_accuracy", 0.0)
+    dims.setdefault("character_accuracy", 0.0)
+    dims.setdefault("layout_readability", 0.0)
+    data.setdefault("issues", [])
+    data.setdefault("suggested_fix_prompt", "")
+    data.setdefault("notes", "")
+    return data
+
+
+def _review_request(
+    model: str,
+    system_prompt: str,
+    user_prompt_text: str,
+    image_url: str,
+) -> Dict[str, Any]:
+    """Keyword arguments of one vision chat completion with a JSON response."""
+    return {
+        "model": model,
+        "response_format": {"type": "json_object"},
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": user_prompt_text},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": image_url, "detail": REVIEW_IMAGE_DETAIL},
+                    },
+                ],
+            },
+        ],
+    }
+
+
+def _parse_review_response(resp: Any, model: str) -> Dict[str, Any]:
+    """Parse the JSON object returned by a review call."""
+    raw = resp.choices[0].message.content
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise RuntimeError(f"Panel review ({model}) returned invalid JSON: {e}\nRaw: {raw}")
+
+
+def _request_review(
+    model: str,
+    system_prompt: str,
+    user_prompt_text: str,
+    image_url: str,
+) -> Dict[str, Any]:
+    """One vision call with a JSON response; returns the parsed object."""
+    resp = openai_client.chat.completions.create(
+        **_review_request(model, system_prompt, user_prompt_text, image_url)
+    )
+    return _parse_review_response(resp, model)
+
+
+def _prepare_review(
+    image_url: str,
+    panel: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    min_score: float,
+    image_bytes: Optional[bytes],
+    use_cache: bool,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]], str, str]:
+    """
+    Blocking part of a review before the model call: cache lookup, prompt and
+    inline image encoding.
+
+    Returns:
+        (cache_key, cached review or None, user prompt, image URL to send)
+    """
+    print("         🔍 Starting quality review...")
+    print(f"         → Image URL: {image_url[:60]}...")
+
+    featured_students = panel.get("featured_students") or []
+    review_payload = _review_payload(panel, classroom, students, min_score)
+    expected_text = review_payload["expected_text"]
+
+    cache_key: Optional[str] = None
+    if image_bytes is not None:
+        cache_key = _review_cache_key(image_bytes, review_payload)
+        if use_cache:
+            cached = review_cache.get(cache_key)
+            if cached is not None:
+                print(f"         ✓ Review cache hit → score {cached['score']:.1f}/10")
+                return cache_key, cached, "", ""
+        else:
+            review_cache.record_bypass()
+
+    if not OPENAI_API_KEY or OPENAI_API_KEY == "YOUR_OPENAI_API_KEY_HERE":
+        raise RuntimeError("OPENAI_API_KEY not set; cannot run panel review")
+
+    print("         → Building review prompt...")
+    print(f"         → Expected students: {featured_students}")
+    print(f"         → Expected text lines: {len(expected_text)}")
+
+    user_prompt_text = (
+        "Here is the structured description of what this panel SHOULD contain.\n"
+        "Then you see the actual rendered image.\n\n"
+        "Tasks:\n"
+        "1) Carefully compare the text in the image (narration, bubbles, labels) to the "
+        "expected text. Note any missing, added, paraphrased, or unreadable words.\n"
+        "2) Check speech-bubble alignment:\n"
+        "   - For each dialogue line, is there a bubble whose tail clearly points to the "
+        "     correct character?\n"
+        "   - Are there any bubbles pointing to the wrong character, or characters speaking "
+        "     even though they have no dialogue defined for this panel?\n"
+        "   - Does any character talk in an obviously wrong way, such as referring to "
+        "     themselves in the third person or addressing themselves by name?\n"
+        "3) Check whether all named students that are supposed to appear are clearly present "
+        "   and consistent with their roles.\n"
+        "4) Check whether the layout makes the text easy to read (no cropping, no weird "
+        "   overlaps, text big enough for kids).\n\n"
+        "Then respond ONLY with a single JSON object with this structure:\n"
+        "{\n"
+        '  "score": float,                 // 0–10 overall\n'
+        '  "dimensions": {\n'
+        '    "text_accuracy": float,       // 0–10 (include correctness of text AND who says it)\n'
+        '    "character_accuracy": float,  // 0–10 (include whether bubbles attach to correct characters)\n'
+        '    "layout_readability": float   // 0–10\n'
+        "  },\n"
+        '  "issues": [ "string", ... ],    // list of concrete problems (mention bubble misalignment explicitly)\n'
+        '  "suggested_fix_prompt": "short text prompt to append to the image model prompt, '
+        "max 2–3 sentences, focusing on the most important fixes such as moving specific "
+        "bubbles to the right character, correcting mis-written text, or adding/removing "
+        'bubbles.",\n'
+        '  "notes": "optional extra comments or explanations"\n'
+        "}\n\n"
+        "Be concise and practical in 'issues' and 'suggested_fix_prompt'. For example, you "
+        "might say: \"Move the bubble with 'F = ma' so the tail points to LENA on the left; "
+        "replace the current text with 'F = m · a'; remove the extra bubble above the teacher.\"\n"
+        "If everything already looks perfect, you can still report a high score (e.g. 9.5–10) "
+        "and leave 'issues' empty and 'suggested_fix_prompt' as an empty string.\n\n"
+        f"PANEL SPEC JSON:\n{json.dumps(review_payload, ensure_ascii=False)}"
+    )
+
+    if image_bytes is not None:
+        review_image_url = encode_review_image(image_bytes)
+        print(f"         → Sending inline review image ({len(review_image_url) // 1024} KB data URL)")
+    else:
+        review_image_url = image_url
+
+    return cache_key, None, user_prompt_text, review_image_url
+
+
+def _escalate(model: str, data: Dict[str, Any], min_score: float) -> bool:
+    """Count the cascade tier and tell whether the review must be re-graded."""
+    if model == OPENAI_QA_MODEL:
+        _cascade_stats["strong_only"] += 1
+        return False
+    if _needs_escalation(data["score"], min_score):
+        print(f"         → Borderline score {float(data['score']):.1f} from {model}, escalating to {OPENAI_QA_MODEL}...")
+        _cascade_stats["escalated"] += 1
+        return True
+    _cascade_stats["fast"] += 1
+    return False
+
+
+def _finish_review(data: Dict[str, Any], model: str, cache_key: Optional[str]) -> Dict[str, Any]:
+    """Log and cache a completed review."""
+    data["review_model"] = model
+    dims = data["dimensions"]
+
+    print("         ✓ Review complete!")
+    print(f"         → Overall score: {data['score']:.1f}/10")
+    print(f"         → Text accuracy: {dims['text_accuracy']:.1f}/10")
+    print(f"         → Character accuracy: {dims['character_accuracy']:.1f}/10")
+    print(f"         → Layout readability: {dims['layout_readability']:.1f}/10")
+    if data['issues']:
+        print(f"         → Issues found: {len(data['issues'])}")
+
+    if cache_key is not None:
+        review_cache.set(cache_key, data)
+
+    return data
+
+
+async def _request_review_async(
+    model: str,
+    system_prompt: str,
+    user_prompt_text: str,
+    image_url: str,
+) -> Dict[str, Any]:
+    """_request_review on the shared AsyncOpenAI client, within a review_slot."""
+    async with review_slot():
+        resp = await async_openai_client.chat.completions.create(
+            **_review_request(model, system_prompt, user_prompt_text, image_url)
+        )
+    return _parse_review_response(resp, model)
+
+
+def review_panel_image(
+    image_url: str,
+    panel: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    min_score: float = 8.0,
+    image_bytes: Optional[bytes] = None,
+    use_cache: bool = True,
+) -> Dict[str, Any]:
+    """
+    Ask a multimodal OpenAI model to review a single comic panel image.
+
+    When image_bytes are given, they are downscaled and sent inline instead of
+    image_url (see encode_review_image), and the review is cached under the
+    SHA-256 of the bytes plus a hash of the panel spec (review_payload),
+    OPENAI_QA_MODEL and REVIEW_PROMPT_VERSION, so the same image is never
+    graded twice for the same spec. use_cache=False forces a fresh review.
+
+    Returns a dict like:
+    {
+      "score": 8.7,
+      "dimensions": {
+        "text_accuracy": 9.0,
+        "character_accuracy": 8.0,
+        "layout_readability": 9.0
+      },
+      "issues": [
+        "Speech bubble for LENA is missing",
+        "Text 'F=ma' is misspelled"
+      ],
+      "suggested_fix_prompt": "Add a speech bubble for LENA saying '...' and correct 'F=ma' text.",
+      "notes": "Additional free-form comments if needed."
+    }
+    """
+    cache_key, cached, user_prompt_text, review_image_url = _prepare_review(
+        image_url, panel, classroom, students, min_score, image_bytes, use_cache
+    )
+    if cached is not None:
+        return cached
+
+    model = OPENAI_QA_FAST_MODEL if _cascade_active() else OPENAI_QA_MODEL
+    print(f"         → Calling OpenAI Vision API ({model})...")
+    data = _normalize_review(
+        _request_review(model, REVIEW_SYSTEM_PROMPT, user_prompt_text, review_image_url)
+    )
+    if _escalate(model, data, min_score):
+        model = OPENAI_QA_MODEL
+        data = _normalize_review(
+            _request_review(model, REVIEW_SYSTEM_PROMPT, user_prompt_text, review_image_url)
+        )
+    return _finish_review(data, model, cache_key)
+
+
+async def review_panel_image_async(
+    image_url: str,
+    panel: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    min_score: float = 8.0,
+    image_bytes: Optional[bytes] = None,
+    use_cache: bool = True,
+) -> Dict[str, Any]:
+    """
+    Async review_panel_image: same arguments and result.
+
+    Model calls go through the shared AsyncOpenAI client and wait for a
+    review_slot (at most REVIEW_CONCURRENCY in flight per process); image
+    encoding and cache access run in worker threads.
+    """
+    cache_key, cached, user_prompt_text, review_image_url = await asyncio.to_thread(
+        _prepare_review, image_url, panel, classroom, students, min_score, image_bytes, use_cache
+    )
+    if cached is not None:
+        return cached
+
+    model = OPENAI_QA_FAST_MODEL if _cascade_active() else OPENAI_QA_MODEL
+    print(f"         → Calling OpenAI Vision API ({model})...")
+    data = _normalize_review(
+        await _request_review_async(model, REVIEW_SYSTEM_PROMPT, user_prompt_text, review_image_url)
+    )
+    if _escalate(model, data, min_score):
+        model = OPENAI_QA_MODEL
+        data = _normalize_review(
+            await _request_review_async(model, REVIEW_SYSTEM_PROMPT, user_prompt_text, review_image_url)
+        )
+    return await asyncio.to_thread(_finish_review, data, model, cache_key)
+
+# ─────────────────────────────────────────────────────────────
+# Batched review (contact sheet)
+# ─────────────────────────────────────────────────────────────
+
+REVIEW_BATCH_SYSTEM_ADDENDUM = (
+    "\nBATCH MODE: instead of one image you get a CONTACT SHEET of several panel "
+    "images, each tile marked with a letter label (A, B, C, ...) in the bar above it, "
+    "together with the expected script of each labelled tile. Review every tile "
+    "independently against ITS OWN script, with exactly the rules above; never let "
+    "one tile influence the score of another.\n"
+)
+
+
+def _sheet_label(position: int) -> str:
+    """Tile label: A..Z, then AA, AB, ..."""
+    letters = string.ascii_uppercase
+    label = ""
+    position += 1
+    while position:
+        position, rest = divmod(position - 1, 26)
+        label = letters[rest] + label
+    return label
+
+
+def build_contact_sheet(
+    images: List[bytes],
+    labels: List[str],
+    tile_width: int = REVIEW_SHEET_TILE_WIDTH,
+) -> str:
+    """
+    Tile several panel images into one labelled contact sheet.
+
+    Args:
+        images: Raw image bytes, one per tile
+        labels: Label drawn above each tile (same order as images)
+        tile_width: Width every tile is scaled to
+
+    Returns:
+        The contact sheet as an inline data URL (REVIEW_IMAGE_FORMAT)
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    tiles = []
+    for data in images:
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert("RGB")
+            height = max(1, round(img.height * tile_width / img.width))
+            tiles.append(img.resize((tile_width, height), Image.LANCZOS))
+
+    columns = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / columns)
+    label_height = max(32, tile_width // 16)
+    gap = 16
+    cell_height = label_height + max(t.height for t in tiles)
+    sheet = Image.new(
+        "RGB",
+        (columns * tile_width + (columns + 1) * gap, rows * cell_height + (rows + 1) * gap),
+        "white",
+    )
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default(size=int(label_height * 0.8))
+
+    for position, (tile, label) in enumerate(zip(tiles, labels)):
+        row, column = divmod(position, columns)
+        x = gap + column * (tile_width + gap)
+        y = gap + row * (cell_height + gap)
+        draw.rectangle([x, y, x + tile_width - 1, y + label_height - 1], fill="black")
+        draw.text((x + 8, y + label_height // 2), label, fill="white", font=font, anchor="lm")
+        sheet.paste(tile, (x, y + label_height))
+
+    return _encode_image(sheet)
+
+
+def _review_sheet(
+    labelled_specs: List[Dict[str, Any]],
+    images: List[bytes],
+    model: str = OPENAI_QA_MODEL,
+) -> Dict[str, Dict[str, Any]]:
+    """One vision call for one contact sheet; returns the raw reviews by label."""
+    labels = [spec["label"] for spec in labelled_specs]
+    sheet_url = build_contact_sheet(images, labels)
+
+    user_prompt_text = (
+        f"The contact sheet shows {len(labels)} rendered panels labelled "
+        f"{', '.join(labels)}. Below is what each labelled panel SHOULD contain.\n\n"
+        "For EACH label: compare the text in the tile to its expected text, check that "
+        "every bubble tail points to the correct speaker, check that the named students "
+        "are present, and check that the layout is easy to read for kids.\n\n"
+        "Respond ONLY with a single JSON object of this structure:\n"
+        "{\n"
+        '  "panels": [\n'
+        "    {\n"
+        '      "label": "A",\n'
+        '      "score": float,                 // 0–10 overall\n'
+        '      "dimensions": {\n'
+        '        "text_accuracy": float,\n'
+        '        "character_accuracy": float,\n'
+        '        "layout_readability": float\n'
+        "      },\n"
+        '      "issues": [ "string", ... ],\n'
+        '      "suggested_fix_prompt": "max 2–3 sentences of prompt-level fixes for THIS tile",\n'
+        '      "notes": "optional"\n'
+        "    }\n"
+        "  ]\n"
+        "}\n"
+        "with exactly one entry per label.\n\n"
+        f"PANEL SPECS JSON:\n{json.dumps(labelled_specs, ensure_ascii=False)}"
+    )
+
+    print(f"         → Calling OpenAI Vision API ({model}) with a {len(labels)}-panel contact sheet...")
+    data = _request_review(
+        model,
+        REVIEW_SYSTEM_PROMPT + REVIEW_BATCH_SYSTEM_ADDENDUM,
+        user_prompt_text,
+        sheet_url,
+    )
+
+    reviews: Dict[str, Dict[str, Any]] = {}
+    for entry in data.get("panels") or []:
+        if isinstance(entry, dict) and entry.get("label") in labels:
+            label = entry.pop("label")
+            reviews[label] = _normalize_review(entry)
+            reviews[label]["review_model"] = model
+    return reviews
+
+
+def review_panel_batch(
+    items: List[Dict[str, Any]],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    min_score: float = 8.0,
+    use_cache: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Review several panel images with one vision call per contact sheet.
+
+    Cached reviews are reused; the remaining images are tiled into labelled
+    contact sheets of up to REVIEW_SHEET_MAX_TILES images and graded together.
+    With the cascade, the fast model grades each sheet and borderline tiles
+    are re-graded together on a second sheet by OPENAI_QA_MODEL. Images the
+    model did not return a review for fall back to review_panel_image.
+
+    Args:
+        items: [{"panel": {...}, "image_bytes": b"...", "image_url": "..."}]
+               (several items may be candidates of the same panel)
+        classroom: Classroom record
+        students: Students of the classroom
+        min_score: Passing score
+        use_cache: False forces fresh reviews
+
+    Returns:
+        One review per item, in the same shape as review_panel_image
+    """
+    reviews: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    payloads = [_review_payload(item["panel"], classroom, students, min_score) for item in items]
+    keys = [
+        _review_cache_key(item["image_bytes"], payload, mode="sheet")
+        for item, payload in zip(items, payloads)
+    ]
+
+    pending: List[int] = []
+    for position, key in enumerate(keys):
+        cached = review_cache.get(key) if use_cache else None
+        if not use_cache:
+            review_cache.record_bypass()
+        if cached is not None:
+            reviews[position] = cached
+        else:
+            pending.append(position)
+
+    if pending:
+        if not OPENAI_API_KEY or OPENAI_API_KEY == "YOUR_OPENAI_API_KEY_HERE":
+            raise RuntimeError("OPENAI_API_KEY not set; cannot run panel review")
+        print(f"         🔍 Batched review of {len(pending)} images ({len(items) - len(pending)} cached)...")
+
+    sheet_size = max(1, REVIEW_SHEET_MAX_TILES)
+    for start in range(0, len(pending), sheet_size):
+        chunk = pending[start:start + sheet_size]
+        labelled_specs = [
+            {"label": _sheet_label(n), **payloads[position]}
+            for n, position in enumerate(chunk)
+        ]
+        images = [items[p]["image_bytes"] for p in chunk]
+        if _cascade_active():
+            sheet_reviews = _review_sheet(labelled_specs, images, OPENAI_QA_FAST_MODEL)
+            borderline = [
+                n for n, spec in enumerate(labelled_specs)
+                if spec["label"] in sheet_reviews
+                and _needs_escalation(sheet_reviews[spec["label"]]["score"], min_score)
+            ]
+            _cascade_stats["fast"] += len(sheet_reviews) - len(borderline)
+            if borderline:
+                print(f"         → {len(borderline)} borderline tiles, escalating to {OPENAI_QA_MODEL}...")
+                strong_reviews = _review_sheet(
+                    [labelled_specs[n] for n in borderline],
+                    [images[n] for n in borderline],
+                    OPENAI_QA_MODEL,
+                )
+                for n in borderline:
+                    label = labelled_specs[n]["label"]
+                    if label in strong_reviews:
+                        sheet_reviews[label] = strong_reviews[label]
+                        _cascade_stats["escalated"] += 1
+                    else:
+                        # Escalation lost this tile: review it on its own below
+                        del sheet_reviews[label]
+        else:
+            sheet_reviews = _review_sheet(labelled_specs, images)
+            _cascade_stats["strong_only"] += len(sheet_reviews)
+        for spec, position in zip(labelled_specs, chunk):
+            review = sheet_reviews.get(spec["label"])
+            if review is None:
+                print(f"         ⚠️  No review for tile {spec['label']}; reviewing it on its own...")
+                item = items[position]
+                reviews[position] = review_panel_image(
+                    image_url=item.get("image_url") or "",
+                    panel=item["panel"],
+                    classroom=classroom,
+                    students=students,
+                    min_score=min_score,
+                    image_bytes=item["image_bytes"],
+                    use_cache=use_cache,
+                )
+                continue
+            print(f"         ✓ Tile {spec['label']} (panel {spec['panel_index']}) → score {review['score']:.1f}/10")
+            review_cache.set(keys[position], review)
+            reviews[position] = review
+
+    return reviews
@@ -1,12 +1,12 @@
 """
 Avatar generation service using Black Forest Labs API.
 """
-import os
-import asyncio
-import httpx
-import uuid
-from typing import Optional, Dict, Any
-from database.database import get_student, update_student, get_classroom, supabase
+from typing import Any, Dict, Optional
+
+from database.database import get_student, update_student
+from services import bfl_client
+from services.image_store import store_image
+from services.image_variants import schedule_variants
 
 
 async def generate_avatar(student_id: str) -> Dict[str, Any]:
@@ -44,9 +44,8 @@ async def generate_avatar(student_id: str) -> Dict[str, Any]:
         print(f"[WARN] Could not fetch classroom for student {student_id}: {e}")
         # Continue without classroom - will use default design style
 
-    # Get API key
-    api_key = os.getenv("BLACK_FOREST_API_KEY")
-    if not api_key:
+    # Check API key
+    if not bfl_client.is_configured():
         raise ValueError("BLACK_FOREST_API_KEY not configured in environment")
 
     # Build prompt for avatar generation
@@ -54,7 +53,7 @@ async def generate_avatar(student_id: str) -> Dict[str, Any]:
     photo_url = student.get("photo_url")
 
     # Call Black Forest Labs API to generate avatar
-    bfl_avatar_url = await _call_black_forest_api(prompt, api_key, photo_url)
+    bfl_avatar_url = await _call_black_forest_api(prompt, photo_url)
 
     # Download and upload to Supabase storage
     supabase_avatar_url = await _upload_avatar_to_storage(bfl_avatar_url, student_id)
@@ -94,14 +93,12 @@ def _build_avatar_prompt(student: Dict[str, Any], classroom: Optional[Dict[str,
     return prompt
 
 
-async def _call_black_forest_api(prompt: str, api_key: str, image_url: Optional[str] = None) -> str:
-
+async def _call_black_forest_api(prompt: str, image_url: Optional[str] = None) -> str:
     """
     Call Black Forest Labs API to generate an image.
     
     Args:
         prompt: Text prompt for image generation
-        api_key: Black Forest Labs API key
         image_url: Optional reference image URL for image-to-image generation
         
     Returns:
@@ -109,67 +106,23 @@ async def _call_black_forest_api(prompt: str, api_key: str, image_url: Optional[
         
     Raises:
         httpx.HTTPError: If API request fails
+        RuntimeError: If generation fails
+        TimeoutError: If generation does not finish within 120 seconds
     """
-    url = "https://api.bfl.ai/v1/flux-2-pro"
-
-
-    headers = {
-        "accept": "application/json",
-        "x-key": api_key,
-        "Content-Type": "application/json"
-    }
-
     payload = {
         "prompt": prompt
-
-
     }
 
     # Add reference image if provided
     if image_url:
         payload["input_image"] = image_url
 
-
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        # Submit generation request
-        response = await client.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-
-        result = response.json()
-        request_id = result.get("id")
-        polling_url = result.get("polling_url")
-
-        if not request_id or not polling_url:
-            raise ValueError("No request ID or polling URL returned from Black Forest Labs API")
-
-        # Poll for result using the polling URL
-
-        max_attempts = 60
-
-        for attempt in range(max_attempts):
-            await asyncio.sleep(2)  # Wait 2 seconds between polls
-
-            result_response = await client.get(polling_url, headers=headers)
-            result_response.raise_for_status()
-
-            result_data = result_response.json()
-            status = result_data.get("status")
-
-            if status == "Ready":
-                generated_image_url = result_data.get("result", {}).get("sample")
-                if generated_image_url:
-                    return generated_image_url
-                raise ValueError("No image URL in completed result")
-
-            elif status == "Error":
-                error_msg = result_data.get("error", "Unknown error")
-                raise ValueError(f"Image generation failed: {error_msg}")
-
-            elif status in ["Pending", "Request Moderated"]:
-                # Continue polling
-                continue
-
-        raise TimeoutError("Image generation timed out after 120 seconds")
+    # Submit through the shared BFL client; its poller resolves the result (120 s max)
+    return await bfl_client.generate(
+        payload,
+        endpoint="flux-2-pro",
+        timeout_seconds=120.0,
+    )
 
 
 async def _upload_avatar_to_storage(image_url: str, student_id: str) -> str:
@@ -178,7 +131,7 @@ async def _upload_avatar_to_storage(image_url: str, student_id: str) -> str:
     
     Args:
         image_url: URL of the generated image from Black Forest Labs
-        student_id: UUID of the student (used for filename)
+        student_id: UUID of the student
         
     Returns:
         Public URL of the uploaded image in Supabase storage
@@ -190,40 +143,27 @@ async def _upload_avatar_to_storage(image_url: str, student_id: str) -> str:
     print(f"Downloading avatar from Black Forest Labs: {image_url}")
     
     # Download the image from Black Forest Labs
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.get(image_url)
-        response.raise_for_status()
-        image_data = response.content
+    image_data = await bfl_client.download(image_url)
     
     print(f"Downloaded {len(image_data)} bytes")
     
-    # Generate filename with student ID
-    filename = f"{student_id}.png"
-    
     try:
-        # Upload to Supabase storage in Avatars bucket (with upsert to replace if exists)
-        print(f"Uploading to Supabase Avatars bucket: {filename}")
-        
-        storage_response = supabase.storage.from_("Avatars").upload(
-            path=filename,
-            file=image_data,
-            file_options={
-                "content-type": "image/png",
-                "cache-control": "3600",
-                "upsert": "true"  # Replace if already exists
-            }
-        )
-        
-        # Check for upload errors
-        if hasattr(storage_response, 'error') and storage_response.error:
-            raise Exception(f"Supabase upload error: {storage_response.error}")
-            
+        # Upload to Supabase Avatars bucket under the image's content hash
+        # (identical avatars are stored once; each new avatar gets a new URL)
+        print(f"Uploading avatar of student {student_id} to Supabase Avatars bucket")
+        public_url = store_image("Avatars", image_data)
     except Exception as upload_error:
         print(f"Upload error: {upload_error}")
         raise Exception(f"Failed to upload avatar to Supabase: {str(upload_error)}")
-    
-    # Get public URL
-    public_url = supabase.storage.from_("Avatars").get_public_url(filename)
+
+    # Smaller WebP/AVIF encodings are built in the background
+    schedule_variants(
+        image_data,
+        "Avatars",
+        "",
+        lambda variants: update_student(student_id, {"avatar_variants": variants}),
+        label=f"avatar of student {student_id}",
+    )
     
     print(f"Avatar uploaded successfully: {public_url}")
     
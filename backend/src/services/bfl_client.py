@@ -0,0 +1,412 @@
+"""
+bfl_client.py
+
+Shared async client for the Black Forest Labs (FLUX) API.
+
+Panels, avatars and thumbnails all go through this module:
+- One process-wide pooled httpx.AsyncClient (HTTP/2 when `h2` is installed,
+  keep-alive reused across submits, polls and downloads)
+- One background poller that tracks every in-flight task in the process and
+  polls them on a shared schedule that adapts to the observed render time
+- A global cap on concurrently running tasks to stay under provider limits
+- submit() → poll() → download(), or generate() for submit + poll in one call
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Support both BFL_API_KEY and BLACK_FOREST_API_KEY for compatibility
+BFL_API_KEY = os.getenv("BFL_API_KEY") or os.getenv("BLACK_FOREST_API_KEY")
+BFL_API_BASE = os.getenv("BFL_API_BASE", "https://api.bfl.ai")
+BFL_MODEL_ENDPOINT = os.getenv("BFL_MODEL_ENDPOINT", "flux-2-pro")
+
+BFL_MAX_CONNECTIONS = int(os.getenv("BFL_MAX_CONNECTIONS", "20"))
+BFL_KEEPALIVE_SECONDS = float(os.getenv("BFL_KEEPALIVE_SECONDS", "60"))
+
+# Max tasks submitted and not yet finished, across the whole process
+BFL_MAX_INFLIGHT_TASKS = int(os.getenv("BFL_MAX_INFLIGHT_TASKS", "12"))
+# Shared poll schedule: first poll shortly before the expected render time,
+# then back off from the min interval up to the max interval
+BFL_POLL_MIN_INTERVAL = float(os.getenv("BFL_POLL_MIN_INTERVAL", "0.5"))
+BFL_POLL_MAX_INTERVAL = float(os.getenv("BFL_POLL_MAX_INTERVAL", "5.0"))
+BFL_DEFAULT_ETA_SECONDS = float(os.getenv("BFL_DEFAULT_ETA_SECONDS", "15"))
+
+# Statuses after which polling can stop without a result
+FAILED_STATUSES = {"Error", "Failed", "Request Moderated", "Content Moderated"}
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def is_configured() -> bool:
+    """True if a Black Forest Labs API key is available."""
+    return bool(BFL_API_KEY)
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Return the process-wide pooled client, creating it on first use.
+
+    An AsyncClient is bound to the event loop it first ran on, so a new one is
+    created if we are called from a different loop (e.g. a CLI asyncio.run).
+    """
+    global _client, _client_loop
+
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(
+                max_connections=BFL_MAX_CONNECTIONS,
+                max_keepalive_connections=BFL_MAX_CONNECTIONS,
+                keepalive_expiry=BFL_KEEPALIVE_SECONDS,
+            ),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def aclose() -> None:
+    """Close the shared client (call on application shutdown)."""
+    global _client, _client_loop
+
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
+
+def _headers() -> Dict[str, str]:
+    if not BFL_API_KEY:
+        raise RuntimeError("BFL_API_KEY is not set; cannot call FLUX API")
+    return {
+        "accept": "application/json",
+        "x-key": BFL_API_KEY,
+    }
+
+
+class _InflightTask:
+    """One submitted BFL task tracked by the shared poller."""
+
+    def __init__(
+        self,
+        task_id: str,
+        polling_url: str,
+        endpoint: str,
+        submitted_at: float,
+        deadline: float,
+        future: "asyncio.Future[str]",
+    ):
+        self.task_id = task_id
+        self.polling_url = polling_url
+        self.endpoint = endpoint
+        self.submitted_at = submitted_at
+        self.deadline = deadline
+        self.future = future
+        self.next_poll_at = submitted_at
+        self.late_polls = 0
+        # Set when the caller stopped waiting (e.g. a cancelled speculative render)
+        self.abandoned = False
+
+
+class _TaskMultiplexer:
+    """
+    Process-wide registry of in-flight BFL tasks.
+
+    A single background coroutine polls every tracked task when it is due,
+    resolving the awaiting futures as results arrive. Each task holds one of
+    BFL_MAX_INFLIGHT_TASKS slots until it finishes on the provider side (even
+    if the caller gave up waiting), so the cap reflects real provider load.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, _InflightTask] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional["asyncio.Task[None]"] = None
+        # Exponential moving average of render time per endpoint (seconds)
+        self._eta: Dict[str, float] = {}
+        self.stats: Dict[str, int] = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "timed_out": 0,
+            "abandoned": 0,
+            "polls": 0,
+            "poll_errors": 0,
+        }
+
+    def _bind(self) -> asyncio.AbstractEventLoop:
+        """(Re)create loop-bound primitives when called from a new event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._tasks = {}
+            self._slots = asyncio.Semaphore(BFL_MAX_INFLIGHT_TASKS)
+            self._wakeup = asyncio.Event()
+            self._runner = None
+        return loop
+
+    async def acquire_slot(self) -> None:
+        self._bind()
+        await self._slots.acquire()
+
+    def release_slot(self) -> None:
+        self._slots.release()
+
+    def expected_eta(self, endpoint: str) -> float:
+        return self._eta.get(endpoint, BFL_DEFAULT_ETA_SECONDS)
+
+    def track(self, task_id: str, polling_url: str, endpoint: str, timeout_seconds: float) -> "asyncio.Future[str]":
+        """Register a submitted task (its slot is already held) and return its future."""
+        loop = self._bind()
+        now = loop.time()
+        future: "asyncio.Future[str]" = loop.create_future()
+        # Nobody may be waiting any more when the result lands; don't warn about it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        task = _InflightTask(task_id, polling_url, endpoint, now, now + timeout_seconds, future)
+        self._schedule(task, now)
+        self._tasks[task_id] = task
+
+        if self._runner is None or self._runner.done():
+            self._runner = loop.create_task(self._run())
+        self._wakeup.set()
+        return future
+
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    def _schedule(self, task: _InflightTask, now: float) -> None:
+        """Adaptive backoff: wait for most of the expected ETA, then poll with growing intervals."""
+        elapsed = now - task.submitted_at
+        eta = self.expected_eta(task.endpoint)
+        if elapsed < eta * 0.8:
+            wait = eta * 0.8 - elapsed
+        else:
+            wait = BFL_POLL_MIN_INTERVAL * (1.5 ** task.late_polls)
+            task.late_polls += 1
+        wait = min(max(wait, BFL_POLL_MIN_INTERVAL), BFL_POLL_MAX_INTERVAL)
+        task.next_poll_at = min(now + wait, task.deadline)
+
+    def _finish(self, task: _InflightTask) -> None:
+        self._tasks.pop(task.task_id, None)
+        self.release_slot()
+
+    def _record_duration(self, endpoint: str, seconds: float) -> None:
+        previous = self._eta.get(endpoint)
+        self._eta[endpoint] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._tasks:
+            now = loop.time()
+            due: List[_InflightTask] = [t for t in self._tasks.values() if t.next_poll_at <= now]
+            if not due:
+                next_at = min(t.next_poll_at for t in self._tasks.values())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_at - now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # One broken poll must never take down the shared poller: every
+            # other tracked future would stay pending and its slot leak
+            results = await asyncio.gather(
+                *(self._poll_one(task) for task in due), return_exceptions=True
+            )
+            for task, result in zip(due, results):
+                if isinstance(result, Exception) and task.task_id in self._tasks:
+                    self._fail(task, result)
+
+    async def _poll_one(self, task: _InflightTask) -> None:
+        loop = asyncio.get_running_loop()
+        self.stats["polls"] += 1
+
+        try:
+            data = await get_result(task.polling_url)
+        except httpx.HTTPStatusError as e:
+            code = e.response.status_code
+            # Rate limited or provider error: back off and poll again (until the deadline)
+            if code != 429 and code < 500:
+                self._fail(task, e)
+                return
+            self.stats["poll_errors"] += 1
+            task.late_polls += 1
+            data = {"status": "Pending"}
+        except Exception as e:
+            # Connection problems or a truncated / non-JSON body: retry the poll
+            self.stats["poll_errors"] += 1
+            print(f"         ⚠️ FLUX poll of task {task.task_id} failed, retrying: {e}")
+            data = {"status": "Pending"}
+
+        now = loop.time()
+        status = data.get("status")
+
+        if status == "Ready":
+            sample_url = (data.get("result") or {}).get("sample")
+            if not sample_url:
+                self._fail(task, RuntimeError(f"FLUX result missing sample URL: {data}"))
+                return
+            self._record_duration(task.endpoint, now - task.submitted_at)
+            self.stats["completed"] += 1
+            if task.abandoned:
+                self.stats["abandoned"] += 1
+            else:
+                print(f"         → Generation complete! ({now - task.submitted_at:.1f}s)")
+            task.future.set_result(sample_url)
+            self._finish(task)
+            return
+
+        if status in FAILED_STATUSES:
+            self._fail(task, RuntimeError(f"FLUX generation failed ({status}): {data.get('error') or data}"))
+            return
+
+        if now >= task.deadline:
+            self.stats["timed_out"] += 1
+            self._fail(task, TimeoutError(f"Timed out after {task.deadline - task.submitted_at:.0f}s while polling FLUX result"))
+            return
+
+        self._schedule(task, now)
+
+    def _fail(self, task: _InflightTask, error: BaseException) -> None:
+        self.stats["failed"] += 1
+        if not task.future.done():
+            task.future.set_exception(error)
+        self._finish(task)
+
+
+_multiplexer = _TaskMultiplexer()
+
+
+def get_stats() -> Dict[str, Any]:
+    """Counters of the shared poller (for diagnostics endpoints)."""
+    return {
+        **_multiplexer.stats,
+        "inflight": _multiplexer.inflight(),
+        "max_inflight": BFL_MAX_INFLIGHT_TASKS,
+        "expected_eta_seconds": dict(_multiplexer._eta),
+    }
+
+
+async def submit(
+    payload: Dict[str, Any],
+    endpoint: Optional[str] = None,
+    timeout_seconds: float = 60.0,
+    timings: Optional[Dict[str, float]] = None,
+) -> Dict[str, Any]:
+    """
+    POST a generation/edit task and hand it to the shared poller.
+
+    Waits for a free in-flight slot first (global BFL_MAX_INFLIGHT_TASKS cap).
+    If a timings dict is given, "flux_queue" is set to the time spent waiting
+    for the slot plus the submit request.
+
+    Returns:
+      {"id": "...", "polling_url": "..."}
+    """
+    endpoint = endpoint or BFL_MODEL_ENDPOINT
+    started = time.perf_counter()
+    await _multiplexer.acquire_slot()
+
+    try:
+        client = get_client()
+        response = await client.post(
+            f"{BFL_API_BASE}/v1/{endpoint}",
+            headers=_headers(),
+            json=payload,
+        )
+        response.raise_for_status()
+        data = response.json()
+
+        task_id = data.get("id")
+        if not task_id:
+            raise RuntimeError(f"FLUX submit response missing id: {data}")
+    except BaseException:
+        _multiplexer.release_slot()
+        raise
+
+    # Older endpoints only return an id; poll the generic result endpoint then
+    data.setdefault("polling_url", f"{BFL_API_BASE}/v1/get_result?id={task_id}")
+    _multiplexer.stats["submitted"] += 1
+    _multiplexer.track(task_id, data["polling_url"], endpoint, timeout_seconds)
+    if timings is not None:
+        timings["flux_queue"] = time.perf_counter() - started
+    return data
+
+
+async def get_result(polling_url: str) -> Dict[str, Any]:
+    """Fetch the current status of a task once."""
+    client = get_client()
+    response = await client.get(polling_url, headers=_headers())
+    response.raise_for_status()
+    return response.json()
+
+
+async def poll(task_id: str) -> str:
+    """
+    Wait for a submitted task to finish on the shared poll schedule.
+
+    Call it right after submit(); finished tasks are no longer tracked.
+
+    Cancelling the caller does not cancel the provider-side task; the poller
+    keeps tracking it so its in-flight slot is released when it really ends.
+
+    Returns:
+      The result.sample URL (short-lived delivery URL)
+    """
+    task = _multiplexer._tasks.get(task_id)
+    if task is None:
+        raise RuntimeError(f"FLUX task {task_id} is not being tracked")
+    try:
+        return await asyncio.shield(task.future)
+    except asyncio.CancelledError:
+        task.abandoned = True
+        raise
+
+
+async def generate(
+    payload: Dict[str, Any],
+    endpoint: Optional[str] = None,
+    timeout_seconds: float = 60.0,
+    timings: Optional[Dict[str, float]] = None,
+) -> str:
+    """
+    Submit a task and wait for its sample URL.
+
+    If a timings dict is given, it gets "flux_queue" (slot wait + submit) and
+    "flux_render" (submitted until the result was seen; this includes any
+    queueing on the provider side, which the API does not report separately).
+    """
+    task = await submit(payload, endpoint=endpoint, timeout_seconds=timeout_seconds, timings=timings)
+    print("         → Request submitted, polling for result...")
+    submitted = time.perf_counter()
+    sample_url = await poll(task["id"])
+    if timings is not None:
+        timings["flux_render"] = time.perf_counter() - submitted
+    return sample_url
+
+
+async def download(url: str) -> bytes:
+    """Download a result image over the shared connection pool."""
+    client = get_client()
+    response = await client.get(url)
+    response.raise_for_status()
+    return response.content
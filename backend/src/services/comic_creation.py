@@ -1,907 +1,2807 @@
-"""
-comic_creation.py
-
-Step 2 of the pipeline:
-- Load chapter + stored state (teacher_outline, story_ideas)
-- Take chosen_idea_id from frontend
-- Call OpenAI to generate full script + panel breakdown
-- Build FLUX prompts, call Black Forest Labs FLUX.2 [pro] to generate images
-- Use previous panel image + student avatars as multi-reference inputs
-- Run an OpenAI vision-based quality check per panel (optional, configurable)
-- Retry low-scoring panels up to N times with refined prompts
-- Upload final images (Supabase Storage if configured) and create panel rows
-- Update chapter JSON state and return full chapter payload
-"""
-
-import os
-import json
-import time
-import uuid
-from typing import Any, Dict, List, Optional, Tuple
-
-import requests
-from dotenv import load_dotenv
-from openai import OpenAI
-
-from database.database import (
-    supabase,
-    get_classroom,
-    get_students_by_classroom,
-    get_chapter,
-    update_chapter,
-    create_panel,
-)
-
-# NEW: quality review helper
-from panel_review import review_panel_image
-
-# ─────────────────────────────────────────────────────────────
-# Environment + client setup
-# ─────────────────────────────────────────────────────────────
-
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "YOUR_OPENAI_API_KEY_HERE")
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5.1")
-
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-# Support both BFL_API_KEY and BLACK_FOREST_API_KEY for compatibility
-BFL_API_KEY = os.getenv("BFL_API_KEY") or os.getenv(
-    "BLACK_FOREST_API_KEY", "YOUR_BFL_API_KEY_HERE"
-)
-BFL_API_BASE = os.getenv("BFL_API_BASE", "https://api.bfl.ai")
-
-BFL_MODEL_ENDPOINT = os.getenv("BFL_MODEL_ENDPOINT", "flux-2-pro")
-
-SUPABASE_IMAGES_BUCKET = os.getenv("SUPABASE_IMAGES_BUCKET")
-
-# NEW: panel review configuration
-PANEL_REVIEW_ENABLED = os.getenv("PANEL_REVIEW_ENABLED", "true").lower() == "true"
-PANEL_REVIEW_MIN_SCORE = float(os.getenv("PANEL_REVIEW_MIN_SCORE", "9.0"))
-PANEL_REVIEW_MAX_ATTEMPTS = int(os.getenv("PANEL_REVIEW_MAX_ATTEMPTS", "3"))
-
-if not OPENAI_API_KEY or OPENAI_API_KEY == "YOUR_OPENAI_API_KEY_HERE":
-    print("[WARN] OPENAI_API_KEY not set; OpenAI calls will fail until you configure it.")
-
-if not BFL_API_KEY or BFL_API_KEY == "YOUR_BFL_API_KEY_HERE":
-    print("[WARN] BFL_API_KEY or BLACK_FOREST_API_KEY not set; FLUX calls will fail until you configure it.")
-
-
-# ─────────────────────────────────────────────────────────────
-# Public entrypoint
-# ─────────────────────────────────────────────────────────────
-
-def commit_story_choice(chapter_id: str, chosen_idea_id: str) -> Dict[str, Any]:
-    """
-    Complete the chapter pipeline once a story idea has been chosen.
-
-    Returns:
-      {
-        "chapter_id": ...,
-        "chapter_index": ...,
-        "classroom_id": ...,
-        "episode_title": "...",
-        "learning_objectives": [...],
-        "panels": [
-          {
-            "index": 1,
-            "setting": "...",
-            "description": "...",
-            "narration": "...",
-            "dialogue": [...],
-            "featured_students": [...],
-            "image_url": "https://..."
-          },
-          ...
-        ]
-      }
-    """
-
-    print(f"\n{'='*60}")
-    print(f"🎬 Starting Comic Generation")
-    print(f"{'='*60}")
-    print(f"Chapter ID: {chapter_id}")
-    print(f"Chosen Idea: {chosen_idea_id}")
-    
-    print("\n🧹 Step 0: Cleaning up existing panels (if any)...")
-    # Delete any existing panels for this chapter to allow regeneration
-    try:
-        supabase.table("panels").delete().eq("chapter_id", chapter_id).execute()
-        print("✓ Existing panels cleared")
-    except Exception as e:
-        print(f"⚠️  No existing panels to clear: {e}")
-    
-    print("\n📚 Step 1: Fetching chapter data...")
-    chapter = get_chapter(chapter_id)
-    if chapter is None:
-        raise ValueError(f"Chapter {chapter_id} not found")
-    print(f"✓ Chapter found: Index {chapter.get('index')}")
-
-    classroom_id: str = chapter["classroom_id"]
-    print(f"\n🏫 Step 2: Fetching classroom data...")
-    classroom = get_classroom(classroom_id)
-    if classroom is None:
-        raise ValueError(f"Classroom {classroom_id} not found")
-    print(f"✓ Classroom: {classroom.get('name')} ({classroom.get('subject')})")
-
-    print(f"\n👥 Step 3: Fetching students...")
-    students = get_students_by_classroom(classroom_id)
-    print(f"✓ Found {len(students)} students")
-
-    # Build lookup: student name (lowercased) -> full record (for avatars)
-    students_by_name: Dict[str, Dict[str, Any]] = {
-        s["name"].strip().lower(): s for s in students
-    }
-
-    # Get story ideas from the dedicated field
-    print(f"\n💡 Step 4: Loading story ideas...")
-    story_ideas = chapter.get("story_ideas", [])
-    if not story_ideas:
-        raise ValueError(
-            f"No story ideas found for chapter {chapter_id}; "
-            "start_chapter must be called first to generate ideas."
-        )
-    print(f"✓ Found {len(story_ideas)} story ideas")
-
-    teacher_outline = chapter.get("original_prompt", "")
-
-    # Find the chosen idea
-    chosen_idea: Optional[Dict[str, Any]] = next(
-        (idea for idea in story_ideas if idea["id"] == chosen_idea_id),
-        None,
-    )
-    if chosen_idea is None:
-        raise ValueError(f"Chosen idea id {chosen_idea_id} not found for chapter {chapter_id}")
-    print(f"✓ Selected: {chosen_idea.get('title')}")
-
-    # Generate full script + panels via OpenAI
-    print(f"\n🤖 Step 5: Generating comic script with OpenAI...")
-    print(f"   Model: {OPENAI_MODEL}")
-    script = generate_full_script_and_panels(
-        classroom=classroom,
-        students=students,
-        teacher_outline=teacher_outline,
-        chosen_idea=chosen_idea,
-    )
-    print(f"✓ Script generated: {script.get('episode_title')}")
-    print(f"✓ Panels to generate: {len(script.get('panels', []))}")
-
-    # Build FLUX prompts
-    print(f"\n📝 Step 6: Building FLUX prompts...")
-    flux_prompts = build_flux_prompts_from_script(
-        classroom=classroom,
-        students=students,
-        script=script,
-    )
-    print(f"✓ Built {len(flux_prompts)} prompts")
-
-    # Map panel index -> panel dict for convenience
-    panels_by_index: Dict[int, Dict[str, Any]] = {
-        int(p["index"]): p for p in script["panels"]
-    }
-
-    # Generate images and create panel rows
-    print(f"\n🎨 Step 7: Generating images with FLUX...")
-    print(f"   Endpoint: {BFL_MODEL_ENDPOINT}")
-    print(f"   This may take 1-2 minutes per panel...\n")
-    
-    panel_index_to_url: Dict[int, str] = {}
-    previous_panel_image_url: Optional[str] = None
-    panel_quality: Dict[int, Dict[str, Any]] = {}
-
-    # Make sure we generate in index order
-    for panel_prompt in sorted(flux_prompts, key=lambda p: p["index"]):
-        idx = panel_prompt["index"]
-        base_prompt = panel_prompt["prompt"]
-        aspect_ratio = panel_prompt["aspect_ratio"]
-
-        print(f"   Panel {idx}/{len(flux_prompts)}:")
-
-        panel = panels_by_index.get(idx, {})
-        featured_students = panel.get("featured_students") or []
-        dialogue = panel.get("dialogue") or []
-
-        # Collect names mentioned in this panel (featured + speakers)
-        mentioned_names: set[str] = set()
-        for name in featured_students:
-            if isinstance(name, str):
-                mentioned_names.add(name.strip())
-        for line in dialogue:
-            speaker = line.get("speaker")
-            if isinstance(speaker, str):
-                mentioned_names.add(speaker.strip())
-
-        # Resolve avatars from DB for mentioned students
-        avatar_urls: List[str] = []
-        for name in mentioned_names:
-            student = students_by_name.get(name.lower())
-            if student:
-                avatar = student.get("avatar_url")
-                if avatar:
-                    avatar_urls.append(avatar)
-
-        # Build reference images list:
-        #  - previous panel image (if any) first, to keep style across panels
-        #  - then all unique student avatars for this panel
-        reference_images: List[str] = []
-        if previous_panel_image_url:
-            reference_images.append(previous_panel_image_url)
-
-        for url in avatar_urls:
-            if url not in reference_images:
-                reference_images.append(url)
-
-        # FLUX.2 [pro] supports up to 8 reference images via input_image..input_image_8
-        if len(reference_images) > 8:
-            reference_images = reference_images[:8]
-
-        print(f"      - Using {len(reference_images)} reference images")
-
-        # NEW: quality-aware generation loop
-        if not PANEL_REVIEW_ENABLED:
-            # Old behavior: single generation, no review
-            print(f"      - Review disabled; generating once...")
-            image_bytes, source_url = call_flux_and_download(
-                base_prompt,
-                aspect_ratio=aspect_ratio,
-                reference_images=reference_images,
-            )
-            image_url = upload_image_and_get_url(
-                img_bytes=image_bytes,
-                chapter_id=chapter_id,
-                panel_index=idx,
-                fallback_url=source_url,
-            )
-            create_panel(chapter_id=chapter_id, index=idx, image=image_url)
-            panel_index_to_url[idx] = image_url
-            previous_panel_image_url = image_url
-            continue
-
-        best_image_bytes: Optional[bytes] = None
-        best_source_url: Optional[str] = None
-        best_score: float = -1.0
-        best_review: Optional[Dict[str, Any]] = None
-
-        current_prompt = base_prompt
-
-        for attempt in range(1, PANEL_REVIEW_MAX_ATTEMPTS + 1):
-            print(f"\n      🎯 Attempt {attempt}/{PANEL_REVIEW_MAX_ATTEMPTS}")
-            print(f"      → Generating image with FLUX...")
-            image_bytes, source_url = call_flux_and_download(
-                current_prompt,
-                aspect_ratio=aspect_ratio,
-                reference_images=reference_images,
-            )
-
-            print(f"      ✓ Image generated ({len(image_bytes)} bytes)")
-            
-            # Run multimodal review against the *BFL sample URL*
-            print(f"      → Running quality review...")
-            try:
-                review = review_panel_image(
-                    image_url=source_url,
-                    panel=panel,
-                    classroom=classroom,
-                    students=students,
-                    min_score=PANEL_REVIEW_MIN_SCORE,
-                )
-                score = float(review.get("score", 0.0))
-                print(f"      ✓ Quality score: {score:.1f}/10 (threshold: {PANEL_REVIEW_MIN_SCORE})")
-                issues = review.get("issues") or []
-                if issues:
-                    print(f"      ⚠️  Issues found:")
-                    for i, issue in enumerate(issues, 1):
-                        print(f"         {i}. {issue}")
-            except Exception as e:
-                print(f"      ❌ Panel review failed (attempt {attempt}): {e}")
-                review = None
-                score = 0.0
-
-            # Track best attempt so far
-            if score > best_score:
-                best_score = score
-                best_image_bytes = image_bytes
-                best_source_url = source_url
-                best_review = review
-
-            # If we passed the quality threshold, stop retrying
-            if score >= PANEL_REVIEW_MIN_SCORE:
-                print(f"      ✅ Panel passed quality threshold! (score {score:.1f} >= {PANEL_REVIEW_MIN_SCORE})")
-                break
-
-            # Otherwise, refine prompt using suggested fix (if any) and try again
-            if attempt < PANEL_REVIEW_MAX_ATTEMPTS:
-                print(f"      ⚠️  Score {score:.1f} below threshold {PANEL_REVIEW_MIN_SCORE}, will retry...")
-                
-                # Build aggressive, targeted fix prompt
-                fix_parts = []
-                
-                # Get the suggested fix from the review
-                if review:
-                    suggested_fix = (review.get("suggested_fix_prompt") or "").strip()
-                    if suggested_fix:
-                        fix_parts.append(suggested_fix)
-                    
-                    # Extract specific issues and create targeted fixes
-                    issues = review.get("issues") or []
-                    dimensions = review.get("dimensions") or {}
-                    
-                    # If text accuracy is low, be VERY strict about spelling
-                    text_accuracy = dimensions.get("text_accuracy", 0.0)
-                    if text_accuracy < 7.0 and issues:
-                        fix_parts.append(
-                            "CRITICAL: Text must be spelled EXACTLY correctly with no errors. "
-                            "Double-check every word for spelling mistakes."
-                        )
-                    
-                    # If character accuracy is low, emphasize character presence
-                    char_accuracy = dimensions.get("character_accuracy", 0.0)
-                    if char_accuracy < 7.0:
-                        fix_parts.append(
-                            f"REQUIRED: All characters must be clearly visible: {', '.join(featured_students)}. "
-                            "Each character must be distinct and recognizable."
-                        )
-                    
-                    # Add specific issue-based fixes
-                    for issue in issues:
-                        issue_lower = issue.lower()
-                        
-                        # Spelling/text issues
-                        if any(word in issue_lower for word in ["spell", "misspell", "wrong text", "incorrect text"]):
-                            fix_parts.append(
-                                f"FIX IMMEDIATELY: {issue}. "
-                                "Verify spelling character-by-character before rendering."
-                            )
-                        
-                        # Missing elements
-                        elif "missing" in issue_lower:
-                            fix_parts.append(
-                                f"MUST ADD: {issue}. "
-                                "This element is required and cannot be omitted."
-                            )
-                        
-                        # Bubble/dialogue issues
-                        elif any(word in issue_lower for word in ["bubble", "dialogue", "speech"]):
-                            fix_parts.append(
-                                f"DIALOGUE FIX: {issue}. "
-                                "Ensure bubble tails point to the correct speaker."
-                            )
-                
-                # Escalate strictness on subsequent attempts
-                if attempt == 2:
-                    fix_parts.insert(0, 
-                        "SECOND ATTEMPT - BE MORE CAREFUL: The previous image had errors. "
-                        "Pay extra attention to the following corrections:"
-                    )
-                elif attempt >= 3:
-                    fix_parts.insert(0,
-                        "FINAL ATTEMPT - MAXIMUM PRECISION REQUIRED: Multiple attempts have failed. "
-                        "This is the last chance. Follow these corrections EXACTLY:"
-                    )
-                
-                if fix_parts:
-                    # Join all fix parts with clear separation
-                    comprehensive_fix = " ".join(fix_parts)
-                    print(f"      → Applying targeted fixes:")
-                    for i, part in enumerate(fix_parts, 1):
-                        print(f"         {i}. {part[:80]}...")
-                    
-                    # Append to base prompt with emphasis
-                    current_prompt = base_prompt + "\n\nCRITICAL CORRECTIONS: " + comprehensive_fix
-                else:
-                    print(f"      → No specific fixes available; retrying with same prompt")
-                    current_prompt = base_prompt
-            else:
-                print(f"      ⚠️  Max attempts reached, will use best attempt")
-
-        # After attempts, accept best attempt (even if below threshold)
-        if best_image_bytes is None or best_source_url is None:
-            raise RuntimeError(f"Panel {idx}: generation failed; no image bytes returned")
-
-        print(f"\n      📦 Using best attempt (score={best_score:.1f})")
-        print(f"      → Uploading to storage...")
-        image_url = upload_image_and_get_url(
-            img_bytes=best_image_bytes,
-            chapter_id=chapter_id,
-            panel_index=idx,
-            fallback_url=best_source_url,
-        )
-        print(f"      ✓ Uploaded: {image_url[:60]}...")
-
-        create_panel(chapter_id=chapter_id, index=idx, image=image_url)
-        print(f"      ✓ Panel {idx} complete!\n")
-
-        panel_index_to_url[idx] = image_url
-        previous_panel_image_url = image_url
-        if best_review is not None:
-            panel_quality[idx] = best_review
-
-    # Update chapter with story script and status
-    print(f"\n💾 Step 8: Saving chapter data...")
-    # Attach panel_quality into the script for later inspection (optional)
-    if panel_quality:
-        script["panel_quality"] = panel_quality
-
-    update_chapter(
-        chapter_id,
-        {
-            "chosen_idea_id": chosen_idea_id,
-            "story_script": script,
-            "status": "ready",
-        },
-    )
-    print(f"✓ Chapter updated to 'ready' status")
-
-    # Build structured payload for frontend
-    print(f"\n📦 Step 9: Building response payload...")
-    panels_output: List[Dict[str, Any]] = []
-    for panel in script["panels"]:
-        idx = panel["index"]
-        panels_output.append(
-            {
-                "index": idx,
-                "setting": panel["setting"],
-                "description": panel["description"],
-                "narration": panel["narration"],
-                "dialogue": panel["dialogue"],
-                "featured_students": panel["featured_students"],
-                "image_url": panel_index_to_url.get(idx),
-            }
-        )
-
-    result = {
-        "chapter_id": chapter_id,
-        "chapter_index": chapter["index"],
-        "classroom_id": classroom_id,
-        "episode_title": script["episode_title"],
-        "learning_objectives": script.get("learning_objectives", []),
-        "panels": panels_output,
-    }
-    
-    print(f"\n{'='*60}")
-    print(f"✅ Comic Generation Complete!")
-    print(f"{'='*60}")
-    print(f"Episode: {script['episode_title']}")
-    print(f"Panels: {len(panels_output)}")
-    print(f"{'='*60}\n")
-    
-    return result
-
-
-# ─────────────────────────────────────────────────────────────
-# OpenAI helpers
-# ─────────────────────────────────────────────────────────────
-
-def _classroom_context_dict(
-    classroom: Dict[str, Any],
-    students: List[Dict[str, Any]],
-    teacher_outline: str,
-) -> Dict[str, Any]:
-    """Compact JSON context that we send to OpenAI."""
-    return {
-        "classroom": {
-            "id": classroom["id"],
-            "name": classroom["name"],
-            "subject": classroom["subject"],
-            "grade_level": classroom["grade_level"],
-            "story_theme": classroom["story_theme"],
-            "design_style": classroom["design_style"],
-            "duration": classroom["duration"],
-        },
-        "students": [
-            {
-                "name": s["name"],
-                "interests": s.get("interests", ""),
-                "avatar_url": s.get("avatar_url"),
-            }
-            for s in students
-        ],
-        "teacher_outline": teacher_outline,
-    }
-
-
-def generate_full_script_and_panels(
-    classroom: Dict[str, Any],
-    students: List[Dict[str, Any]],
-    teacher_outline: str,
-    chosen_idea: Dict[str, Any],
-) -> Dict[str, Any]:
-    """
-    Ask OpenAI for a full script + panel breakdown.
-    """
-
-    payload = _classroom_context_dict(classroom, students, teacher_outline)
-    payload["chosen_idea"] = chosen_idea
-
-    system_prompt = (
-        "You write scripts for short educational comics. "
-        "Target: kids 6–16, clear and simple language, 8–12 panels per chapter. "
-        "Always respond with a single JSON object following the requested schema."
-    )
-
-    user_prompt = (
-        "Using the given classroom, students, teacher_outline and chosen_idea, write a single comic chapter.\n\n"
-                "Constraints:\n"
-        "- 8 to 12 panels total.\n"
-        "- Panels 1–3: introduce the situation and characters.\n"
-        "- Middle panels: show a small challenge or question related to the learning topic.\n"
-        "- Final panels: resolve the situation and recap the key learning objective.\n"
-        "- Each panel should have at most 1 narration box and at most 2 speech bubbles.\n"
-        "- Each narration or dialogue line must be very short (max 10 words).\n"
-        "- Each panel should be visually distinct and move the story forward.\n"
-        "- Use the students' names in dialogue sometimes to make it personal.\n"
-        "- Do NOT have characters speak about themselves in the third person.\n"
-        "- Do NOT have a character address themselves by name in their own speech bubble.\n"
-        "- Keep dialogue lines short (max 15 words).\n"
-        "- Make sure the story helps understand the subject in a concrete way.\n"
-        "- The 'speaker' field must always be either a student name from this classroom\n"
-        "  or 'Teacher' / 'Narrator'.\n\n"
-        "Return ONLY a JSON object with this structure (no extra text):\n"
-        "{\n"
-        '  "episode_title": "short, fun title",\n'
-        '  "learning_objectives": ["objective 1", "objective 2", ...],\n'
-        '  "panels": [\n'
-        "    {\n"
-        '      "index": 1,\n'
-        '      "setting": "location and time",\n'
-        '      "description": "what we see in the drawing, including characters and actions",\n'
-        '      "narration": "optional narrator text or empty string",\n'
-        '      "dialogue": [\n'
-        '        {"speaker": "Name", "text": "line of dialogue"},\n'
-        "        ...\n"
-        "      ],\n"
-        '      "featured_students": ["Name1", "Name2", ...]\n'
-        "    },\n"
-        "    ...\n"
-        "  ]\n"
-        "}\n\n"
-        f"INPUT:\n{json.dumps(payload, ensure_ascii=False)}"
-    )
-
-    resp = openai_client.chat.completions.create(
-        model=OPENAI_MODEL,
-        response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-    )
-
-    raw = resp.choices[0].message.content
-    try:
-        data = json.loads(raw)
-    except json.JSONDecodeError as e:
-        raise RuntimeError(f"OpenAI returned invalid JSON for script: {e}\nRaw: {raw}")
-
-    panels = data.get("panels", [])
-    # Normalize panel indices to 1..N if missing/invalid
-    for idx, panel in enumerate(panels, start=1):
-        panel["index"] = int(panel.get("index", idx))
-        panel.setdefault("setting", "")
-        panel.setdefault("description", "")
-        panel.setdefault("narration", "")
-        panel.setdefault("dialogue", [])
-        panel.setdefault("featured_students", [])
-
-    data["panels"] = panels
-    data.setdefault("episode_title", chosen_idea.get("title", "Untitled Chapter"))
-    data.setdefault("learning_objectives", [])
-
-    return data
-
-
-# ─────────────────────────────────────────────────────────────
-# Flux prompt construction
-# ─────────────────────────────────────────────────────────────
-
-def _panel_text_for_prompt(panel: Dict[str, Any]) -> str:
-    """
-    Convert narration + dialogue into short, structured lines for FLUX.
-
-    We explicitly tell the model:
-    - Which character should have which bubble
-    - Where to place the bubble / tail
-    """
-    lines: List[str] = []
-
-    narration = (panel.get("narration") or "").strip()
-    if narration:
-        lines.append(
-            f'NARRATION_BOX (top of panel, no tail, centered): "{narration}"'
-        )
-
-    for line in panel.get("dialogue") or []:
-        speaker = (line.get("speaker") or "").strip()
-        text = (line.get("text") or "").strip()
-        if not text:
-            continue
-
-        if speaker:
-            # Very explicit: who speaks, where the bubble goes, where the tail points
-            lines.append(
-                f'SPEECH_BUBBLE for {speaker.upper()} '
-                f'(bubble above or beside {speaker.upper()}, tail clearly pointing '
-                f'to {speaker.upper()}): "{text}"'
-            )
-        else:
-            lines.append(f'UNASSIGNED_SPEECH_BUBBLE: "{text}"')
-
-    return " | ".join(lines)
-
-
-def build_flux_prompts_from_script(
-    classroom: Dict[str, Any],
-    students: List[Dict[str, Any]],
-    script: Dict[str, Any],
-) -> List[Dict[str, Any]]:
-    """
-    Build text-to-image prompts for each panel based on the script and classroom style.
-    Now also instructs FLUX.2 to render the narration + dialogue text inside the panel.
-    """
-
-    design_style = classroom.get("design_style", "comic")
-    if design_style == "manga":
-        style_phrase = (
-            "in a clean black-and-white manga style, expressive characters, clear line art"
-        )
-    else:
-        style_phrase = (
-            "in a colorful, kid-friendly comic style, clear line art, simple shading"
-        )
-
-    theme_phrase = classroom.get("story_theme", "")
-
-    student_descriptors: Dict[str, str] = {}
-    for s in students:
-        interests = s.get("interests", "")
-        if interests:
-            student_descriptors[s["name"]] = f"{s['name']}, a student who likes {interests}"
-        else:
-            student_descriptors[s["name"]] = f"{s['name']}, a student"
-
-    flux_prompts: List[Dict[str, Any]] = []
-
-    for panel in script["panels"]:
-        idx = int(panel["index"])
-        setting = panel.get("setting") or ""
-        description = panel.get("description") or ""
-        featured = panel.get("featured_students") or []
-
-        if featured:
-            cast_desc = ", ".join(
-                student_descriptors.get(name, name) for name in featured
-            )
-            cast_phrase = f"Show the students: {cast_desc}."
-        else:
-            cast_phrase = "Show a small group of students and a teacher."
-
-        # Base visual prompt
-        # Build the base visual prompt
-        prompt = (
-            f"A single comic panel {style_phrase}. "
-            f"Scene setting: {setting}. "
-            f"Visual description: {description}. "
-            f"{cast_phrase} "
-            "Keep composition readable for text bubbles. "
-            "Keep character designs and overall style consistent across panels and "
-            "with any reference images provided. "
-            "Each speech bubble MUST be attached to the correct speaker: the tail of "
-            "the bubble must clearly point to the mouth/head of the character who "
-            "is speaking. Do NOT show characters speaking if they have no speech "
-            "bubble defined for this panel. Do NOT duplicate or invent extra text."
-        )
-
-        if theme_phrase:
-            prompt += f"Match the ongoing story theme: {theme_phrase}. "
-
-        # NEW: tell FLUX.2 to render the actual text from this panel
-        panel_text = _panel_text_for_prompt(panel)
-        if panel_text:
-            prompt += (
-                "Write the following text clearly inside comic-style speech bubbles "
-                "and narration boxes. Use bold, uppercase comic lettering in black "
-                "on white bubbles/boxes, with no distortion or extra flourishes. "
-                "Do NOT paraphrase or change the wording. Use every line exactly as given. "
-                "For each SPEECH_BUBBLE line, place the bubble near the named character "
-                "and point the tail directly to that character. For the NARRATION_BOX, "
-                "place it at the top of the panel with no tail. Text to write (each '|' "
-                "separates a different bubble or box): "
-                f"{panel_text} "
-            )
-
-        aspect_ratio = "3:2"
-
-        flux_prompts.append(
-            {
-                "index": idx,
-                "prompt": prompt,
-                "aspect_ratio": aspect_ratio,
-            }
-        )
-
-    return flux_prompts
-
-
-# ─────────────────────────────────────────────────────────────
-# FLUX / Black Forest Labs API helpers
-# ─────────────────────────────────────────────────────────────
-
-def _dims_from_aspect(aspect_ratio: str) -> Tuple[int, int]:
-    """
-    Map a simple aspect ratio string to width/height for FLUX.2 [pro].
-    FLUX.2 works with explicit width/height instead of a string aspect ratio.
-    """
-    aspect_ratio = aspect_ratio.strip()
-    if aspect_ratio == "1:1":
-        return 768, 768
-    if aspect_ratio in ("3:2", "2:3"):
-        return (960, 640) if aspect_ratio == "3:2" else (640, 960)
-    if aspect_ratio in ("16:9", "9:16"):
-        return (960, 540) if aspect_ratio == "16:9" else (540, 960)
-    # Default: 3:2-ish
-    return 960, 640
-
-
-def call_flux_and_download(
-    prompt: str,
-    aspect_ratio: str = "3:2",
-    reference_images: Optional[List[str]] = None,
-    poll_interval: float = 0.75,
-    timeout_seconds: float = 60.0,
-) -> Tuple[bytes, str]:
-    """
-    1) POST to BFL async endpoint to create a generation/edit task (FLUX.2 [pro]).
-    2) Optionally pass up to 8 reference images (previous panel + student avatars)
-       as input_image, input_image_2, ..., input_image_8.
-    3) Poll the returned polling_url until status == 'Ready' or timeout.
-    4) Download the resulting image bytes from result.sample URL.
-
-    Returns:
-      (image_bytes, source_url)
-    """
-
-    if not BFL_API_KEY or BFL_API_KEY == "YOUR_BFL_API_KEY_HERE":
-        raise RuntimeError("BFL_API_KEY is not set; cannot call FLUX API")
-
-    submit_url = f"{BFL_API_BASE}/v1/{BFL_MODEL_ENDPOINT}"
-    headers = {
-        "accept": "application/json",
-        "Content-Type": "application/json",
-        "x-key": BFL_API_KEY,
-    }
-
-    width, height = _dims_from_aspect(aspect_ratio)
-
-    body: Dict[str, Any] = {
-        "prompt": prompt,
-        "width": width,
-        "height": height,
-        "output_format": "png",
-        "safety_tolerance": 4,
-        # You can uncomment this if you've found prompt_upsampling hurts text:
-        # "prompt_upsampling": False,
-    }
-
-    # Attach reference images as input_image..input_image_8
-    refs = reference_images or []
-    for i, ref in enumerate(refs):
-        if i >= 8:
-            break
-        key = "input_image" if i == 0 else f"input_image_{i + 1}"
-        body[key] = ref
-
-    submit_resp = requests.post(submit_url, headers=headers, json=body, timeout=30)
-    submit_resp.raise_for_status()
-    submit_data = submit_resp.json()
-
-    polling_url = submit_data.get("polling_url")
-    if not polling_url:
-        raise RuntimeError(f"FLUX submit response missing polling_url: {submit_data}")
-
-    print(f"         → Request submitted, polling for result...")
-    start = time.time()
-    poll_count = 0
-    
-    while True:
-        if time.time() - start > timeout_seconds:
-            raise TimeoutError("Timed out while polling FLUX generation result")
-
-        time.sleep(poll_interval)
-        poll_count += 1
-
-        poll_resp = requests.get(
-            polling_url,
-            headers={
-                "accept": "application/json",
-                "x-key": BFL_API_KEY,
-            },
-            timeout=30,
-        )
-        poll_resp.raise_for_status()
-        poll_data = poll_resp.json()
-
-        status = poll_data.get("status")
-        
-        if poll_count % 5 == 0:  # Print every 5 polls
-            elapsed = time.time() - start
-            print(f"         → Still generating... ({elapsed:.1f}s elapsed, status: {status})")
-        
-        if status == "Ready":
-            elapsed = time.time() - start
-            print(f"         → Generation complete! ({elapsed:.1f}s)")
-            
-            result = poll_data.get("result", {})
-            sample_url = result.get("sample")
-            if not sample_url:
-                raise RuntimeError(f"FLUX result missing sample URL: {poll_data}")
-
-            img_resp = requests.get(sample_url, timeout=30)
-            img_resp.raise_for_status()
-            return img_resp.content, sample_url
-
-        if status in {"Error", "Failed"}:
-            raise RuntimeError(f"FLUX generation failed: {poll_data}")
-
-
-def upload_image_and_get_url(
-    img_bytes: bytes,
-    chapter_id: str,
-    panel_index: int,
-    fallback_url: str,
-) -> str:
-    """
-    Upload image bytes to Supabase Storage if SUPABASE_IMAGES_BUCKET is configured.
-    Uses unique UUID for each image to prevent overwriting on regeneration.
-    Otherwise, fall back to the original FLUX delivery URL (short-lived, not ideal for production).
-    """
-
-    if not SUPABASE_IMAGES_BUCKET:
-        return fallback_url
-
-    image_id = str(uuid.uuid4())
-    path = f"chapters/{chapter_id}/panel_{panel_index:02d}_{image_id}.png"
-
-    try:
-        supabase.storage.from_(SUPABASE_IMAGES_BUCKET).upload(
-            path=path,
-            file=img_bytes,
-            file_options={
-                "content-type": "image/png",
-                "cache-control": "3600",
-                "upsert": "true",
-            },
-        )
-
-        public_url = supabase.storage.from_(SUPABASE_IMAGES_BUCKET).get_public_url(path)
-        if isinstance(public_url, dict):
-            public_url = (
-                public_url.get("publicUrl")
-                or public_url.get("public_url")
-                or fallback_url
-            )
-
-        return public_url  # type: ignore[return-value]
-    except Exception as e:
-        print(f"[WARN] Failed to upload image to Supabase Storage: {e}")
-        return fallback_url
-
-
-
-# ─────────────────────────────────────────────────────────────
-# Optional CLI for testing
-# ─────────────────────────────────────────────────────────────
-
-if __name__ == "__main__":
-    import argparse
-
-    parser = argparse.ArgumentParser(
-        description="Commit a chosen story idea and generate full chapter"
-    )
-    parser.add_argument("chapter_id", help="Chapter UUID")
-    parser.add_argument("chosen_idea_id", help="ID of the chosen idea (e.g. idea_1)")
-
-    args = parser.parse_args()
-
-    result = commit_story_choice(args.chapter_id, args.chosen_idea_id)
-    print(json.dumps(result, indent=2, ensure_ascii=False))
+"""
+comic_creation.py
+
+Step 2 of the pipeline:
+- Load chapter + stored state (teacher_outline, story_ideas)
+- Take chosen_idea_id from frontend
+- Call OpenAI to generate full script + panel breakdown
+- Build FLUX prompts, call Black Forest Labs FLUX.2 [pro] to generate images
+- Use a reference panel image + student avatars as multi-reference inputs
+  (configurable dependency scheme, so independent panels render concurrently)
+- Run an OpenAI vision-based quality check per panel (optional, configurable),
+  after a local pre-filter that rejects obviously bad candidates for free
+- Retry low-scoring panels up to N times with refined prompts
+- Upload final images (Supabase Storage if configured) and create panel rows
+- Update chapter JSON state and return full chapter payload
+"""
+
+import asyncio
+import base64
+import copy
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from database.database import (
+    create_panel,
+    get_chapter,
+    get_classroom,
+    get_panels_by_chapter,
+    get_students_by_classroom,
+    replace_panel,
+    supabase,
+    update_chapter,
+    update_panel_variants,
+)
+from panel_lettering import PANEL_TEXT_RENDERING, art_prompt_instructions, letter_panel
+from panel_prefilter import PANEL_PREFILTER_ENABLED, analyze_image, prefilter_panel
+
+# NEW: quality review helper
+from panel_review import review_panel_batch, review_panel_image_async, review_slot
+from services import bfl_client
+from services.bfl_client import BFL_MODEL_ENDPOINT
+from services.image_store import store_image
+from services.image_variants import schedule_variants
+from services.persistent_cache import PersistentCache, make_key
+from services.review_telemetry import record_reviews, review_row
+from services.timings import ChapterTimings
+
+# ─────────────────────────────────────────────────────────────
+# Environment + client setup
+# ─────────────────────────────────────────────────────────────
+
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "YOUR_OPENAI_API_KEY_HERE")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5.1")
+
+openai_client = OpenAI(api_key=OPENAI_API_KEY)
+
+SUPABASE_IMAGES_BUCKET = os.getenv("SUPABASE_IMAGES_BUCKET")
+
+# NEW: panel review configuration
+PANEL_REVIEW_ENABLED = os.getenv("PANEL_REVIEW_ENABLED", "true").lower() == "true"
+PANEL_REVIEW_MIN_SCORE = float(os.getenv("PANEL_REVIEW_MIN_SCORE", "9.0"))
+PANEL_REVIEW_MAX_ATTEMPTS = int(os.getenv("PANEL_REVIEW_MAX_ATTEMPTS", "3"))
+
+# Concurrent panel generation configuration
+# How panels reference each other for style consistency:
+#   "previous" - each panel references the panel right before it (strictly sequential)
+#   "keyframe" - every panel references one early keyframe panel (the rest render in parallel)
+#   "none"     - no panel-to-panel references (fully parallel)
+PANEL_REFERENCE_MODES = ("previous", "keyframe", "none")
+PANEL_REFERENCE_MODE = os.getenv("PANEL_REFERENCE_MODE", "previous").lower()
+PANEL_KEYFRAME_INDEX = int(os.getenv("PANEL_KEYFRAME_INDEX", "1"))
+PANEL_GENERATION_CONCURRENCY = int(os.getenv("PANEL_GENERATION_CONCURRENCY", "1"))
+# Start rendering the next panel(s) speculatively while the panel they
+# reference is still being reviewed
+PANEL_PIPELINE_ENABLED = os.getenv("PANEL_PIPELINE_ENABLED", "true").lower() == "true"
+# Best-of-N: FLUX candidates generated (and reviewed) in parallel per attempt;
+# the refined prompt is only used when every candidate is below the threshold
+PANEL_CANDIDATES_PER_ATTEMPT = int(os.getenv("PANEL_CANDIDATES_PER_ATTEMPT", "1"))
+# Batched review: reviews requested within PANEL_REVIEW_BATCH_WINDOW seconds
+# (best-of-N candidates, concurrently rendered panels) are graded together on
+# one contact sheet of up to PANEL_REVIEW_BATCH_SIZE images. 1 = one call per image.
+PANEL_REVIEW_BATCH_SIZE = int(os.getenv("PANEL_REVIEW_BATCH_SIZE", "1"))
+PANEL_REVIEW_BATCH_WINDOW = float(os.getenv("PANEL_REVIEW_BATCH_WINDOW", "1.0"))
+# How a panel that failed review is retried:
+#   "regenerate" - render from scratch with the refined prompt
+#   "edit"       - FLUX edit of the best attempt so far, driven by the reviewer's suggested fix
+#   "auto"       - edit when the best attempt scored at least PANEL_EDIT_MIN_SCORE, else regenerate
+PANEL_RETRY_STRATEGIES = ("regenerate", "edit", "auto")
+PANEL_RETRY_STRATEGY = os.getenv("PANEL_RETRY_STRATEGY", "regenerate").lower()
+PANEL_EDIT_MIN_SCORE = float(os.getenv("PANEL_EDIT_MIN_SCORE", "6.0"))
+
+# Persistent script cache: identical classroom context + chosen idea + model +
+# prompt version reuse the stored script instead of calling OpenAI again.
+# Bump SCRIPT_PROMPT_VERSION whenever the script prompt changes.
+# Opt-in; set PERSISTENT_CACHE_PATH to persistent storage when enabling it
+SCRIPT_PROMPT_VERSION = "1"
+SCRIPT_CACHE_ENABLED = os.getenv("SCRIPT_CACHE_ENABLED", "false").lower() == "true"
+if SCRIPT_CACHE_ENABLED and not os.getenv("PERSISTENT_CACHE_PATH"):
+    print("[WARN] SCRIPT_CACHE_ENABLED without PERSISTENT_CACHE_PATH; the script cache lives in the temp dir.")
+SCRIPT_CACHE_MAX_ENTRIES = int(os.getenv("SCRIPT_CACHE_MAX_ENTRIES", "256"))
+script_cache = PersistentCache(
+    "scripts", max_entries=SCRIPT_CACHE_MAX_ENTRIES, enabled=SCRIPT_CACHE_ENABLED
+)
+# Stream the script and start rendering each panel as soon as it is written
+SCRIPT_STREAMING_ENABLED = os.getenv("SCRIPT_STREAMING_ENABLED", "true").lower() == "true"
+
+if PANEL_RETRY_STRATEGY not in PANEL_RETRY_STRATEGIES:
+    print(f"[WARN] Unknown PANEL_RETRY_STRATEGY '{PANEL_RETRY_STRATEGY}'; using 'regenerate'.")
+    PANEL_RETRY_STRATEGY = "regenerate"
+
+# Retry outcomes per strategy since process start (see get_retry_stats)
+_retry_stats: Dict[str, Dict[str, float]] = {
+    strategy: {"renders": 0, "improved": 0, "passed": 0, "render_seconds": 0.0}
+    for strategy in ("regenerate", "edit")
+}
+
+if not OPENAI_API_KEY or OPENAI_API_KEY == "YOUR_OPENAI_API_KEY_HERE":
+    print("[WARN] OPENAI_API_KEY not set; OpenAI calls will fail until you configure it.")
+
+if PANEL_TEXT_RENDERING == "local" and not SUPABASE_IMAGES_BUCKET:
+    print("[WARN] PANEL_TEXT_RENDERING=local needs SUPABASE_IMAGES_BUCKET; without it panels link to the text-free FLUX art.")
+
+if not bfl_client.is_configured():
+    print("[WARN] BFL_API_KEY or BLACK_FOREST_API_KEY not set; FLUX calls will fail until you configure it.")
+
+
+# ─────────────────────────────────────────────────────────────
+# Public entrypoint
+# ─────────────────────────────────────────────────────────────
+
+async def commit_story_choice(
+    chapter_id: str,
+    chosen_idea_id: str,
+    concurrency: Optional[int] = None,
+    reference_mode: Optional[str] = None,
+    use_script_cache: bool = True,
+    deadline_seconds: Optional[float] = None,
+    max_renders: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Complete the chapter pipeline once a story idea has been chosen.
+
+    concurrency caps how many panels are generated at the same time and
+    reference_mode picks which earlier panel each panel uses as its style
+    reference (see PANEL_REFERENCE_MODES). Both default to the env config.
+    use_script_cache=False forces a fresh OpenAI script.
+
+    deadline_seconds (total time from now) and max_renders (FLUX renders) set
+    a chapter budget: every panel is rendered once first, then the remaining
+    budget goes to retries of the weakest panels (see _ChapterBudget).
+
+    Progress is checkpointed into story_script (the script, the FLUX prompts
+    and every accepted panel with its review), so an interrupted run can be
+    continued with resume_chapter_generation.
+
+    Returns:
+      {
+        "chapter_id": ...,
+        "chapter_index": ...,
+        "classroom_id": ...,
+        "episode_title": "...",
+        "learning_objectives": [...],
+        "panels": [
+          {
+            "index": 1,
+            "setting": "...",
+            "description": "...",
+            "narration": "...",
+            "dialogue": [...],
+            "featured_students": [...],
+            "image_url": "https://..."
+          },
+          ...
+        ]
+      }
+    """
+
+    print(f"\n{'='*60}")
+    print("🎬 Starting Comic Generation")
+    print(f"{'='*60}")
+    print(f"Chapter ID: {chapter_id}")
+    print(f"Chosen Idea: {chosen_idea_id}")
+
+    concurrency, reference_mode = _resolve_generation_settings(concurrency, reference_mode)
+    timings = ChapterTimings()
+    budget = _ChapterBudget.create(deadline_seconds, max_renders)
+
+    print("\n📚 Step 1: Fetching chapter data...")
+    chapter = await asyncio.to_thread(get_chapter, chapter_id)
+    if chapter is None:
+        raise ValueError(f"Chapter {chapter_id} not found")
+    print(f"✓ Chapter found: Index {chapter.get('index')}")
+
+    classroom_id: str = chapter["classroom_id"]
+    print("\n🏫 Step 2: Fetching classroom data...")
+    classroom = await asyncio.to_thread(get_classroom, classroom_id)
+    if classroom is None:
+        raise ValueError(f"Classroom {classroom_id} not found")
+    print(f"✓ Classroom: {classroom.get('name')} ({classroom.get('subject')})")
+
+    print("\n👥 Step 3: Fetching students...")
+    students = await asyncio.to_thread(get_students_by_classroom, classroom_id)
+    print(f"✓ Found {len(students)} students")
+
+    # Get story ideas from the dedicated field
+    print("\n💡 Step 4: Loading story ideas...")
+    story_ideas = chapter.get("story_ideas", [])
+    if not story_ideas:
+        raise ValueError(
+            f"No story ideas found for chapter {chapter_id}; "
+            "start_chapter must be called first to generate ideas."
+        )
+    print(f"✓ Found {len(story_ideas)} story ideas")
+
+    teacher_outline = chapter.get("original_prompt", "")
+
+    # Find the chosen idea
+    chosen_idea: Optional[Dict[str, Any]] = next(
+        (idea for idea in story_ideas if idea["id"] == chosen_idea_id),
+        None,
+    )
+    if chosen_idea is None:
+        raise ValueError(f"Chosen idea id {chosen_idea_id} not found for chapter {chapter_id}")
+    print(f"✓ Selected: {chosen_idea.get('title')}")
+
+    # Only touch stored data once the chapter and the chosen idea are known to be valid
+    print("\n🧹 Cleaning up existing panels (if any)...")
+    # Delete any existing panels for this chapter to allow regeneration
+    try:
+        await asyncio.to_thread(
+            lambda: supabase.table("panels").delete().eq("chapter_id", chapter_id).execute()
+        )
+        print("✓ Existing panels cleared")
+    except Exception as e:
+        print(f"⚠️  No existing panels to clear: {e}")
+    # Drop the previous run's script so a resume never mixes it with this run
+    await asyncio.to_thread(
+        update_chapter, chapter_id, {"story_script": None, "chosen_idea_id": chosen_idea_id}
+    )
+
+    # Generate full script + panels via OpenAI
+    print("\n🤖 Step 5: Generating comic script with OpenAI...")
+    print(f"   Model: {OPENAI_MODEL}")
+    cached_script: Optional[Dict[str, Any]] = None
+    if SCRIPT_STREAMING_ENABLED:
+        if use_script_cache:
+            with timings.stage("script"):
+                cached_script = await asyncio.to_thread(
+                    get_cached_script,
+                    classroom=classroom,
+                    students=students,
+                    teacher_outline=teacher_outline,
+                    chosen_idea=chosen_idea,
+                )
+        else:
+            script_cache.record_bypass()
+        if cached_script is None:
+            return await _generate_streamed_chapter(
+                chapter=chapter,
+                classroom=classroom,
+                students=students,
+                teacher_outline=teacher_outline,
+                chosen_idea=chosen_idea,
+                concurrency=concurrency,
+                reference_mode=reference_mode,
+                timings=timings,
+                budget=budget,
+            )
+
+    with timings.stage("script"):
+        script = cached_script or await asyncio.to_thread(
+            generate_full_script_and_panels,
+            classroom=classroom,
+            students=students,
+            teacher_outline=teacher_outline,
+            chosen_idea=chosen_idea,
+            use_cache=use_script_cache,
+        )
+    print(f"✓ Script generated: {script.get('episode_title')}")
+    print(f"✓ Panels to generate: {len(script.get('panels', []))}")
+
+    # Checkpoint 1: the script survives a worker restart
+    script["generation_settings"] = {
+        "concurrency": concurrency,
+        "reference_mode": reference_mode,
+        **_ChapterBudget.settings(budget),
+    }
+    script["timings"] = timings.data
+    await _save_checkpoint(chapter_id, script, chosen_idea_id=chosen_idea_id)
+
+    return await _generate_chapter_panels(
+        chapter=chapter,
+        classroom=classroom,
+        students=students,
+        script=script,
+        concurrency=concurrency,
+        reference_mode=reference_mode,
+        timings=timings,
+        budget=budget,
+    )
+
+
+async def _generate_streamed_chapter(
+    chapter: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    teacher_outline: str,
+    chosen_idea: Dict[str, Any],
+    concurrency: int,
+    reference_mode: str,
+    timings: ChapterTimings,
+    budget: Optional["_ChapterBudget"] = None,
+) -> Dict[str, Any]:
+    """
+    Stream the script from OpenAI and start rendering every panel as soon as
+    its JSON object is complete, instead of waiting for the whole script.
+    """
+    chapter_id: str = chapter["id"]
+    print("   Streaming: panels start rendering as soon as they are written")
+
+    # Checkpoint 1 (partial): grows with every written panel, so a resume
+    # only has to write the rest of the script
+    script: Dict[str, Any] = {
+        "panels": [],
+        "flux_prompts": [],
+        "generation_settings": {
+            "concurrency": concurrency,
+            "reference_mode": reference_mode,
+            **_ChapterBudget.settings(budget),
+        },
+        "script_incomplete": True,
+        "timings": timings.data,
+    }
+    await _save_checkpoint(chapter_id, script, chosen_idea_id=chosen_idea["id"])
+    script_started = time.perf_counter()
+
+    loop = asyncio.get_running_loop()
+    written: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+
+    def on_panel(panel: Dict[str, Any]) -> None:
+        # Called from the worker thread that consumes the OpenAI stream
+        loop.call_soon_threadsafe(written.put_nowait, panel)
+
+    script_task = asyncio.ensure_future(
+        asyncio.to_thread(
+            stream_full_script_and_panels,
+            classroom=classroom,
+            students=students,
+            teacher_outline=teacher_outline,
+            chosen_idea=chosen_idea,
+            on_panel=on_panel,
+        )
+    )
+    script_task.add_done_callback(lambda _: written.put_nowait(None))
+
+    def add_panel(panel: Dict[str, Any]) -> Dict[str, Any]:
+        panel_prompt = build_flux_prompts_from_script(
+            classroom=classroom,
+            students=students,
+            script={"panels": [panel]},
+        )[0]
+        script["panels"].append(panel)
+        script["flux_prompts"].append(panel_prompt)
+        print(f"   ✍️  Panel {panel['index']} written; rendering it now")
+        return panel_prompt
+
+    async def panel_stream() -> AsyncIterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        seen: set = set()
+        while True:
+            panel = await written.get()
+            if panel is None:
+                break
+            if panel["index"] in seen:
+                continue
+            if not seen:
+                timings.add_stage("script_first_panel", time.perf_counter() - script_started)
+            seen.add(panel["index"])
+            yield panel, add_panel(panel)
+            await _save_checkpoint(chapter_id, script)
+
+        # Raises if the script stream failed
+        final_script = await script_task
+        timings.add_stage("script", time.perf_counter() - script_started)
+        for panel in final_script["panels"]:
+            # Panels the incremental parser could not pick up
+            if panel["index"] not in seen:
+                seen.add(panel["index"])
+                yield panel, add_panel(panel)
+
+        for key, value in final_script.items():
+            if key != "panels":
+                script[key] = value
+        script.pop("script_incomplete", None)
+        await _save_checkpoint(chapter_id, script)
+        print(f"✓ Script generated: {script.get('episode_title')}")
+        print(f"✓ Panels to generate: {len(script['panels'])}")
+
+    return await _generate_chapter_panels(
+        chapter=chapter,
+        classroom=classroom,
+        students=students,
+        script=script,
+        concurrency=concurrency,
+        reference_mode=reference_mode,
+        panel_stream=panel_stream(),
+        timings=timings,
+        budget=budget,
+    )
+
+
+async def resume_chapter_generation(
+    chapter_id: str,
+    concurrency: Optional[int] = None,
+    reference_mode: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Continue an interrupted chapter from its last checkpoint.
+
+    Reuses the stored story_script and FLUX prompts, keeps every panel row
+    that already exists plus accepted-but-uncommitted panels, and only renders
+    what is missing. A script whose stream was interrupted keeps the panels
+    already written and OpenAI only writes the rest. Chapters without any
+    stored panel start over through commit_story_choice. Returns the same
+    payload as commit_story_choice.
+    """
+    print(f"\n{'='*60}")
+    print("🔁 Resuming Comic Generation")
+    print(f"{'='*60}")
+    print(f"Chapter ID: {chapter_id}")
+
+    chapter = await asyncio.to_thread(get_chapter, chapter_id)
+    if chapter is None:
+        raise ValueError(f"Chapter {chapter_id} not found")
+
+    script = chapter.get("story_script") or {}
+    settings = script.get("generation_settings") or {}
+    concurrency, reference_mode = _resolve_generation_settings(
+        concurrency or settings.get("concurrency"),
+        reference_mode or settings.get("reference_mode"),
+    )
+
+    if not script.get("panels"):
+        chosen_idea_id = chapter.get("chosen_idea_id")
+        if not chosen_idea_id:
+            raise ValueError(f"Chapter {chapter_id} has no stored script or chosen idea to resume from")
+        print("⚠️  No stored script; starting over from the chosen idea")
+        return await commit_story_choice(
+            chapter_id,
+            chosen_idea_id,
+            concurrency,
+            reference_mode,
+            deadline_seconds=settings.get("deadline_seconds"),
+            max_renders=settings.get("max_renders"),
+        )
+
+    classroom = await asyncio.to_thread(get_classroom, chapter["classroom_id"])
+    if classroom is None:
+        raise ValueError(f"Classroom {chapter['classroom_id']} not found")
+    students = await asyncio.to_thread(get_students_by_classroom, chapter["classroom_id"])
+
+    # Panel rows that were already committed are kept as they are
+    rows = await asyncio.to_thread(get_panels_by_chapter, chapter_id)
+    committed = {int(row["index"]): row for row in rows}
+    print(f"✓ Found stored script '{script.get('episode_title')}' with {len(committed)} committed panels")
+
+    # Keep adding to the interrupted run's timings
+    timings = ChapterTimings(script.setdefault("timings", {}))
+    timings.data["resumes"] = timings.data.get("resumes", 0) + 1
+
+    if script.get("script_incomplete"):
+        await _complete_partial_script(chapter, classroom, students, script, timings)
+
+    # The budget starts over from the resume
+    budget = _ChapterBudget.create(settings.get("deadline_seconds"), settings.get("max_renders"))
+
+    return await _generate_chapter_panels(
+        chapter=chapter,
+        classroom=classroom,
+        students=students,
+        script=script,
+        concurrency=concurrency,
+        reference_mode=reference_mode,
+        committed=committed,
+        timings=timings,
+        budget=budget,
+    )
+
+
+async def _complete_partial_script(
+    chapter: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    script: Dict[str, Any],
+    timings: ChapterTimings,
+) -> None:
+    """
+    Finish (in place) a script whose stream was interrupted. The panels that
+    were already written, and maybe rendered, are kept as they are and OpenAI
+    only writes the panels after them.
+    """
+    chapter_id: str = chapter["id"]
+    chosen_idea: Optional[Dict[str, Any]] = next(
+        (idea for idea in chapter.get("story_ideas") or [] if idea["id"] == chapter.get("chosen_idea_id")),
+        None,
+    )
+    if chosen_idea is None:
+        raise ValueError(f"Chapter {chapter_id} has no chosen idea to finish its script from")
+
+    print(f"⚠️  Script was interrupted after {len(script['panels'])} panels; writing the rest")
+    with timings.stage("script"):
+        full_script = await asyncio.to_thread(
+            generate_full_script_and_panels,
+            classroom=classroom,
+            students=students,
+            teacher_outline=chapter.get("original_prompt", ""),
+            chosen_idea=chosen_idea,
+            written_panels=script["panels"],
+        )
+    script.update(full_script)
+    script.pop("script_incomplete", None)
+    # Rebuilt for every panel by _generate_chapter_panels
+    script.pop("flux_prompts", None)
+    await _save_checkpoint(chapter_id, script)
+    print(f"✓ Script completed: {script.get('episode_title')} ({len(script['panels'])} panels)")
+
+
+async def regenerate_panels(
+    chapter_id: str,
+    panel_indices: List[int],
+    correction_prompt: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Re-render only some panels of a finished chapter.
+
+    Reuses the story_script stored on the chapter (no new OpenAI script call),
+    rebuilds the FLUX prompts of the requested panels only (appending the
+    teacher's optional correction prompt) and replaces just those panel rows.
+    Untouched panels keep their images and still serve as references.
+
+    Returns:
+      {"chapter_id": ..., "panels": [{"index": 3, "image_url": "https://..."}, ...]}
+    """
+    print(f"\n{'='*60}")
+    print("🛠️  Regenerating Panels")
+    print(f"{'='*60}")
+    print(f"Chapter ID: {chapter_id}")
+    print(f"Panels: {panel_indices}")
+
+    chapter = await asyncio.to_thread(get_chapter, chapter_id)
+    if chapter is None:
+        raise ValueError(f"Chapter {chapter_id} not found")
+
+    try:
+        script = chapter.get("story_script") or {}
+        if not script.get("panels") or script.get("script_incomplete"):
+            raise ValueError(f"Chapter {chapter_id} has no stored script; commit the chapter first")
+
+        targets = sorted({int(idx) for idx in panel_indices})
+        known = {int(p["index"]) for p in script["panels"]}
+        unknown = [idx for idx in targets if idx not in known]
+        if not targets or unknown:
+            raise ValueError(f"Unknown panel indices for chapter {chapter_id}: {unknown or panel_indices}")
+
+        classroom = await asyncio.to_thread(get_classroom, chapter["classroom_id"])
+        if classroom is None:
+            raise ValueError(f"Classroom {chapter['classroom_id']} not found")
+        students = await asyncio.to_thread(get_students_by_classroom, chapter["classroom_id"])
+    except Exception:
+        # Nothing was changed yet; don't leave the chapter stuck in "regenerating"
+        if chapter.get("status") == "regenerating":
+            await asyncio.to_thread(update_chapter, chapter_id, {"status": "ready"})
+        raise
+
+    settings = script.get("generation_settings") or {}
+    concurrency, reference_mode = _resolve_generation_settings(
+        settings.get("concurrency"), settings.get("reference_mode")
+    )
+
+    # Record the request so an interrupted regeneration can be picked up again
+    script["pending_regeneration"] = {
+        "panel_indices": targets,
+        "correction_prompt": correction_prompt,
+    }
+    await _save_checkpoint(chapter_id, script)
+
+    # Every other panel keeps its current image (used only as a reference);
+    # panels without a row yet are rendered along with the requested ones
+    rows = await asyncio.to_thread(get_panels_by_chapter, chapter_id)
+    existing = {int(row["index"]): row for row in rows}
+    missing = sorted(known - set(existing) - set(targets))
+    if missing:
+        print(f"   Also rendering panels with no image yet: {missing}")
+        targets = sorted(set(targets) | set(missing))
+
+    # Rebuild prompts only for the panels being rendered
+    target_prompts = build_flux_prompts_from_script(
+        classroom=classroom,
+        students=students,
+        script={**script, "panels": [p for p in script["panels"] if int(p["index"]) in targets]},
+    )
+    correction = (correction_prompt or "").strip()
+    if correction:
+        for panel_prompt in target_prompts:
+            panel_prompt["prompt"] += f"\n\nTEACHER CORRECTIONS: {correction}"
+
+    completed = {
+        idx: {"image_url": row["image"], "art_url": row.get("art_image")}
+        for idx, row in existing.items()
+        if idx not in targets
+    }
+    stored_prompts = {int(p["index"]): p for p in script.get("flux_prompts") or []}
+    for panel_prompt in target_prompts:
+        stored_prompts[panel_prompt["index"]] = panel_prompt
+    flux_prompts = [
+        stored_prompts.get(idx, {"index": idx, "prompt": "", "aspect_ratio": "3:2"})
+        for idx in sorted(known)
+    ]
+
+    panel_quality = script.setdefault("panel_quality", {})
+    timings = ChapterTimings()
+
+    async def record_review(result: Dict[str, Any]) -> None:
+        if result["review"] is not None:
+            panel_quality[str(result["index"])] = result["review"]
+
+    try:
+        panel_index_to_url, _ = await generate_panel_images(
+            chapter_id=chapter_id,
+            classroom=classroom,
+            students=students,
+            script=script,
+            flux_prompts=flux_prompts,
+            concurrency=concurrency,
+            reference_mode=reference_mode,
+            completed=completed,
+            committed_indices=set(completed),
+            on_accepted=record_review,
+            commit_panel=replace_panel,
+            timings=timings,
+        )
+    except Exception:
+        # The chapter is still readable: panels not replaced keep their old image
+        script.pop("pending_regeneration", None)
+        await asyncio.to_thread(update_chapter, chapter_id, {"story_script": script, "status": "ready"})
+        raise
+
+    script["flux_prompts"] = flux_prompts
+    script.pop("pending_regeneration", None)
+    script["regeneration_timings"] = timings.finish()
+    await asyncio.to_thread(update_chapter, chapter_id, {"story_script": script, "status": "ready"})
+    print(f"✓ Regenerated {len(targets)} panels")
+
+    return {
+        "chapter_id": chapter_id,
+        "panels": [
+            {"index": idx, "image_url": panel_index_to_url.get(idx)}
+            for idx in targets
+        ],
+    }
+
+
+async def reletter_panels(
+    chapter_id: str,
+    panel_indices: Optional[List[int]] = None,
+    text_updates: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Redraw the speech bubbles of locally lettered panels on their stored
+    text-free art, without any FLUX render.
+
+    text_updates ({"index", "narration"?, "dialogue"?}) are written into the
+    chapter's story_script first. Panels relettered are panel_indices plus the
+    updated ones (every panel if neither is given); panels rendered without
+    local lettering have no stored art and are skipped.
+
+    Returns:
+      {"chapter_id": ..., "panels": [{"index": 3, "image_url": "https://..."}, ...],
+       "skipped": [indices without stored art]}
+    """
+    if not SUPABASE_IMAGES_BUCKET:
+        raise ValueError("Relettering panels needs SUPABASE_IMAGES_BUCKET")
+
+    chapter = await asyncio.to_thread(get_chapter, chapter_id)
+    if chapter is None:
+        raise ValueError(f"Chapter {chapter_id} not found")
+    script = chapter.get("story_script") or {}
+    if not script.get("panels") or script.get("script_incomplete"):
+        raise ValueError(f"Chapter {chapter_id} has no stored script; commit the chapter first")
+
+    panels = {int(p["index"]): p for p in script["panels"]}
+    updates = text_updates or []
+    requested = {int(u["index"]) for u in updates} | set(panel_indices or [])
+    unknown = sorted(idx for idx in requested if idx not in panels)
+    if unknown:
+        raise ValueError(f"Unknown panel indices for chapter {chapter_id}: {unknown}")
+
+    for update in updates:
+        panel = panels[int(update["index"])]
+        if update.get("narration") is not None:
+            panel["narration"] = update["narration"]
+        if update.get("dialogue") is not None:
+            panel["dialogue"] = update["dialogue"]
+    if updates:
+        await asyncio.to_thread(update_chapter, chapter_id, {"story_script": script})
+
+    targets = sorted(requested) or sorted(panels)
+    rows = {int(row["index"]): row for row in await asyncio.to_thread(get_panels_by_chapter, chapter_id)}
+    skipped = [idx for idx in targets if not (rows.get(idx) or {}).get("art_image")]
+    print(f"🔤 Relettering panels {[idx for idx in targets if idx not in skipped]} of chapter {chapter_id}")
+
+    async def reletter(idx: int) -> Dict[str, Any]:
+        row = rows[idx]
+        art = await bfl_client.download(row["art_image"])
+        image_bytes = await asyncio.to_thread(letter_panel, art, panels[idx])
+        image_url = await asyncio.to_thread(
+            upload_image_and_get_url,
+            img_bytes=image_bytes,
+            chapter_id=chapter_id,
+            panel_index=idx,
+            fallback_url=row["image"],
+        )
+        await asyncio.to_thread(
+            replace_panel,
+            chapter_id=chapter_id,
+            index=idx,
+            image=image_url,
+            art_image=row["art_image"],
+        )
+        _schedule_panel_variants(chapter_id, idx, {"image_url": image_url, "image_bytes": image_bytes})
+        return {"index": idx, "image_url": image_url}
+
+    relettered = await asyncio.gather(
+        *(reletter(idx) for idx in targets if idx not in skipped)
+    )
+    if skipped:
+        print(f"   Skipped panels without stored art: {skipped}")
+
+    return {"chapter_id": chapter_id, "panels": list(relettered), "skipped": skipped}
+
+
+def _resolve_generation_settings(
+    concurrency: Optional[int],
+    reference_mode: Optional[str],
+) -> Tuple[int, str]:
+    """Apply env defaults and validate the panel generation settings."""
+    concurrency = max(1, concurrency or PANEL_GENERATION_CONCURRENCY)
+    reference_mode = (reference_mode or PANEL_REFERENCE_MODE).lower()
+    if reference_mode not in PANEL_REFERENCE_MODES:
+        raise ValueError(
+            f"Unknown panel reference mode '{reference_mode}'; "
+            f"expected one of {', '.join(PANEL_REFERENCE_MODES)}"
+        )
+    return concurrency, reference_mode
+
+
+async def _save_checkpoint(
+    chapter_id: str,
+    script: Dict[str, Any],
+    **updates: Any,
+) -> None:
+    """
+    Persist the in-progress story_script (and any extra chapter fields) from
+    a worker thread. The script is snapshotted first, since other panels keep
+    updating it while the write is in flight.
+    """
+    started = time.perf_counter()
+    snapshot = copy.deepcopy(script)
+    await asyncio.to_thread(update_chapter, chapter_id, {"story_script": snapshot, **updates})
+    if "timings" in script:
+        ChapterTimings(script["timings"]).add_stage("checkpoints", time.perf_counter() - started)
+
+
+def _stored_accepted_panels(script: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+    """Accepted panels checkpointed in story_script (JSON keys come back as strings)."""
+    return {
+        int(idx): result
+        for idx, result in (script.get("accepted_panels") or {}).items()
+    }
+
+
+async def _generate_chapter_panels(
+    chapter: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    script: Dict[str, Any],
+    concurrency: int,
+    reference_mode: str,
+    committed: Optional[Dict[int, Dict[str, Any]]] = None,
+    panel_stream: Optional[AsyncIterator[Tuple[Dict[str, Any], Dict[str, Any]]]] = None,
+    timings: Optional[ChapterTimings] = None,
+    budget: Optional["_ChapterBudget"] = None,
+) -> Dict[str, Any]:
+    """
+    Shared tail of commit / resume: build (or reuse) FLUX prompts, render the
+    panels that are still missing with per-panel checkpoints, then mark the
+    chapter ready and build the frontend payload.
+
+    With panel_stream, panels (and their prompts) arrive while the script is
+    still being written and are rendered as they come in.
+    """
+    chapter_id: str = chapter["id"]
+    classroom_id: str = chapter["classroom_id"]
+    committed = committed or {}
+    timings = timings or ChapterTimings(script.setdefault("timings", {}))
+
+    # Build FLUX prompts
+    print("\n📝 Step 6: Building FLUX prompts...")
+    flux_prompts = script.get("flux_prompts")
+    if panel_stream is not None:
+        # Built one panel at a time as the script streams in
+        flux_prompts = []
+        print("✓ Prompts are built as panels are written")
+    elif flux_prompts:
+        print(f"✓ Reusing {len(flux_prompts)} checkpointed prompts")
+    else:
+        with timings.stage("prompts"):
+            flux_prompts = build_flux_prompts_from_script(
+                classroom=classroom,
+                students=students,
+                script=script,
+            )
+        # Checkpoint 2: the prompts
+        script["flux_prompts"] = flux_prompts
+        await _save_checkpoint(chapter_id, script)
+        print(f"✓ Built {len(flux_prompts)} prompts")
+
+    # Panels that are already done: committed rows + accepted (not yet committed) ones
+    completed = _stored_accepted_panels(script)
+    for idx, row in committed.items():
+        completed[idx] = {
+            **completed.get(idx, {}),
+            "image_url": row["image"],
+            "art_url": row.get("art_image"),
+        }
+    panel_quality = script.setdefault("panel_quality", {})
+
+    async def checkpoint_panel(result: Dict[str, Any]) -> None:
+        # Checkpoint 3: each accepted panel with its review
+        idx = result["index"]
+        script.setdefault("accepted_panels", {})[str(idx)] = {
+            "image_url": result["image_url"],
+            "art_url": result.get("art_url"),
+            "score": result["score"],
+        }
+        if result["review"] is not None:
+            panel_quality[str(idx)] = result["review"]
+        await _save_checkpoint(chapter_id, script)
+
+    # Generate images and create panel rows
+    print("\n🎨 Step 7: Generating images with FLUX...")
+    print(f"   Endpoint: {BFL_MODEL_ENDPOINT}")
+    print(f"   Reference mode: {reference_mode} | Concurrency: {concurrency}")
+    if budget is not None:
+        print(f"   Budget: {budget.describe()}")
+    if completed:
+        print(f"   Resuming: {len(completed)} panels already done")
+    print("   This may take 1-2 minutes per panel...\n")
+
+    with timings.stage("images"):
+        panel_index_to_url, _ = await generate_panel_images(
+            chapter_id=chapter_id,
+            classroom=classroom,
+            students=students,
+            script=script,
+            flux_prompts=flux_prompts,
+            concurrency=concurrency,
+            reference_mode=reference_mode,
+            completed=completed,
+            committed_indices=set(committed),
+            on_accepted=checkpoint_panel,
+            panel_stream=panel_stream,
+            timings=timings,
+            budget=budget,
+        )
+
+    # Update chapter with story script and status
+    print("\n💾 Step 8: Saving chapter data...")
+    # panel_quality stays in the script for later inspection; the accepted
+    # panels checkpoint is redundant once every panel row exists
+    script.pop("accepted_panels", None)
+    if not panel_quality:
+        script.pop("panel_quality", None)
+    if budget is not None:
+        timings.data["budget"] = budget.report()
+    stages = timings.finish()["stages"]
+    print("⏱️  Timings: " + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in stages.items()))
+
+    await asyncio.to_thread(
+        update_chapter,
+        chapter_id,
+        {
+            "story_script": script,
+            "status": "ready",
+        },
+    )
+    print("✓ Chapter updated to 'ready' status")
+
+    # Build structured payload for frontend
+    print("\n📦 Step 9: Building response payload...")
+    panels_output: List[Dict[str, Any]] = []
+    for panel in script["panels"]:
+        idx = panel["index"]
+        panels_output.append(
+            {
+                "index": idx,
+                "setting": panel["setting"],
+                "description": panel["description"],
+                "narration": panel["narration"],
+                "dialogue": panel["dialogue"],
+                "featured_students": panel["featured_students"],
+                "image_url": panel_index_to_url.get(idx),
+            }
+        )
+
+    result = {
+        "chapter_id": chapter_id,
+        "chapter_index": chapter["index"],
+        "classroom_id": classroom_id,
+        "episode_title": script["episode_title"],
+        "learning_objectives": script.get("learning_objectives", []),
+        "panels": panels_output,
+    }
+
+    print(f"\n{'='*60}")
+    print("✅ Comic Generation Complete!")
+    print(f"{'='*60}")
+    print(f"Episode: {script['episode_title']}")
+    print(f"Panels: {len(panels_output)}")
+    print(f"{'='*60}\n")
+
+    return result
+
+
+# ─────────────────────────────────────────────────────────────
+# Panel generation engine
+# ─────────────────────────────────────────────────────────────
+
+def _reference_dependencies(
+    indices: List[int],
+    reference_mode: str,
+    keyframe_index: int = PANEL_KEYFRAME_INDEX,
+) -> Dict[int, Optional[int]]:
+    """
+    Map each panel index to the panel whose image it uses as style reference
+    (or None). Panels whose dependency is already done can render in parallel.
+    """
+    ordered = sorted(indices)
+    if not ordered:
+        return {}
+
+    if reference_mode == "previous":
+        return {
+            idx: (ordered[pos - 1] if pos > 0 else None)
+            for pos, idx in enumerate(ordered)
+        }
+
+    if reference_mode == "keyframe":
+        keyframe = keyframe_index if keyframe_index in ordered else ordered[0]
+        return {idx: (None if idx == keyframe else keyframe) for idx in ordered}
+
+    return {idx: None for idx in ordered}
+
+
+def _streamed_dependency(
+    idx: int,
+    arrived: List[int],
+    reference_mode: str,
+    keyframe_index: int = PANEL_KEYFRAME_INDEX,
+) -> Optional[int]:
+    """
+    Reference panel of a panel that arrives while the script is still streaming,
+    given the indices that arrived before it (same rules as
+    _reference_dependencies, without knowing the later panels).
+    """
+    if reference_mode == "previous":
+        earlier = [i for i in arrived if i < idx]
+        return max(earlier) if earlier else None
+
+    if reference_mode == "keyframe":
+        first = arrived[0] if arrived else idx
+        # Panels arrive in index order: a keyframe before the first panel never comes
+        keyframe = keyframe_index if first <= keyframe_index else first
+        return None if idx == keyframe else keyframe
+
+    return None
+
+
+def _panel_avatar_urls(
+    panel: Dict[str, Any],
+    students_by_name: Dict[str, Dict[str, Any]],
+) -> List[str]:
+    """Avatar URLs of every student featured in or speaking in this panel."""
+    featured_students = panel.get("featured_students") or []
+    dialogue = panel.get("dialogue") or []
+
+    # Collect names mentioned in this panel (featured + speakers)
+    mentioned_names: set[str] = set()
+    for name in featured_students:
+        if isinstance(name, str):
+            mentioned_names.add(name.strip())
+    for line in dialogue:
+        speaker = line.get("speaker")
+        if isinstance(speaker, str):
+            mentioned_names.add(speaker.strip())
+
+    # Resolve avatars from DB for mentioned students
+    avatar_urls: List[str] = []
+    for name in mentioned_names:
+        student = students_by_name.get(name.lower())
+        if student:
+            avatar = student.get("avatar_url")
+            if avatar:
+                avatar_urls.append(avatar)
+
+    return avatar_urls
+
+
+def _build_reference_images(
+    reference_panel_url: Optional[str],
+    avatar_urls: List[str],
+) -> List[str]:
+    """
+    Build reference images list:
+     - reference panel image (if any) first, to keep style across panels
+     - then all unique student avatars for this panel
+    """
+    reference_images: List[str] = []
+    if reference_panel_url:
+        reference_images.append(reference_panel_url)
+
+    for url in avatar_urls:
+        if url not in reference_images:
+            reference_images.append(url)
+
+    # FLUX.2 [pro] supports up to 8 reference images via input_image..input_image_8
+    return reference_images[:8]
+
+
+def _refine_prompt_from_review(
+    base_prompt: str,
+    review: Optional[Dict[str, Any]],
+    attempt: int,
+    featured_students: List[str],
+) -> str:
+    """
+    Build the prompt for the next attempt from the reviewer's feedback on
+    `attempt`, escalating strictness on subsequent attempts.
+    """
+    # Build aggressive, targeted fix prompt
+    fix_parts = []
+
+    # Get the suggested fix from the review
+    if review:
+        suggested_fix = (review.get("suggested_fix_prompt") or "").strip()
+        if suggested_fix:
+            fix_parts.append(suggested_fix)
+
+        # Extract specific issues and create targeted fixes
+        issues = review.get("issues") or []
+        dimensions = review.get("dimensions") or {}
+
+        # If text accuracy is low, be VERY strict about spelling
+        text_accuracy = dimensions.get("text_accuracy", 0.0)
+        if text_accuracy < 7.0 and issues:
+            fix_parts.append(
+                "CRITICAL: Text must be spelled EXACTLY correctly with no errors. "
+                "Double-check every word for spelling mistakes."
+            )
+
+        # If character accuracy is low, emphasize character presence
+        char_accuracy = dimensions.get("character_accuracy", 0.0)
+        if char_accuracy < 7.0:
+            fix_parts.append(
+                f"REQUIRED: All characters must be clearly visible: {', '.join(featured_students)}. "
+                "Each character must be distinct and recognizable."
+            )
+
+        # Add specific issue-based fixes
+        for issue in issues:
+            issue_lower = issue.lower()
+
+            # Spelling/text issues
+            if any(word in issue_lower for word in ["spell", "misspell", "wrong text", "incorrect text"]):
+                fix_parts.append(
+                    f"FIX IMMEDIATELY: {issue}. "
+                    "Verify spelling character-by-character before rendering."
+                )
+
+            # Missing elements
+            elif "missing" in issue_lower:
+                fix_parts.append(
+                    f"MUST ADD: {issue}. "
+                    "This element is required and cannot be omitted."
+                )
+
+            # Bubble/dialogue issues
+            elif any(word in issue_lower for word in ["bubble", "dialogue", "speech"]):
+                fix_parts.append(
+                    f"DIALOGUE FIX: {issue}. "
+                    "Ensure bubble tails point to the correct speaker."
+                )
+
+    # Escalate strictness on subsequent attempts
+    if attempt == 2:
+        fix_parts.insert(0,
+            "SECOND ATTEMPT - BE MORE CAREFUL: The previous image had errors. "
+            "Pay extra attention to the following corrections:"
+        )
+    elif attempt >= 3:
+        fix_parts.insert(0,
+            "FINAL ATTEMPT - MAXIMUM PRECISION REQUIRED: Multiple attempts have failed. "
+            "This is the last chance. Follow these corrections EXACTLY:"
+        )
+
+    if not fix_parts:
+        print("      → No specific fixes available; retrying with same prompt")
+        return base_prompt
+
+    # Join all fix parts with clear separation
+    comprehensive_fix = " ".join(fix_parts)
+    print("      → Applying targeted fixes:")
+    for i, part in enumerate(fix_parts, 1):
+        print(f"         {i}. {part[:80]}...")
+
+    # Append to base prompt with emphasis
+    return base_prompt + "\n\nCRITICAL CORRECTIONS: " + comprehensive_fix
+
+
+def _choose_retry_strategy(review: Optional[Dict[str, Any]], score: float) -> str:
+    """
+    Pick how to retry a panel whose best attempt so far got `review`.
+
+    Editing needs a concrete suggested fix to apply; frames rejected by the
+    local pre-filter (blank, no bubbles) are always regenerated.
+    """
+    if PANEL_RETRY_STRATEGY == "regenerate" or not review or review.get("prefilter"):
+        return "regenerate"
+    if not (review.get("suggested_fix_prompt") or "").strip():
+        return "regenerate"
+    if PANEL_RETRY_STRATEGY == "auto" and score < PANEL_EDIT_MIN_SCORE:
+        return "regenerate"
+    return "edit"
+
+
+def _edit_prompt_from_review(review: Dict[str, Any], panel: Dict[str, Any]) -> str:
+    """
+    Instruction for a FLUX edit of the previous attempt: apply only the
+    reviewer's fix and keep everything else as it is.
+    """
+    parts = [
+        "Edit this comic panel. Keep the composition, characters, poses, art style, "
+        "colors and all correct text exactly as they are.",
+        f"Only change the following: {review['suggested_fix_prompt'].strip()}",
+    ]
+    issues = review.get("issues") or []
+    if issues:
+        parts.append("Problems to fix: " + "; ".join(issues))
+    if PANEL_TEXT_RENDERING == "local":
+        # The edited image is the text-free art; lettering is redrawn afterwards
+        parts.append(art_prompt_instructions(panel))
+    else:
+        panel_text = _panel_text_for_prompt(panel)
+        if panel_text:
+            parts.append(f"The text in the panel must read exactly: {panel_text}")
+    print(f"      → Editing the best attempt: {review['suggested_fix_prompt'].strip()[:80]}...")
+    return "\n".join(parts)
+
+
+def get_retry_stats() -> Dict[str, Any]:
+    """
+    Retry renders per strategy since process start: how often the retry beat
+    the panel's best attempt so far, how often it passed review, and the
+    average FLUX time (queue + render + download) per render.
+    """
+    strategies = {}
+    for strategy, stats in _retry_stats.items():
+        renders = stats["renders"]
+        strategies[strategy] = {
+            "renders": int(renders),
+            "improved": int(stats["improved"]),
+            "passed": int(stats["passed"]),
+            "improved_rate": round(stats["improved"] / renders, 3) if renders else None,
+            "pass_rate": round(stats["passed"] / renders, 3) if renders else None,
+            "avg_render_seconds": round(stats["render_seconds"] / renders, 3) if renders else None,
+        }
+    return {"strategy": PANEL_RETRY_STRATEGY, "edit_min_score": PANEL_EDIT_MIN_SCORE, **strategies}
+
+
+class _SpeculativeRender:
+    """
+    Speculative first FLUX attempt for one panel, started against a candidate
+    image of the panel it references while that candidate is still under review.
+
+    The attempt is only used if the candidate ends up being the accepted image;
+    a newer candidate or a rejected one cancels it. The candidate is sent
+    inline (nothing is stored before it is accepted), as the same image the
+    accepted panel will be stored as. Speculative renders have their own
+    semaphore, so they overlap the reviews that hold the panel slots.
+    """
+
+    def __init__(
+        self,
+        panel_prompt: Dict[str, Any],
+        avatar_urls: List[str],
+        semaphore: asyncio.Semaphore,
+    ):
+        self.panel_prompt = panel_prompt
+        self.avatar_urls = avatar_urls
+        self.semaphore = semaphore
+        # Source URL of the candidate this attempt is built on
+        self.reference_url: Optional[str] = None
+        self.task: Optional["asyncio.Task[Tuple[bytes, str]]"] = None
+        # Stage timings of the current speculative attempt
+        self.timings: Dict[str, Any] = {}
+
+    def speculate(self, reference_url: Optional[str], reference_bytes: Optional[bytes] = None) -> None:
+        """
+        Re-reference the speculative attempt (None just cancels it).
+
+        Args:
+            reference_url: Source URL of the candidate under review
+            reference_bytes: Its panel image (lettered, as it would be stored)
+        """
+        self.cancel()
+        if reference_url is None or reference_bytes is None:
+            return
+        print(f"      ⏩ [panel {self.panel_prompt['index']}] Speculatively generating while reference is reviewed")
+        self.reference_url = reference_url
+        self.timings = {}
+        self.task = asyncio.create_task(self._render(reference_url, reference_bytes, self.timings))
+
+    async def _render(
+        self, source_url: str, image_bytes: bytes, timings: Dict[str, Any]
+    ) -> Tuple[bytes, str]:
+        # Without a bucket, upload_image_and_get_url keeps the FLUX URL, so the
+        # non-speculative path references source_url
+        if SUPABASE_IMAGES_BUCKET:
+            reference = base64.b64encode(image_bytes).decode("ascii")
+        else:
+            reference = source_url
+        async with self.semaphore:
+            return await call_flux_and_download(
+                self.panel_prompt["prompt"],
+                aspect_ratio=self.panel_prompt["aspect_ratio"],
+                reference_images=_build_reference_images(reference, self.avatar_urls),
+                timings=timings,
+            )
+
+    def claim(self, accepted_url: Optional[str]) -> Optional["asyncio.Task[Tuple[bytes, str]]"]:
+        """
+        Hand over the attempt if it was built on the accepted candidate (by
+        source URL), else cancel it.
+        """
+        task = self.task
+        if task is not None and accepted_url is not None and accepted_url == self.reference_url:
+            self.task = None
+            self.reference_url = None
+            return task
+        self.cancel()
+        return None
+
+    def cancel(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+        self.reference_url = None
+
+
+class _ChapterBudget:
+    """
+    Time and render budget of one chapter generation.
+
+    deadline_seconds counts from the start of the request, max_renders counts
+    FLUX renders. With a budget, every panel is first rendered once (so the
+    chapter is always complete); the scheduler in generate_panel_images then
+    spends what is left on retries, one attempt per panel per round: panels
+    below PANEL_REVIEW_MIN_SCORE first (weakest first), then the weakest of
+    the passing ones. An attempt is only started if it fits the render budget
+    and the average attempt so far still fits before the deadline.
+    """
+
+    def __init__(self, deadline_seconds: Optional[float], max_renders: Optional[int]):
+        self.deadline_seconds = deadline_seconds
+        self.max_renders = max_renders
+        self.started = time.perf_counter()
+        self.renders = 0
+        self.attempt_seconds: List[float] = []
+        self.retries = 0
+
+    @classmethod
+    def create(
+        cls,
+        deadline_seconds: Optional[float],
+        max_renders: Optional[int],
+    ) -> Optional["_ChapterBudget"]:
+        """A budget, or None when neither limit is set (unbudgeted retries)."""
+        if deadline_seconds is None and max_renders is None:
+            return None
+        return cls(deadline_seconds, max_renders)
+
+    @staticmethod
+    def settings(budget: Optional["_ChapterBudget"]) -> Dict[str, Any]:
+        """generation_settings entries, so a resume keeps the same limits."""
+        if budget is None:
+            return {}
+        return {"deadline_seconds": budget.deadline_seconds, "max_renders": budget.max_renders}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def add_attempt(self, renders: int, seconds: float) -> None:
+        self.renders += renders
+        self.attempt_seconds.append(seconds)
+
+    def can_afford(self, renders: int) -> bool:
+        """Whether one more round of attempts using `renders` renders fits."""
+        if self.max_renders is not None and self.renders + renders > self.max_renders:
+            return False
+        if self.deadline_seconds is not None:
+            expected = (
+                sum(self.attempt_seconds) / len(self.attempt_seconds)
+                if self.attempt_seconds
+                else 0.0
+            )
+            if self.elapsed() + expected > self.deadline_seconds:
+                return False
+        return True
+
+    def describe(self) -> str:
+        parts = []
+        if self.deadline_seconds is not None:
+            parts.append(f"deadline {self.deadline_seconds:.0f}s")
+        if self.max_renders is not None:
+            parts.append(f"max {self.max_renders} renders")
+        return ", ".join(parts)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            **_ChapterBudget.settings(self),
+            "renders": self.renders,
+            "retries": self.retries,
+            "elapsed": round(self.elapsed(), 2),
+        }
+
+
+class _ReviewBatcher:
+    """
+    Collects panel reviews requested within a short window and grades them
+    together with review_panel_batch (one contact sheet per batch).
+    """
+
+    def __init__(
+        self,
+        classroom: Dict[str, Any],
+        students: List[Dict[str, Any]],
+        max_size: int = PANEL_REVIEW_BATCH_SIZE,
+        window: float = PANEL_REVIEW_BATCH_WINDOW,
+    ):
+        self.classroom = classroom
+        self.students = students
+        self.max_size = max_size
+        self.window = window
+        self._pending: List[Tuple[Dict[str, Any], "asyncio.Future[Dict[str, Any]]"]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+
+    async def review(self, panel: Dict[str, Any], image_bytes: bytes, image_url: str) -> Dict[str, Any]:
+        """Queue one image for review and wait for its batch to be graded."""
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[Dict[str, Any]]" = loop.create_future()
+        self._pending.append(({"panel": panel, "image_bytes": image_bytes, "image_url": image_url}, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Dict[str, Any], "asyncio.Future[Dict[str, Any]]"]]) -> None:
+        try:
+            # One slot per batch: its sheet requests run one after another
+            async with review_slot():
+                reviews = await asyncio.to_thread(
+                    review_panel_batch,
+                    [item for item, _ in batch],
+                    classroom=self.classroom,
+                    students=self.students,
+                    min_score=PANEL_REVIEW_MIN_SCORE,
+                )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), review in zip(batch, reviews):
+            if not future.done():
+                future.set_result(review)
+
+
+async def _generate_attempt(
+    prompt: str,
+    aspect_ratio: str,
+    reference_images: List[str],
+    speculative: Optional["asyncio.Task[Tuple[bytes, str]]"] = None,
+    timings: Optional[Dict[str, Any]] = None,
+    speculative_timings: Optional[Dict[str, Any]] = None,
+    edit_image: Optional[str] = None,
+) -> Tuple[bytes, str]:
+    """
+    Use a claimed speculative render if it succeeded, else call FLUX now
+    (as an edit of edit_image, if given).
+
+    Stage timings go into `timings` (copied from speculative_timings when the
+    speculative render is used).
+    """
+    if speculative is not None:
+        try:
+            result = await speculative
+            if timings is not None:
+                timings.update(speculative_timings or {})
+                timings["speculative"] = True
+            return result
+        except Exception as e:
+            print(f"      ⚠️  Speculative render failed ({e}); generating again")
+
+    return await call_flux_and_download(
+        prompt,
+        aspect_ratio=aspect_ratio,
+        reference_images=reference_images,
+        timings=timings,
+        edit_image=edit_image,
+    )
+
+
+async def _letter_attempt(
+    image_bytes: bytes,
+    panel: Dict[str, Any],
+    timings: Optional[Dict[str, Any]] = None,
+) -> Tuple[bytes, Optional[bytes]]:
+    """
+    With PANEL_TEXT_RENDERING=local, draw the panel's bubbles onto the
+    text-free FLUX art.
+
+    Returns:
+      (panel image bytes, text-free art bytes or None when FLUX letters the panel)
+    """
+    if PANEL_TEXT_RENDERING != "local":
+        return image_bytes, None
+    started = time.perf_counter()
+    lettered = await asyncio.to_thread(letter_panel, image_bytes, panel)
+    if timings is not None:
+        timings["lettering"] = time.perf_counter() - started
+    return lettered, image_bytes
+
+
+async def _upload_panel(
+    chapter_id: str,
+    idx: int,
+    image_bytes: bytes,
+    source_url: str,
+    art_bytes: Optional[bytes],
+) -> Tuple[str, Optional[str]]:
+    """Upload the panel image (and its text-free art, if any) in worker threads."""
+    uploads = [
+        asyncio.to_thread(
+            upload_image_and_get_url,
+            img_bytes=image_bytes,
+            chapter_id=chapter_id,
+            panel_index=idx,
+            fallback_url=source_url,
+        )
+    ]
+    if art_bytes is not None:
+        uploads.append(
+            asyncio.to_thread(
+                upload_image_and_get_url,
+                img_bytes=art_bytes,
+                chapter_id=chapter_id,
+                panel_index=idx,
+                fallback_url=source_url,
+            )
+        )
+    urls = await asyncio.gather(*uploads)
+    return urls[0], (urls[1] if art_bytes is not None else None)
+
+
+async def _render_panel(
+    chapter_id: str,
+    panel_prompt: Dict[str, Any],
+    panel: Dict[str, Any],
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    reference_images: List[str],
+    first_attempt: Optional["asyncio.Task[Tuple[bytes, str]]"] = None,
+    on_candidate: Optional[Callable[[Optional[str], Optional[bytes]], None]] = None,
+    timings: Optional[ChapterTimings] = None,
+    first_attempt_timings: Optional[Dict[str, Any]] = None,
+    review_batcher: Optional[_ReviewBatcher] = None,
+    start_attempt: int = 1,
+    max_attempts: Optional[int] = None,
+    previous_best: Optional[Dict[str, Any]] = None,
+    defer_telemetry: bool = False,
+) -> Dict[str, Any]:
+    """
+    Generate, review (with retries) and upload a single panel image.
+
+    Each attempt renders PANEL_CANDIDATES_PER_ATTEMPT candidates at once and
+    reviews them concurrently; the best-scoring one is kept. Retries either
+    render again from a refined prompt or edit the best attempt so far (see
+    PANEL_RETRY_STRATEGY).
+
+    FLUX calls and reviews are async; blocking Storage calls run in worker
+    threads, so several panels can be in flight at once.
+
+    first_attempt is an already running FLUX call (a claimed speculative render)
+    used instead of the first candidate of attempt 1. on_candidate is called
+    with the first candidate's source URL and (lettered) image bytes of each
+    attempt before it is reviewed, and with None once that attempt is
+    rejected, so dependent panels can speculate on it.
+
+    timings (if given) gets one record per attempt/candidate and the upload time.
+    review_batcher (if given) grades the candidates on shared contact sheets
+    instead of one review call per image.
+
+    Attempts run from start_attempt to max_attempts (default
+    PANEL_REVIEW_MAX_ATTEMPTS). previous_best is an earlier result of this
+    panel: the first attempt retries it (refined prompt or edit), and it is returned
+    unchanged ("improved": False) if no new candidate beats it.
+
+    With defer_telemetry, the review rows of this call are returned as
+    "review_rows" instead of being written, for a caller that may still
+    replace the kept image (budget retries).
+
+    Returns:
+      {"index": ..., "image_url": "...", "source_url": "...",
+       "review": {...} | None, "score": float, "image_bytes": b"...",
+       "art_bytes": b"..." | None, "art_url": "..." | None,
+       "renders": FLUX renders made}
+
+    With PANEL_TEXT_RENDERING=local every candidate is lettered locally
+    before review; art_bytes / art_url are the text-free FLUX art.
+    """
+    idx = panel_prompt["index"]
+    base_prompt = panel_prompt["prompt"]
+    aspect_ratio = panel_prompt["aspect_ratio"]
+    featured_students = panel.get("featured_students") or []
+
+    print(f"   Panel {idx}: using {len(reference_images)} reference images")
+
+    # NEW: quality-aware generation loop
+    if not PANEL_REVIEW_ENABLED:
+        # Old behavior: single generation, no review
+        print(f"      [panel {idx}] Review disabled; generating once...")
+        attempt_timings: Dict[str, Any] = {"attempt": 1, "candidate": 1}
+        image_bytes, source_url = await _generate_attempt(
+            base_prompt,
+            aspect_ratio,
+            reference_images,
+            first_attempt,
+            timings=attempt_timings,
+            speculative_timings=first_attempt_timings,
+        )
+        image_bytes, art_bytes = await _letter_attempt(image_bytes, panel, attempt_timings)
+        if on_candidate:
+            on_candidate(source_url, image_bytes)
+        upload_started = time.perf_counter()
+        image_url, art_url = await _upload_panel(chapter_id, idx, image_bytes, source_url, art_bytes)
+        if timings is not None:
+            timings.add_attempt(idx, attempt_timings)
+            timings.add_panel_stage(idx, "upload", time.perf_counter() - upload_started)
+        return {
+            "index": idx,
+            "image_url": image_url,
+            "source_url": source_url,
+            "review": None,
+            "score": 0.0,
+            "image_bytes": image_bytes,
+            "art_bytes": art_bytes,
+            "art_url": art_url,
+            "renders": 1,
+        }
+
+    best_image_bytes: Optional[bytes] = None
+    best_source_url: Optional[str] = None
+    best_score: float = -1.0
+    best_review: Optional[Dict[str, Any]] = None
+
+    current_prompt = base_prompt
+    # "initial" for the first render, then "regenerate" or "edit" per retry
+    strategy = "initial"
+    edit_image: Optional[str] = None
+    # Text-free art of each candidate by source URL (PANEL_TEXT_RENDERING=local)
+    art_by_source: Dict[str, bytes] = {}
+
+    def plan_retry(retried_attempt: int, review: Optional[Dict[str, Any]]) -> None:
+        """
+        Set prompt/strategy of the next attempt: an edit of the best attempt so
+        far, or a render from the prompt refined with the last attempt's review.
+        """
+        nonlocal current_prompt, strategy, edit_image
+        strategy = _choose_retry_strategy(best_review, best_score)
+        # With local lettering, edit the art rather than the lettered panel
+        edit_source = art_by_source.get(best_source_url or "", best_image_bytes)
+        if strategy == "edit" and edit_source is not None:
+            current_prompt = _edit_prompt_from_review(best_review, panel)
+            edit_image = base64.b64encode(edit_source).decode("ascii")
+        else:
+            strategy = "regenerate"
+            edit_image = None
+            current_prompt = _refine_prompt_from_review(
+                base_prompt, review, retried_attempt, featured_students
+            )
+
+    if previous_best is not None:
+        best_image_bytes = previous_best.get("image_bytes")
+        best_source_url = previous_best.get("source_url")
+        best_score = previous_best["score"]
+        best_review = previous_best.get("review")
+        if previous_best.get("art_bytes") is not None and best_source_url:
+            art_by_source[best_source_url] = previous_best["art_bytes"]
+        plan_retry(start_attempt - 1, best_review)
+    last_attempt = max_attempts or PANEL_REVIEW_MAX_ATTEMPTS
+    candidates_per_attempt = max(1, PANEL_CANDIDATES_PER_ATTEMPT)
+    renders = 0
+    improved = False
+    # (dHash, review) of every reviewed candidate, so near-duplicates reuse the review
+    reviewed: List[Tuple[int, Dict[str, Any]]] = []
+    # Telemetry row of every reviewed candidate
+    review_rows: List[Dict[str, Any]] = []
+    best_row: Optional[Dict[str, Any]] = None
+
+    for attempt in range(start_attempt, last_attempt + 1):
+        print(f"\n      🎯 [panel {idx}] Attempt {attempt}/{PANEL_REVIEW_MAX_ATTEMPTS} ({strategy})")
+        if candidates_per_attempt > 1:
+            print(f"      → Generating {candidates_per_attempt} candidates with FLUX in parallel...")
+        else:
+            print("      → Generating image with FLUX...")
+
+        # Dependent panels speculate on the first candidate that comes back
+        announced = False
+
+        async def generate_and_review(
+            candidate: int,
+        ) -> Tuple[bytes, str, Optional[Dict[str, Any]], float, Dict[str, Any]]:
+            nonlocal announced
+            label = f"panel {idx}" if candidates_per_attempt == 1 else f"panel {idx}, candidate {candidate}"
+            attempt_timings: Dict[str, Any] = {
+                "attempt": attempt,
+                "candidate": candidate,
+                "strategy": strategy,
+            }
+            image_bytes, source_url = await _generate_attempt(
+                current_prompt,
+                aspect_ratio,
+                reference_images,
+                first_attempt if attempt == 1 and candidate == 1 else None,
+                timings=attempt_timings,
+                speculative_timings=first_attempt_timings,
+                edit_image=edit_image,
+            )
+            render_seconds = sum(
+                attempt_timings.get(stage) or 0.0 for stage in ("flux_queue", "flux_render", "download")
+            )
+            image_bytes, art_bytes = await _letter_attempt(image_bytes, panel, attempt_timings)
+            if art_bytes is not None:
+                art_by_source[source_url] = art_bytes
+
+            print(f"      ✓ [{label}] Image generated ({len(image_bytes)} bytes)")
+            if on_candidate and not announced:
+                announced = True
+                on_candidate(source_url, image_bytes)
+
+            # Local pre-filter: blank frames, missing bubbles, repeated images
+            features: Optional[Dict[str, Any]] = None
+            prefiltered: Optional[Dict[str, Any]] = None
+            if PANEL_PREFILTER_ENABLED:
+                prefilter_started = time.perf_counter()
+                try:
+                    features = await asyncio.to_thread(analyze_image, image_bytes)
+                    # An edit is meant to look like the attempt it edits; don't
+                    # treat it as a near-duplicate of it
+                    prefiltered = prefilter_panel(
+                        features, panel, [] if strategy == "edit" else reviewed
+                    )
+                except Exception as e:
+                    print(f"      ⚠️  [{label}] Pre-filter failed, reviewing anyway: {e}")
+                attempt_timings["prefilter"] = time.perf_counter() - prefilter_started
+
+            # Run multimodal review on the downscaled image bytes (sent inline)
+            print("      → Running quality review...")
+            review_started = time.perf_counter()
+            try:
+                if prefiltered is not None:
+                    review = prefiltered
+                elif review_batcher is not None:
+                    review = await review_batcher.review(panel, image_bytes, source_url)
+                else:
+                    review = await review_panel_image_async(
+                        image_url=source_url,
+                        panel=panel,
+                        classroom=classroom,
+                        students=students,
+                        min_score=PANEL_REVIEW_MIN_SCORE,
+                        image_bytes=image_bytes,
+                    )
+                if features is not None and not (review.get("prefilter") or review.get("prefilter_duplicate")):
+                    reviewed.append((features["dhash"], review))
+                score = float(review.get("score", 0.0))
+                print(f"      ✓ [{label}] Quality score: {score:.1f}/10 (threshold: {PANEL_REVIEW_MIN_SCORE})")
+                issues = review.get("issues") or []
+                if issues:
+                    print("      ⚠️  Issues found:")
+                    for i, issue in enumerate(issues, 1):
+                        print(f"         {i}. {issue}")
+            except Exception as e:
+                print(f"      ❌ [{label}] Panel review failed (attempt {attempt}): {e}")
+                review = None
+                score = 0.0
+            review_seconds = time.perf_counter() - review_started
+            if timings is not None:
+                attempt_timings["review"] = review_seconds
+                attempt_timings["score"] = score
+                timings.add_attempt(idx, attempt_timings)
+            row = review_row(
+                chapter_id, classroom, idx, attempt, candidate, review,
+                review_seconds, PANEL_REVIEW_MIN_SCORE,
+                strategy=strategy, render_seconds=render_seconds,
+            )
+            review_rows.append(row)
+            return image_bytes, source_url, review, score, row
+
+        outcomes = await asyncio.gather(
+            *(generate_and_review(c) for c in range(1, candidates_per_attempt + 1)),
+            return_exceptions=True,
+        )
+        renders += len(outcomes)
+        candidates = [o for o in outcomes if not isinstance(o, BaseException)]
+        if not candidates:
+            # Every FLUX call of this attempt failed
+            raise outcomes[0]
+        for failure in (o for o in outcomes if isinstance(o, BaseException)):
+            print(f"      ⚠️  [panel {idx}] A candidate failed to generate: {failure}")
+
+        if strategy in _retry_stats:
+            stats = _retry_stats[strategy]
+            for candidate in candidates:
+                candidate_row = candidate[4]
+                stats["renders"] += 1
+                stats["improved"] += candidate[3] > best_score
+                stats["passed"] += candidate[3] >= PANEL_REVIEW_MIN_SCORE
+                stats["render_seconds"] += candidate_row.get("render_seconds") or 0.0
+
+        # Track best candidate so far (earliest wins a tie)
+        image_bytes, source_url, review, score, row = max(candidates, key=lambda c: c[3])
+        if score > best_score:
+            best_score = score
+            best_image_bytes = image_bytes
+            best_source_url = source_url
+            best_review = review
+            best_row = row
+            improved = True
+
+        # If we passed the quality threshold, stop retrying
+        if score >= PANEL_REVIEW_MIN_SCORE:
+            print(f"      ✅ [panel {idx}] Passed quality threshold! (score {score:.1f} >= {PANEL_REVIEW_MIN_SCORE})")
+            break
+
+        # Otherwise (every candidate was below the threshold), refine the prompt
+        # using the best candidate's suggested fix (if any) and try again
+        if attempt < last_attempt:
+            print(f"      ⚠️  [panel {idx}] Score {score:.1f} below threshold {PANEL_REVIEW_MIN_SCORE}, will retry...")
+            if on_candidate:
+                on_candidate(None, None)
+            plan_retry(attempt, review)
+        else:
+            print(f"      ⚠️  [panel {idx}] Max attempts reached, will use best attempt")
+
+    if previous_best is not None and not improved:
+        print(f"      ↩️  [panel {idx}] No improvement over score {best_score:.1f}; keeping the current image")
+        if not defer_telemetry:
+            record_reviews(review_rows)
+        return {**previous_best, "renders": renders, "improved": False, "review_rows": review_rows}
+
+    # After attempts, accept best attempt (even if below threshold)
+    if best_image_bytes is None or best_source_url is None:
+        raise RuntimeError(f"Panel {idx}: generation failed; no image bytes returned")
+
+    print(f"\n      📦 [panel {idx}] Using best attempt (score={best_score:.1f})")
+    print("      → Uploading to storage...")
+    best_art_bytes = art_by_source.get(best_source_url)
+    upload_started = time.perf_counter()
+    image_url, art_url = await _upload_panel(
+        chapter_id, idx, best_image_bytes, best_source_url, best_art_bytes
+    )
+    if timings is not None:
+        timings.add_panel_stage(idx, "upload", time.perf_counter() - upload_started)
+    print(f"      ✓ Uploaded: {image_url[:60]}...")
+
+    if best_row is not None:
+        best_row["accepted"] = True
+    if not defer_telemetry:
+        record_reviews(review_rows)
+
+    return {
+        "index": idx,
+        "image_url": image_url,
+        "source_url": best_source_url,
+        "review": best_review,
+        "score": best_score,
+        "image_bytes": best_image_bytes,
+        "art_bytes": best_art_bytes,
+        "art_url": art_url,
+        "renders": renders,
+        "review_rows": review_rows,
+    }
+
+
+def _schedule_panel_variants(chapter_id: str, idx: int, result: Dict[str, Any]) -> None:
+    """Build WebP/AVIF variants of a committed panel in the background."""
+    if not SUPABASE_IMAGES_BUCKET or not result.get("image_bytes"):
+        return
+    image_url = result["image_url"]
+    schedule_variants(
+        result["image_bytes"],
+        SUPABASE_IMAGES_BUCKET,
+        "panels",
+        lambda variants: update_panel_variants(chapter_id, idx, image_url, variants),
+        label=f"panel {idx} of chapter {chapter_id}",
+    )
+
+
+async def generate_panel_images(
+    chapter_id: str,
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    script: Dict[str, Any],
+    flux_prompts: List[Dict[str, Any]],
+    concurrency: int = PANEL_GENERATION_CONCURRENCY,
+    reference_mode: str = PANEL_REFERENCE_MODE,
+    pipeline: bool = PANEL_PIPELINE_ENABLED,
+    completed: Optional[Dict[int, Dict[str, Any]]] = None,
+    committed_indices: Optional[set] = None,
+    on_accepted: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+    commit_panel: Optional[Callable[..., Any]] = None,
+    panel_stream: Optional[AsyncIterator[Tuple[Dict[str, Any], Dict[str, Any]]]] = None,
+    timings: Optional[ChapterTimings] = None,
+    budget: Optional[_ChapterBudget] = None,
+) -> Tuple[Dict[int, str], Dict[int, Dict[str, Any]]]:
+    """
+    Render every panel, at most `concurrency` at a time.
+
+    Each panel waits only for the panel it references (per reference_mode),
+    so independent panels render in parallel. Panel rows are still committed
+    in index order through create_panel, as soon as every earlier panel is done.
+
+    With pipeline=True, the first FLUX attempt of the nearest dependent panels
+    starts while the referenced panel is still being reviewed (at most
+    `concurrency` speculative renders at a time). A rejected or
+    superseded candidate cancels that speculative render, so the output is the
+    same as rendering strictly in turn.
+
+    completed maps panel index -> {"image_url": ...} for panels done in an
+    earlier run (they are only used as references); committed_indices already
+    have panel rows. on_accepted is awaited with each newly accepted panel
+    before it waits for its turn to be committed. commit_panel replaces
+    create_panel for writing rows (e.g. replace_panel when regenerating).
+
+    panel_stream yields (panel, flux_prompt) pairs of panels that are still
+    being written by the script model; each one starts rendering as soon as it
+    arrives, in addition to the panels in flux_prompts.
+
+    timings (if given) records per-panel waits, attempts, upload and DB write.
+
+    With a budget, panels get a single attempt each; once every row is
+    committed, the rest of the budget is spent on retries (see _ChapterBudget)
+    and improved panels replace their rows. Later panels keep the reference
+    they were rendered against.
+
+    Returns:
+      (panel_index_to_url, panel_quality)
+    """
+    # Build lookup: student name (lowercased) -> full record (for avatars)
+    students_by_name: Dict[str, Dict[str, Any]] = {
+        s["name"].strip().lower(): s for s in students
+    }
+
+    # Map panel index -> panel dict for convenience
+    panels_by_index: Dict[int, Dict[str, Any]] = {
+        int(p["index"]): p for p in script["panels"]
+    }
+
+    ordered_prompts = sorted(flux_prompts, key=lambda p: p["index"])
+    dependencies = _reference_dependencies(
+        [p["index"] for p in ordered_prompts], reference_mode
+    )
+    completed = completed or {}
+    committed_indices = committed_indices or set()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks: Dict[int, "asyncio.Task[Dict[str, Any]]"] = {}
+    # Panel indices in the order their tasks were started (= commit order)
+    order: List[int] = []
+    # Resolved with a panel's task once it exists (streamed panels may still be
+    # missing when a later panel needs them), or None if it never arrives
+    task_slots: Dict[int, "asyncio.Future[Optional[asyncio.Task[Dict[str, Any]]]]"] = {}
+    loop = asyncio.get_running_loop()
+
+    def task_slot(idx: int) -> "asyncio.Future[Optional[asyncio.Task[Dict[str, Any]]]]":
+        if idx not in task_slots:
+            task_slots[idx] = loop.create_future()
+        return task_slots[idx]
+
+    review_batcher = (
+        _ReviewBatcher(classroom, students, PANEL_REVIEW_BATCH_SIZE, PANEL_REVIEW_BATCH_WINDOW)
+        if PANEL_REVIEW_BATCH_SIZE > 1
+        else None
+    )
+
+    # Review telemetry rows per panel, written once budget retries are done
+    # (a retry can still replace the accepted image)
+    review_rows_by_index: Dict[int, List[Dict[str, Any]]] = {}
+
+    # Prompt and reference images each panel was rendered with (reused by budget retries)
+    prompts_by_index: Dict[int, Dict[str, Any]] = {}
+    reference_images_by_index: Dict[int, List[str]] = {}
+
+    # Speculative renders, keyed by the referenced panel index
+    speculation_semaphore = asyncio.Semaphore(max(1, concurrency))
+    speculations: Dict[int, List[_SpeculativeRender]] = {}
+    speculation_by_index: Dict[int, _SpeculativeRender] = {}
+    # (source URL, image bytes) of the candidate currently under review per
+    # panel (what a late speculation starts from)
+    current_candidates: Dict[int, Optional[Tuple[str, bytes]]] = {}
+
+    def add_speculation(panel_prompt: Dict[str, Any], dependency: Optional[int]) -> None:
+        idx = panel_prompt["index"]
+        if not pipeline or dependency is None or idx in completed or dependency in completed:
+            return
+        if dependency in tasks and tasks[dependency].done():
+            return
+        # Only the nearest dependents would get a concurrency slot right away
+        if len(speculations.get(dependency, [])) >= max(1, concurrency):
+            return
+        speculation = _SpeculativeRender(
+            panel_prompt,
+            _panel_avatar_urls(panels_by_index.get(idx, {}), students_by_name),
+            speculation_semaphore,
+        )
+        speculations.setdefault(dependency, []).append(speculation)
+        speculation_by_index[idx] = speculation
+        if current_candidates.get(dependency):
+            speculation.speculate(*current_candidates[dependency])
+
+    def candidate_callback(idx: int) -> Optional[Callable[[Optional[str], Optional[bytes]], None]]:
+        if not pipeline:
+            return None
+
+        def on_candidate(source_url: Optional[str], image_bytes: Optional[bytes]) -> None:
+            current_candidates[idx] = (source_url, image_bytes) if source_url and image_bytes else None
+            for speculation in speculations.get(idx, []):
+                speculation.speculate(source_url, image_bytes)
+
+        return on_candidate
+
+    async def run_panel(panel_prompt: Dict[str, Any]) -> Dict[str, Any]:
+        idx = panel_prompt["index"]
+        panel = panels_by_index.get(idx, {})
+
+        # Wait for the reference panel before taking a concurrency slot
+        waiting_since = time.perf_counter()
+        reference_url: Optional[str] = None
+        first_attempt: Optional["asyncio.Task[Tuple[bytes, str]]"] = None
+        first_attempt_timings: Optional[Dict[str, Any]] = None
+        dependency = dependencies.get(idx)
+        if dependency is not None:
+            reference_task = await asyncio.shield(task_slot(dependency))
+            if reference_task is not None:
+                reference = await asyncio.shield(reference_task)
+                reference_url = reference["image_url"]
+                speculation = speculation_by_index.get(idx)
+                if speculation is not None:
+                    first_attempt = speculation.claim(reference["source_url"])
+                    first_attempt_timings = speculation.timings
+
+        reference_images = _build_reference_images(
+            reference_url, _panel_avatar_urls(panel, students_by_name)
+        )
+        reference_images_by_index[idx] = reference_images
+
+        slot_requested = time.perf_counter()
+        async with semaphore:
+            if timings is not None:
+                timings.add_panel_stage(idx, "wait_reference", slot_requested - waiting_since)
+                timings.add_panel_stage(idx, "wait_slot", time.perf_counter() - slot_requested)
+            render_started = time.perf_counter()
+            result = await _render_panel(
+                chapter_id=chapter_id,
+                panel_prompt=panel_prompt,
+                panel=panel,
+                classroom=classroom,
+                students=students,
+                reference_images=reference_images,
+                first_attempt=first_attempt,
+                on_candidate=candidate_callback(idx),
+                timings=timings,
+                first_attempt_timings=first_attempt_timings,
+                review_batcher=review_batcher,
+                # With a budget, retries are scheduled across panels afterwards
+                max_attempts=1 if budget is not None else None,
+                defer_telemetry=budget is not None,
+            )
+            if budget is not None:
+                budget.add_attempt(result["renders"], time.perf_counter() - render_started)
+                review_rows_by_index[idx] = list(result["review_rows"])
+
+        if on_accepted:
+            await on_accepted(result)
+        return result
+
+    async def retry_panel(idx: int, attempt: int, previous: Dict[str, Any]) -> Dict[str, Any]:
+        async with semaphore:
+            started = time.perf_counter()
+            result = await _render_panel(
+                chapter_id=chapter_id,
+                panel_prompt=prompts_by_index[idx],
+                panel=panels_by_index.get(idx, {}),
+                classroom=classroom,
+                students=students,
+                reference_images=reference_images_by_index[idx],
+                timings=timings,
+                review_batcher=review_batcher,
+                start_attempt=attempt,
+                max_attempts=attempt,
+                previous_best=previous,
+                defer_telemetry=True,
+            )
+            budget.add_attempt(result["renders"], time.perf_counter() - started)
+        return result
+
+    async def spend_budget(rendered: Dict[int, Dict[str, Any]]) -> None:
+        """Retry the weakest panels while the budget allows."""
+        candidates_per_attempt = max(1, PANEL_CANDIDATES_PER_ATTEMPT)
+        attempts = {idx: 1 for idx in rendered}
+        while True:
+            open_panels = [
+                idx for idx, result in rendered.items()
+                if attempts[idx] < PANEL_REVIEW_MAX_ATTEMPTS and result["score"] < 10.0
+            ]
+            # Panels without an acceptable attempt first, then the weakest passing ones
+            failing = [idx for idx in open_panels if rendered[idx]["score"] < PANEL_REVIEW_MIN_SCORE]
+            pool = sorted(failing or open_panels, key=lambda idx: rendered[idx]["score"])
+
+            round_panels: List[int] = []
+            for idx in pool[:max(1, concurrency)]:
+                if not budget.can_afford(candidates_per_attempt * (len(round_panels) + 1)):
+                    break
+                round_panels.append(idx)
+            if not round_panels:
+                break
+
+            print(f"\n   💰 Budget round: retrying panels {round_panels} "
+                  f"({budget.renders} renders, {budget.elapsed():.0f}s so far)")
+            # A failed retry must not discard the accepted panels or the other retries
+            results = await asyncio.gather(
+                *(retry_panel(idx, attempts[idx] + 1, rendered[idx]) for idx in round_panels),
+                return_exceptions=True,
+            )
+            budget.retries += len(round_panels)
+            for idx, result in zip(round_panels, results):
+                attempts[idx] += 1
+                if isinstance(result, BaseException):
+                    if not isinstance(result, Exception):
+                        raise result
+                    print(f"      ⚠️ Retry of panel {idx} failed, keeping the accepted image: {result}")
+                    continue
+                rows = review_rows_by_index.setdefault(idx, [])
+                if result.get("improved") is False:
+                    rows.extend(result["review_rows"])
+                    continue
+                # Only the image that is finally kept counts as accepted
+                for row in rows:
+                    row["accepted"] = False
+                rows.extend(result["review_rows"])
+                rendered[idx] = result
+                write_started = time.perf_counter()
+                await asyncio.to_thread(
+                    replace_panel,
+                    chapter_id=chapter_id,
+                    index=idx,
+                    image=result["image_url"],
+                    art_image=result.get("art_url"),
+                )
+                if timings is not None:
+                    timings.add_panel_stage(idx, "db_write", time.perf_counter() - write_started)
+                _schedule_panel_variants(chapter_id, idx, result)
+                panel_index_to_url[idx] = result["image_url"]
+                if result["review"] is not None:
+                    panel_quality[idx] = result["review"]
+                if on_accepted:
+                    await on_accepted(result)
+                print(f"      ✓ Panel {idx} improved to {result['score']:.1f}")
+
+    async def already_done(idx: int) -> Dict[str, Any]:
+        return {
+            "index": idx,
+            "image_url": completed[idx]["image_url"],
+            "art_url": completed[idx].get("art_url"),
+            "source_url": None,
+            "review": None,
+            "score": completed[idx].get("score", 0.0),
+        }
+
+    def start_panel(panel_prompt: Dict[str, Any]) -> None:
+        idx = panel_prompt["index"]
+        prompts_by_index[idx] = panel_prompt
+        if idx in completed:
+            tasks[idx] = asyncio.create_task(already_done(idx))
+        else:
+            tasks[idx] = asyncio.create_task(run_panel(panel_prompt))
+        order.append(idx)
+        if not task_slot(idx).done():
+            task_slot(idx).set_result(tasks[idx])
+
+    for panel_prompt in ordered_prompts:
+        add_speculation(panel_prompt, dependencies.get(panel_prompt["index"]))
+    for panel_prompt in ordered_prompts:
+        start_panel(panel_prompt)
+
+    # Streamed panels are started as they arrive
+    arrived = asyncio.Event()
+    stream_task: Optional["asyncio.Task[None]"] = None
+    if panel_stream is not None:
+        async def consume_stream() -> None:
+            try:
+                async for panel, panel_prompt in panel_stream:
+                    idx = panel_prompt["index"]
+                    panels_by_index[idx] = panel
+                    dependencies[idx] = _streamed_dependency(
+                        idx, order, reference_mode
+                    )
+                    add_speculation(panel_prompt, dependencies[idx])
+                    start_panel(panel_prompt)
+                    arrived.set()
+            finally:
+                # Panels referenced but never streamed render without that reference
+                for slot in task_slots.values():
+                    if not slot.done():
+                        slot.set_result(None)
+                arrived.set()
+
+        stream_task = asyncio.create_task(consume_stream())
+
+    panel_index_to_url: Dict[int, str] = {}
+    panel_quality: Dict[int, Dict[str, Any]] = {}
+    # Panels rendered (not reused) in this run, for budget retries
+    rendered: Dict[int, Dict[str, Any]] = {}
+
+    try:
+        # Commit rows strictly in order, as soon as every earlier panel is done
+        position = 0
+        while True:
+            while position >= len(order) and stream_task is not None and not stream_task.done():
+                arrived.clear()
+                await arrived.wait()
+            if position >= len(order):
+                break
+            idx = order[position]
+            position += 1
+
+            result = await tasks[idx]
+            if idx not in committed_indices:
+                write_started = time.perf_counter()
+                await asyncio.to_thread(
+                    commit_panel or create_panel,
+                    chapter_id=chapter_id,
+                    index=idx,
+                    image=result["image_url"],
+                    art_image=result.get("art_url"),
+                )
+                if timings is not None:
+                    timings.add_panel_stage(idx, "db_write", time.perf_counter() - write_started)
+                _schedule_panel_variants(chapter_id, idx, result)
+                if stream_task is None:
+                    print(f"      ✓ Panel {idx}/{len(order)} complete!\n")
+                else:
+                    print(f"      ✓ Panel {idx} complete!\n")
+
+            panel_index_to_url[idx] = result["image_url"]
+            if result["review"] is not None:
+                panel_quality[idx] = result["review"]
+            if idx not in completed:
+                rendered[idx] = result
+
+        if stream_task is not None:
+            # Surface a failed script stream
+            await stream_task
+
+        if budget is not None and PANEL_REVIEW_ENABLED and rendered:
+            await spend_budget(rendered)
+    except BaseException:
+        pending = list(tasks.values())
+        if stream_task is not None:
+            pending.append(stream_task)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+    finally:
+        for speculation in speculation_by_index.values():
+            speculation.cancel()
+        for rows in review_rows_by_index.values():
+            record_reviews(rows)
+
+    return panel_index_to_url, panel_quality
+
+
+# ─────────────────────────────────────────────────────────────
+# OpenAI helpers
+# ─────────────────────────────────────────────────────────────
+
+def _classroom_context_dict(
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    teacher_outline: str,
+) -> Dict[str, Any]:
+    """Compact JSON context that we send to OpenAI."""
+    return {
+        "classroom": {
+            "id": classroom["id"],
+            "name": classroom["name"],
+            "subject": classroom["subject"],
+            "grade_level": classroom["grade_level"],
+            "story_theme": classroom["story_theme"],
+            "design_style": classroom["design_style"],
+            "duration": classroom["duration"],
+        },
+        "students": [
+            {
+                "name": s["name"],
+                "interests": s.get("interests", ""),
+                "avatar_url": s.get("avatar_url"),
+            }
+            for s in students
+        ],
+        "teacher_outline": teacher_outline,
+    }
+
+
+def _script_request(
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    teacher_outline: str,
+    chosen_idea: Dict[str, Any],
+    written_panels: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Cache key and chat messages of the script request.
+
+    The key hashes the context payload (which includes the chosen idea and
+    any written_panels), the model and SCRIPT_PROMPT_VERSION.
+    """
+
+    payload = _classroom_context_dict(classroom, students, teacher_outline)
+    payload["chosen_idea"] = chosen_idea
+    continuation = ""
+    if written_panels:
+        payload["written_panels"] = written_panels
+        continuation = (
+            "- written_panels are already drawn: repeat them unchanged as the first panels\n"
+            "  and continue the story after them.\n"
+        )
+
+    system_prompt = (
+        "You write scripts for short educational comics. "
+        "Target: kids 6–16, clear and simple language, 8–12 panels per chapter. "
+        "Always respond with a single JSON object following the requested schema."
+    )
+
+    user_prompt = (
+        "Using the given classroom, students, teacher_outline and chosen_idea, write a single comic chapter.\n\n"
+                "Constraints:\n"
+        "- 8 to 12 panels total.\n"
+        "- Panels 1–3: introduce the situation and characters.\n"
+        "- Middle panels: show a small challenge or question related to the learning topic.\n"
+        "- Final panels: resolve the situation and recap the key learning objective.\n"
+        "- Each panel should have at most 1 narration box and at most 2 speech bubbles.\n"
+        "- Each narration or dialogue line must be very short (max 10 words).\n"
+        "- Each panel should be visually distinct and move the story forward.\n"
+        "- Use the students' names in dialogue sometimes to make it personal.\n"
+        "- Do NOT have characters speak about themselves in the third person.\n"
+        "- Do NOT have a character address themselves by name in their own speech bubble.\n"
+        "- Keep dialogue lines short (max 15 words).\n"
+        "- Make sure the story helps understand the subject in a concrete way.\n"
+        "- The 'speaker' field must always be either a student name from this classroom\n"
+        "  or 'Teacher' / 'Narrator'.\n"
+        f"{continuation}\n"
+        "Return ONLY a JSON object with this structure (no extra text):\n"
+        "{\n"
+        '  "episode_title": "short, fun title",\n'
+        '  "learning_objectives": ["objective 1", "objective 2", ...],\n'
+        '  "panels": [\n'
+        "    {\n"
+        '      "index": 1,\n'
+        '      "setting": "location and time",\n'
+        '      "description": "what we see in the drawing, including characters and actions",\n'
+        '      "narration": "optional narrator text or empty string",\n'
+        '      "dialogue": [\n'
+        '        {"speaker": "Name", "text": "line of dialogue"},\n'
+        "        ...\n"
+        "      ],\n"
+        '      "featured_students": ["Name1", "Name2", ...]\n'
+        "    },\n"
+        "    ...\n"
+        "  ]\n"
+        "}\n\n"
+        f"INPUT:\n{json.dumps(payload, ensure_ascii=False)}"
+    )
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    return make_key(payload, OPENAI_MODEL, SCRIPT_PROMPT_VERSION), messages
+
+
+def _normalize_script_panel(panel: Dict[str, Any], position: int) -> Dict[str, Any]:
+    """Fill in missing panel fields (index falls back to its 1-based position)."""
+    panel["index"] = int(panel.get("index", position))
+    panel.setdefault("setting", "")
+    panel.setdefault("description", "")
+    panel.setdefault("narration", "")
+    panel.setdefault("dialogue", [])
+    panel.setdefault("featured_students", [])
+    return panel
+
+
+def _parse_script(raw: str, chosen_idea: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise RuntimeError(f"OpenAI returned invalid JSON for script: {e}\nRaw: {raw}")
+
+    panels = data.get("panels", [])
+    # Normalize panel indices to 1..N if missing/invalid
+    for idx, panel in enumerate(panels, start=1):
+        _normalize_script_panel(panel, idx)
+
+    data["panels"] = panels
+    data.setdefault("episode_title", chosen_idea.get("title", "Untitled Chapter"))
+    data.setdefault("learning_objectives", [])
+    return data
+
+
+def get_cached_script(
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    teacher_outline: str,
+    chosen_idea: Dict[str, Any],
+) -> Optional[Dict[str, Any]]:
+    """Script memoized in script_cache for this exact request, if any."""
+    cache_key, _ = _script_request(classroom, students, teacher_outline, chosen_idea)
+    cached = script_cache.get(cache_key)
+    if cached is not None:
+        print(f"✓ Script cache hit ({cache_key[:12]})")
+    return cached
+
+
+def generate_full_script_and_panels(
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    teacher_outline: str,
+    chosen_idea: Dict[str, Any],
+    use_cache: bool = True,
+    written_panels: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Ask OpenAI for a full script + panel breakdown.
+
+    Results are memoized in script_cache, keyed by the context payload (which
+    includes the chosen idea), the model and SCRIPT_PROMPT_VERSION.
+    use_cache=False skips the lookup (the fresh script still replaces the entry).
+    With written_panels (from an interrupted stream) the script continues after
+    them, and those panels are kept exactly as they were written.
+    """
+
+    cache_key, messages = _script_request(
+        classroom, students, teacher_outline, chosen_idea, written_panels
+    )
+    if use_cache:
+        cached = script_cache.get(cache_key)
+        if cached is not None:
+            print(f"✓ Script cache hit ({cache_key[:12]})")
+            return cached
+    else:
+        script_cache.record_bypass()
+
+    resp = openai_client.chat.completions.create(
+        model=OPENAI_MODEL,
+        response_format={"type": "json_object"},
+        messages=messages,
+    )
+
+    data = _parse_script(resp.choices[0].message.content, chosen_idea)
+    if written_panels:
+        last_written = max(int(p["index"]) for p in written_panels)
+        data["panels"] = [
+            *written_panels,
+            *(p for p in data["panels"] if p["index"] > last_written),
+        ]
+    script_cache.set(cache_key, data)
+    return data
+
+
+class _PanelStreamParser:
+    """
+    Incremental parser for the streamed script JSON.
+
+    feed() takes the next chunk of text and returns every object of the
+    top-level "panels" array that has been closed since the last call.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.stack: List[str] = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.last_key: Optional[str] = None
+        self.panels_depth: Optional[int] = None
+        self.panel_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.buffer += chunk
+        closed: List[Dict[str, Any]] = []
+
+        while self.pos < len(self.buffer):
+            ch = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if len(self.stack) == 1:
+                        # Keys and values of the top-level object
+                        self.last_key = self.buffer[self.string_start + 1:self.pos]
+            elif ch == '"':
+                self.in_string = True
+                self.string_start = self.pos
+            elif ch in "{[":
+                if (
+                    ch == "["
+                    and self.stack == ["{"]
+                    and self.last_key == "panels"
+                    and self.panels_depth is None
+                ):
+                    self.panels_depth = 2
+                elif ch == "{" and self.panels_depth is not None and len(self.stack) == self.panels_depth:
+                    self.panel_start = self.pos
+                self.stack.append(ch)
+            elif ch in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if (
+                    ch == "}"
+                    and self.panel_start is not None
+                    and len(self.stack) == self.panels_depth
+                ):
+                    try:
+                        closed.append(json.loads(self.buffer[self.panel_start:self.pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self.panel_start = None
+                elif ch == "]" and self.panels_depth is not None and len(self.stack) == self.panels_depth - 1:
+                    # End of the panels array
+                    self.panels_depth = -1
+            self.pos += 1
+
+        return closed
+
+
+def stream_full_script_and_panels(
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    teacher_outline: str,
+    chosen_idea: Dict[str, Any],
+    on_panel: Callable[[Dict[str, Any]], None],
+) -> Dict[str, Any]:
+    """
+    Streaming variant of generate_full_script_and_panels (blocking; run it in a
+    worker thread).
+
+    The chat completion is consumed as a token stream, and on_panel is called
+    with every panel as soon as its JSON object is closed. Returns the full
+    script once the stream ends (also stored in script_cache). Panels the
+    incremental parser missed are still part of the returned script.
+    """
+
+    cache_key, messages = _script_request(classroom, students, teacher_outline, chosen_idea)
+
+    stream = openai_client.chat.completions.create(
+        model=OPENAI_MODEL,
+        response_format={"type": "json_object"},
+        messages=messages,
+        stream=True,
+    )
+
+    parser = _PanelStreamParser()
+    parts: List[str] = []
+    streamed = 0
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content or ""
+        if not text:
+            continue
+        parts.append(text)
+        for panel in parser.feed(text):
+            streamed += 1
+            on_panel(_normalize_script_panel(panel, streamed))
+
+    data = _parse_script("".join(parts), chosen_idea)
+    script_cache.set(cache_key, data)
+    return data
+
+
+# ─────────────────────────────────────────────────────────────
+# Flux prompt construction
+# ─────────────────────────────────────────────────────────────
+
+def _panel_text_for_prompt(panel: Dict[str, Any]) -> str:
+    """
+    Convert narration + dialogue into short, structured lines for FLUX.
+
+    We explicitly tell the model:
+    - Which character should have which bubble
+    - Where to place the bubble / tail
+    """
+    lines: List[str] = []
+
+    narration = (panel.get("narration") or "").strip()
+    if narration:
+        lines.append(
+            f'NARRATION_BOX (top of panel, no tail, centered): "{narration}"'
+        )
+
+    for line in panel.get("dialogue") or []:
+        speaker = (line.get("speaker") or "").strip()
+        text = (line.get("text") or "").strip()
+        if not text:
+            continue
+
+        if speaker:
+            # Very explicit: who speaks, where the bubble goes, where the tail points
+            lines.append(
+                f'SPEECH_BUBBLE for {speaker.upper()} '
+                f'(bubble above or beside {speaker.upper()}, tail clearly pointing '
+                f'to {speaker.upper()}): "{text}"'
+            )
+        else:
+            lines.append(f'UNASSIGNED_SPEECH_BUBBLE: "{text}"')
+
+    return " | ".join(lines)
+
+
+def build_flux_prompts_from_script(
+    classroom: Dict[str, Any],
+    students: List[Dict[str, Any]],
+    script: Dict[str, Any],
+) -> List[Dict[str, Any]]:
+    """
+    Build text-to-image prompts for each panel based on the script and classroom style.
+    Now also instructs FLUX.2 to render the narration + dialogue text inside the panel,
+    or, with PANEL_TEXT_RENDERING=local, to leave room for locally drawn bubbles.
+    """
+
+    design_style = classroom.get("design_style", "comic")
+    if design_style == "manga":
+        style_phrase = (
+            "in a clean black-and-white manga style, expressive characters, clear line art"
+        )
+    else:
+        style_phrase = (
+            "in a colorful, kid-friendly comic style, clear line art, simple shading"
+        )
+
+    theme_phrase = classroom.get("story_theme", "")
+
+    student_descriptors: Dict[str, str] = {}
+    for s in students:
+        interests = s.get("interests", "")
+        if interests:
+            student_descriptors[s["name"]] = f"{s['name']}, a student who likes {interests}"
+        else:
+            student_descriptors[s["name"]] = f"{s['name']}, a student"
+
+    flux_prompts: List[Dict[str, Any]] = []
+
+    for panel in script["panels"]:
+        idx = int(panel["index"])
+        setting = panel.get("setting") or ""
+        description = panel.get("description") or ""
+        featured = panel.get("featured_students") or []
+
+        if featured:
+            cast_desc = ", ".join(
+                student_descriptors.get(name, name) for name in featured
+            )
+            cast_phrase = f"Show the students: {cast_desc}."
+        else:
+            cast_phrase = "Show a small group of students and a teacher."
+
+        if PANEL_TEXT_RENDERING == "local":
+            # Text-free art; bubbles are drawn by panel_lettering after rendering
+            prompt = (
+                f"A single comic panel {style_phrase}. "
+                f"Scene setting: {setting}. "
+                f"Visual description: {description}. "
+                f"{cast_phrase} "
+                "Keep character designs and overall style consistent across panels and "
+                "with any reference images provided. "
+                f"{art_prompt_instructions(panel)}"
+            )
+            if theme_phrase:
+                prompt += f"Match the ongoing story theme: {theme_phrase}. "
+        else:
+            # Base visual prompt
+            # Build the base visual prompt
+            prompt = (
+                f"A single comic panel {style_phrase}. "
+                f"Scene setting: {setting}. "
+                f"Visual description: {description}. "
+                f"{cast_phrase} "
+                "Keep composition readable for text bubbles. "
+                "Keep character designs and overall style consistent across panels and "
+                "with any reference images provided. "
+                "Each speech bubble MUST be attached to the correct speaker: the tail of "
+                "the bubble must clearly point to the mouth/head of the character who "
+                "is speaking. Do NOT show characters speaking if they have no speech "
+                "bubble defined for this panel. Do NOT duplicate or invent extra text."
+            )
+
+            if theme_phrase:
+                prompt += f"Match the ongoing story theme: {theme_phrase}. "
+
+            # NEW: tell FLUX.2 to render the actual text from this panel
+            panel_text = _panel_text_for_prompt(panel)
+            if panel_text:
+                prompt += (
+                    "Write the following text clearly inside comic-style speech bubbles "
+                    "and narration boxes. Use bold, uppercase comic lettering in black "
+                    "on white bubbles/boxes, with no distortion or extra flourishes. "
+                    "Do NOT paraphrase or change the wording. Use every line exactly as given. "
+                    "For each SPEECH_BUBBLE line, place the bubble near the named character "
+                    "and point the tail directly to that character. For the NARRATION_BOX, "
+                    "place it at the top of the panel with no tail. Text to write (each '|' "
+                    "separates a different bubble or box): "
+                    f"{panel_text} "
+                )
+
+        aspect_ratio = "3:2"
+
+        flux_prompts.append(
+            {
+                "index": idx,
+                "prompt": prompt,
+                "aspect_ratio": aspect_ratio,
+            }
+        )
+
+    return flux_prompts
+
+
+# ─────────────────────────────────────────────────────────────
+# FLUX / Black Forest Labs API helpers
+# ─────────────────────────────────────────────────────────────
+
+def _dims_from_aspect(aspect_ratio: str) -> Tuple[int, int]:
+    """
+    Map a simple aspect ratio string to width/height for FLUX.2 [pro].
+    FLUX.2 works with explicit width/height instead of a string aspect ratio.
+    """
+    aspect_ratio = aspect_ratio.strip()
+    if aspect_ratio == "1:1":
+        return 768, 768
+    if aspect_ratio in ("3:2", "2:3"):
+        return (960, 640) if aspect_ratio == "3:2" else (640, 960)
+    if aspect_ratio in ("16:9", "9:16"):
+        return (960, 540) if aspect_ratio == "16:9" else (540, 960)
+    # Default: 3:2-ish
+    return 960, 640
+
+
+async def call_flux_and_download(
+    prompt: str,
+    aspect_ratio: str = "3:2",
+    reference_images: Optional[List[str]] = None,
+    timeout_seconds: float = 60.0,
+    timings: Optional[Dict[str, Any]] = None,
+    edit_image: Optional[str] = None,
+) -> Tuple[bytes, str]:
+    """
+    1) Submit a generation/edit task to FLUX.2 [pro] via the shared BFL client.
+    2) Optionally pass up to 8 reference images (reference panel + student avatars)
+       as input_image, input_image_2, ..., input_image_8.
+       For an edit, edit_image (URL or base64 of the image to change) is
+       input_image and the reference images follow it.
+    3) Wait for the shared BFL poller to report status == 'Ready' (or timeout).
+    4) Download the resulting image bytes from result.sample URL.
+
+    If a timings dict is given, it gets "flux_queue", "flux_render" and
+    "download" (seconds).
+
+    Returns:
+      (image_bytes, source_url)
+    """
+
+    if not bfl_client.is_configured():
+        raise RuntimeError("BFL_API_KEY is not set; cannot call FLUX API")
+
+    width, height = _dims_from_aspect(aspect_ratio)
+
+    body: Dict[str, Any] = {
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "output_format": "png",
+        "safety_tolerance": 4,
+        # You can uncomment this if you've found prompt_upsampling hurts text:
+        # "prompt_upsampling": False,
+    }
+
+    # Attach reference images as input_image..input_image_8
+    refs = reference_images or []
+    if edit_image:
+        refs = [edit_image] + refs
+    for i, ref in enumerate(refs):
+        if i >= 8:
+            break
+        key = "input_image" if i == 0 else f"input_image_{i + 1}"
+        body[key] = ref
+
+    sample_url = await bfl_client.generate(body, timeout_seconds=timeout_seconds, timings=timings)
+    download_started = time.perf_counter()
+    image_bytes = await bfl_client.download(sample_url)
+    if timings is not None:
+        timings["download"] = time.perf_counter() - download_started
+    return image_bytes, sample_url
+
+
+def upload_image_and_get_url(
+    img_bytes: bytes,
+    chapter_id: str,
+    panel_index: int,
+    fallback_url: str,
+) -> str:
+    """
+    Upload image bytes to Supabase Storage if SUPABASE_IMAGES_BUCKET is configured.
+    Images are content-addressed (SHA-256 of the bytes), so an identical image
+    is stored once and served with a long-lived cache lifetime.
+    Otherwise, fall back to the original FLUX delivery URL (short-lived, not ideal for production).
+    """
+
+    if not SUPABASE_IMAGES_BUCKET:
+        return fallback_url
+
+    try:
+        return store_image(SUPABASE_IMAGES_BUCKET, img_bytes, prefix="panels") or fallback_url
+    except Exception as e:
+        print(f"[WARN] Failed to upload panel {panel_index} of chapter {chapter_id} to Supabase Storage: {e}")
+        return fallback_url
+
+
+# ─────────────────────────────────────────────────────────────
+# Optional CLI for testing
+# ─────────────────────────────────────────────────────────────
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Commit a chosen story idea and generate full chapter"
+    )
+    parser.add_argument("chapter_id", help="Chapter UUID")
+    parser.add_argument("chosen_idea_id", help="ID of the chosen idea (e.g. idea_1)")
+
+    args = parser.parse_args()
+
+    result = asyncio.run(commit_story_choice(args.chapter_id, args.chosen_idea_id))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
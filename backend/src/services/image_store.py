@@ -0,0 +1,109 @@
+"""
+Content-addressed image storage on Supabase Storage.
+
+Images are stored under the SHA-256 of their bytes, so identical images
+(retries, regenerations, re-uploads) map to one object that is uploaded once.
+Because an object's content never changes for its path, it is served with a
+long-lived cache lifetime.
+"""
+import hashlib
+import os
+from typing import Optional, Set, Tuple
+
+from database.database import supabase
+
+# Cache lifetime (seconds) sent with every stored image. Supabase Storage
+# serves it as "max-age=<value>"; content-addressed paths never change, so a
+# year is safe.
+IMAGE_CACHE_CONTROL = os.getenv("IMAGE_CACHE_CONTROL", "31536000")
+
+# Paths already known to exist (per bucket), to skip the existence check
+_known_paths: Set[Tuple[str, str]] = set()
+
+
+def detect_image_type(data: bytes) -> Tuple[str, str]:
+    """
+    Detect the image format from its magic bytes.
+
+    Args:
+        data: Raw image bytes
+
+    Returns:
+        (content_type, file_extension), defaulting to PNG
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg", "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif", "avif"
+    return "image/png", "png"
+
+
+def content_path(data: bytes, prefix: str = "", extension: Optional[str] = None) -> str:
+    """
+    Storage path of an image: <prefix>/<sha256 of the bytes>.<extension>.
+
+    Args:
+        data: Raw image bytes
+        prefix: Folder inside the bucket (e.g. "panels")
+        extension: File extension (detected from the bytes if omitted)
+
+    Returns:
+        Path inside the bucket
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    extension = extension or detect_image_type(data)[1]
+    filename = f"{digest}.{extension}"
+    return f"{prefix.strip('/')}/{filename}" if prefix else filename
+
+
+def store_image(
+    bucket: str,
+    data: bytes,
+    prefix: str = "",
+    content_type: Optional[str] = None,
+) -> str:
+    """
+    Upload image bytes under their content hash (skipped if already stored).
+
+    Args:
+        bucket: Supabase Storage bucket name
+        data: Raw image bytes
+        prefix: Folder inside the bucket (e.g. "panels")
+        content_type: MIME type (detected from the bytes if omitted)
+
+    Returns:
+        Public URL of the stored image
+
+    Raises:
+        Exception: If the upload to Supabase fails
+    """
+    detected_type, extension = detect_image_type(data)
+    content_type = content_type or detected_type
+    path = content_path(data, prefix, extension)
+    storage = supabase.storage.from_(bucket)
+
+    if (bucket, path) in _known_paths or storage.exists(path):
+        print(f"♻️ Image already stored, skipping upload: {bucket}/{path}")
+    else:
+        try:
+            storage.upload(
+                path=path,
+                file=data,
+                file_options={
+                    "content-type": content_type,
+                    "cache-control": IMAGE_CACHE_CONTROL,
+                    "upsert": "false",
+                },
+            )
+        except Exception as e:
+            # A concurrent upload of the same bytes already created the object
+            if "duplicate" not in str(e).lower() and "already exists" not in str(e).lower():
+                raise
+    _known_paths.add((bucket, path))
+
+    public_url = storage.get_public_url(path)
+    if isinstance(public_url, dict):
+        public_url = public_url.get("publicUrl") or public_url.get("public_url")
+    return public_url
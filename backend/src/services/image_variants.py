@@ -0,0 +1,153 @@
+"""
+Responsive image variants (WebP / AVIF at a few widths) for stored images.
+
+Encoding runs in a process pool so it never blocks the event loop or the
+panel generation loop; variants are built in the background after the
+original image is stored and recorded next to the record that uses it
+(panels.variants, students.avatar_variants, chapters.thumbnail_variants).
+"""
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services.image_store import store_image
+
+# Needs backend/src/database/add_image_variants.sql to be applied
+IMAGE_VARIANTS_ENABLED = os.getenv("IMAGE_VARIANTS_ENABLED", "false").lower() == "true"
+# Output formats, e.g. "webp" or "webp,avif" (AVIF is much slower to encode)
+IMAGE_VARIANT_FORMATS = [
+    f.strip().lower()
+    for f in os.getenv("IMAGE_VARIANT_FORMATS", "webp").split(",")
+    if f.strip()
+]
+IMAGE_VARIANT_WIDTHS = [
+    int(w) for w in os.getenv("IMAGE_VARIANT_WIDTHS", "480,960,1440").split(",") if w.strip()
+]
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))
+
+_PIL_FORMATS = {"webp": "WEBP", "avif": "AVIF"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+# Keep references to background variant tasks so they are not garbage collected
+_tasks: set = set()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max(1, IMAGE_VARIANT_WORKERS))
+    return _pool
+
+
+def shutdown() -> None:
+    """Stop the encoder processes (called on app shutdown)."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def encode_variants(
+    data: bytes,
+    formats: List[str],
+    widths: List[int],
+    quality: int,
+) -> List[Tuple[str, int, bytes]]:
+    """
+    Encode an image into every (format, width) pair. Runs in a worker process.
+
+    Widths larger than the original are skipped; the original width is always
+    included, so every format has at least a full-size encoding.
+
+    Returns:
+        List of (format, width, encoded bytes)
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as original:
+        original.load()
+        image = original.convert("RGBA" if "A" in original.getbands() else "RGB")
+
+    targets = sorted({w for w in widths if w < image.width} | {image.width})
+    variants: List[Tuple[str, int, bytes]] = []
+    for width in targets:
+        if width == image.width:
+            resized = image
+        else:
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+        for fmt in formats:
+            out = io.BytesIO()
+            resized.save(out, format=_PIL_FORMATS[fmt], quality=quality)
+            variants.append((fmt, width, out.getvalue()))
+    return variants
+
+
+async def build_variants(data: bytes, bucket: str, prefix: str = "") -> Dict[str, Dict[str, str]]:
+    """
+    Encode and store the responsive variants of an image.
+
+    Args:
+        data: Original image bytes
+        bucket: Supabase Storage bucket for the variants
+        prefix: Folder inside the bucket (variants go to <prefix>/variants)
+
+    Returns:
+        {"webp": {"480": "https://...", ...}, "avif": {...}}
+    """
+    formats = [f for f in IMAGE_VARIANT_FORMATS if f in _PIL_FORMATS]
+    loop = asyncio.get_running_loop()
+    encoded = await loop.run_in_executor(
+        _get_pool(),
+        encode_variants,
+        data,
+        formats,
+        IMAGE_VARIANT_WIDTHS,
+        IMAGE_VARIANT_QUALITY,
+    )
+
+    folder = f"{prefix.strip('/')}/variants" if prefix else "variants"
+    urls = await asyncio.gather(
+        *(asyncio.to_thread(store_image, bucket, body, folder) for _, _, body in encoded)
+    )
+
+    variants: Dict[str, Dict[str, str]] = {}
+    for (fmt, width, _), url in zip(encoded, urls):
+        variants.setdefault(fmt, {})[str(width)] = url
+    return variants
+
+
+def schedule_variants(
+    data: bytes,
+    bucket: str,
+    prefix: str,
+    record: Callable[[Dict[str, Dict[str, str]]], Any],
+    label: str,
+) -> Optional["asyncio.Task[None]"]:
+    """
+    Build variants in the background and pass them to `record` (a blocking
+    database write, run in a worker thread). No-op unless IMAGE_VARIANTS_ENABLED.
+
+    Returns:
+        The background task, or None if variants are disabled
+    """
+    if not IMAGE_VARIANTS_ENABLED:
+        return None
+
+    async def run() -> None:
+        try:
+            variants = await build_variants(data, bucket, prefix)
+            await asyncio.to_thread(record, variants)
+            count = sum(len(v) for v in variants.values())
+            print(f"🖼️ Stored {count} image variants for {label}")
+        except Exception as e:
+            print(f"⚠️ Failed to build image variants for {label}: {e}")
+
+    task = asyncio.create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
@@ -0,0 +1,201 @@
+"""
+Small persistent key/value cache (SQLite) for expensive model calls.
+
+Each cache is a named namespace in one SQLite file, bounded to max_entries
+with least-recently-used eviction and an optional TTL. Values are stored as
+JSON. An optional in-process LRU layer (memory_entries) serves hot keys
+without touching SQLite. Safe to use from worker threads.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+PERSISTENT_CACHE_PATH = os.getenv(
+    "PERSISTENT_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "educomic_cache.sqlite3"),
+)
+
+_connection: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def _get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        directory = os.path.dirname(PERSISTENT_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _connection = sqlite3.connect(PERSISTENT_CACHE_PATH, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        _connection.execute(
+            "CREATE INDEX IF NOT EXISTS cache_entries_lru ON cache_entries (namespace, last_used)"
+        )
+        _connection.commit()
+    return _connection
+
+
+def make_key(*parts: Any) -> str:
+    """SHA-256 of the JSON encoding of `parts` (dict key order does not matter)."""
+    encoded = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class PersistentCache:
+    """
+    LRU-bounded persistent cache for one namespace.
+
+    Lookups and writes never raise: a broken cache file only costs a miss.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        max_entries: int = 256,
+        ttl_seconds: Optional[float] = None,
+        enabled: bool = True,
+        memory_entries: int = 0,
+    ):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.memory_entries = memory_entries
+        # key -> (JSON value, created_at), most recently used last
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.memory_hits = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.errors = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Cached value for key (refreshing its LRU position), or None."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with _lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                if not self.ttl_seconds or now - cached[1] <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return json.loads(cached[0])
+                del self._memory[key]
+        try:
+            with _lock:
+                conn = _get_connection()
+                row = conn.execute(
+                    "SELECT value, created_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                ).fetchone()
+                if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                    conn.execute(
+                        "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                        (self.namespace, key),
+                    )
+                    conn.commit()
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute(
+                    "UPDATE cache_entries SET last_used = ? WHERE namespace = ? AND key = ?",
+                    (now, self.namespace, key),
+                )
+                conn.commit()
+                self.hits += 1
+                self._remember(key, row[0], row[1])
+            return json.loads(row[0])
+        except Exception as e:
+            print(f"[WARN] {self.namespace} cache lookup failed: {e}")
+            self.errors += 1
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Any) -> None:
+        """Store value under key and evict least recently used entries."""
+        if not self.enabled:
+            return
+        now = time.time()
+        try:
+            encoded = json.dumps(value, ensure_ascii=False)
+            with _lock:
+                self._remember(key, encoded, now)
+                conn = _get_connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, value, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (self.namespace, key, encoded, now, now),
+                )
+                conn.execute(
+                    """
+                    DELETE FROM cache_entries
+                    WHERE namespace = ? AND key NOT IN (
+                        SELECT key FROM cache_entries
+                        WHERE namespace = ?
+                        ORDER BY last_used DESC
+                        LIMIT ?
+                    )
+                    """,
+                    (self.namespace, self.namespace, max(1, self.max_entries)),
+                )
+                conn.commit()
+        except Exception as e:
+            print(f"[WARN] {self.namespace} cache write failed: {e}")
+            self.errors += 1
+
+    def _remember(self, key: str, encoded: str, created_at: float) -> None:
+        """Keep a value in the in-process LRU layer (caller holds _lock)."""
+        if self.memory_entries <= 0:
+            return
+        self._memory[key] = (encoded, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def record_bypass(self) -> None:
+        """Count a lookup that was skipped on purpose (bypass flag)."""
+        self.bypassed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters (since process start) and current size."""
+        size = None
+        try:
+            with _lock:
+                size = _get_connection().execute(
+                    "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?",
+                    (self.namespace,),
+                ).fetchone()[0]
+        except Exception:
+            pass
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "entries": size,
+            "max_entries": self.max_entries,
+        }
@@ -0,0 +1,177 @@
+"""
+Panel review telemetry.
+
+Every reviewed candidate (attempt, scores, latency, whether it became the
+panel image) is written to the panel_reviews table in the background, and
+summarize_reviews aggregates pass rates and retry counts per classroom,
+design style and threshold to tune PANEL_REVIEW_MIN_SCORE / MAX_ATTEMPTS.
+"""
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from database.database import create_panel_reviews
+
+# Needs backend/src/database/add_panel_reviews.sql to be applied
+REVIEW_TELEMETRY_ENABLED = os.getenv("REVIEW_TELEMETRY_ENABLED", "false").lower() == "true"
+
+# Keep references to background writes so they are not garbage collected
+_tasks: set = set()
+
+
+def review_row(
+    chapter_id: str,
+    classroom: Dict[str, Any],
+    panel_index: int,
+    attempt: int,
+    candidate: int,
+    review: Optional[Dict[str, Any]],
+    latency: Optional[float],
+    threshold: float,
+    strategy: str = "initial",
+    render_seconds: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Telemetry row of one reviewed candidate (accepted is set by the caller).
+    strategy is "initial", "regenerate" or "edit" (how the render was made).
+    """
+    dims = (review or {}).get("dimensions") or {}
+    if review is None:
+        model = None
+    elif review.get("prefilter"):
+        model = "prefilter"
+    elif review.get("prefilter_duplicate"):
+        model = "prefilter_duplicate"
+    else:
+        model = review.get("review_model")
+    return {
+        "chapter_id": chapter_id,
+        "classroom_id": classroom.get("id"),
+        "panel_index": panel_index,
+        "attempt": attempt,
+        "candidate": candidate,
+        "score": float(review.get("score", 0.0)) if review is not None else None,
+        "text_accuracy": dims.get("text_accuracy"),
+        "character_accuracy": dims.get("character_accuracy"),
+        "layout_readability": dims.get("layout_readability"),
+        "review_model": model,
+        "latency_seconds": round(latency, 3) if latency is not None else None,
+        "strategy": strategy,
+        "render_seconds": round(render_seconds, 3) if render_seconds is not None else None,
+        "threshold": threshold,
+        "design_style": classroom.get("design_style"),
+        "accepted": False,
+    }
+
+
+def record_reviews(rows: List[Dict[str, Any]]) -> Optional["asyncio.Task[None]"]:
+    """
+    Write the review rows of one panel in the background. Telemetry never
+    fails generation. No-op unless REVIEW_TELEMETRY_ENABLED.
+
+    Returns:
+        The background task, or None if telemetry is disabled
+    """
+    if not REVIEW_TELEMETRY_ENABLED or not rows:
+        return None
+
+    async def run() -> None:
+        try:
+            await asyncio.to_thread(create_panel_reviews, rows)
+        except Exception as e:
+            print(f"⚠️ Failed to record {len(rows)} panel reviews: {e}")
+
+    task = asyncio.create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+def _mean(values: List[float]) -> Optional[float]:
+    return round(sum(values) / len(values), 3) if values else None
+
+
+def summarize_reviews(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Aggregate review rows per (classroom, design style, threshold).
+
+    For each group: reviews (= FLUX renders reviewed), panels, renders that
+    were not used, first-attempt and final pass rates, average attempts and
+    total retries per panel, average score per attempt number (do retries
+    raise scores?), average review latency, and per retry strategy the pass
+    rate, accepted rate and average render time. Reviews decided by the local
+    pre-filter (rejections, reused near-duplicate reviews) are counted apart.
+    """
+    groups: Dict[Tuple[Any, Any, Any], List[Dict[str, Any]]] = {}
+    for row in rows:
+        key = (row.get("classroom_id"), row.get("design_style"), row.get("threshold"))
+        groups.setdefault(key, []).append(row)
+
+    summaries = []
+    for (classroom_id, design_style, threshold), group in groups.items():
+        panels: Dict[Tuple[Any, Any], List[Dict[str, Any]]] = {}
+        for row in group:
+            panels.setdefault((row.get("chapter_id"), row.get("panel_index")), []).append(row)
+
+        def passed(row: Dict[str, Any]) -> bool:
+            return row.get("score") is not None and row["score"] >= (threshold or 0)
+
+        first_pass = [
+            any(passed(r) for r in reviews if r.get("attempt") == 1)
+            for reviews in panels.values()
+        ]
+        final_pass = [
+            any(passed(r) for r in reviews if r.get("accepted"))
+            for reviews in panels.values()
+        ]
+        attempts = [max(r.get("attempt") or 1 for r in reviews) for reviews in panels.values()]
+
+        scores_by_attempt: Dict[int, List[float]] = {}
+        for row in group:
+            if row.get("score") is not None:
+                scores_by_attempt.setdefault(row.get("attempt") or 1, []).append(row["score"])
+
+        strategies: Dict[str, List[Dict[str, Any]]] = {}
+        for row in group:
+            if row.get("strategy") in ("regenerate", "edit"):
+                strategies.setdefault(row["strategy"], []).append(row)
+
+        summaries.append(
+            {
+                "classroom_id": classroom_id,
+                "design_style": design_style,
+                "threshold": threshold,
+                "reviews": len(group),
+                "panels": len(panels),
+                "unused_renders": sum(1 for r in group if not r.get("accepted")),
+                "first_attempt_pass_rate": _mean([1.0 if p else 0.0 for p in first_pass]),
+                "final_pass_rate": _mean([1.0 if p else 0.0 for p in final_pass]),
+                "avg_attempts": _mean([float(a) for a in attempts]),
+                "retries": sum(a - 1 for a in attempts),
+                "avg_score_by_attempt": {
+                    str(attempt): _mean(scores)
+                    for attempt, scores in sorted(scores_by_attempt.items())
+                },
+                "avg_latency_seconds": _mean(
+                    [r["latency_seconds"] for r in group if r.get("latency_seconds") is not None]
+                ),
+                "prefilter_rejections": sum(1 for r in group if r.get("review_model") == "prefilter"),
+                "prefilter_duplicates": sum(
+                    1 for r in group if r.get("review_model") == "prefilter_duplicate"
+                ),
+                "retry_strategies": {
+                    strategy: {
+                        "renders": len(retries),
+                        "pass_rate": _mean([1.0 if passed(r) else 0.0 for r in retries]),
+                        "accepted_rate": _mean([1.0 if r.get("accepted") else 0.0 for r in retries]),
+                        "avg_render_seconds": _mean(
+                            [r["render_seconds"] for r in retries if r.get("render_seconds") is not None]
+                        ),
+                    }
+                    for strategy, retries in sorted(strategies.items())
+                },
+            }
+        )
+
+    summaries.sort(key=lambda s: (str(s["classroom_id"]), str(s["design_style"]), s["threshold"] or 0))
+    return summaries
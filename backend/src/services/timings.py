@@ -0,0 +1,89 @@
+"""
+Stage timing breakdown of chapter generation.
+
+A ChapterTimings records wall time per chapter stage (script, prompts,
+images, ...) and, per panel, the time spent waiting and in every attempt
+(FLUX queue, FLUX render, download, pre-filter, review), plus upload and DB
+writes.
+It writes into a plain dict that lives in story_script["timings"], so the
+breakdown is saved with every checkpoint. All values are seconds.
+"""
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional
+
+# Per-attempt stages summed into the chapter totals
+ATTEMPT_STAGES = ("flux_queue", "flux_render", "download", "lettering", "prefilter", "review")
+# Per-panel stages summed into the chapter totals
+PANEL_STAGES = ("wait_reference", "wait_slot", "upload", "db_write")
+
+
+def _round(seconds: float) -> float:
+    return round(seconds, 2)
+
+
+class ChapterTimings:
+    """Collects stage timings into `data` (usually story_script["timings"])."""
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        self.started = time.perf_counter()
+        self.data = data if data is not None else {}
+        self.data.setdefault("started_at", datetime.now(timezone.utc).isoformat())
+        self.data.setdefault("stages", {})
+        self.data.setdefault("panels", {})
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a chapter-level stage (accumulates if the stage runs again, e.g. on resume)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        stages = self.data["stages"]
+        stages[name] = _round(stages.get(name, 0.0) + seconds)
+
+    def panel(self, idx: int) -> Dict[str, Any]:
+        """Timing record of one panel (JSON keys are strings)."""
+        return self.data["panels"].setdefault(str(idx), {"attempts": []})
+
+    def add_panel_stage(self, idx: int, name: str, seconds: float) -> None:
+        record = self.panel(idx)
+        record[name] = _round(record.get(name, 0.0) + seconds)
+
+    def add_attempt(self, idx: int, attempt: Dict[str, Any]) -> None:
+        self.panel(idx)["attempts"].append(
+            {k: (_round(v) if isinstance(v, float) else v) for k, v in attempt.items()}
+        )
+
+    def finish(self) -> Dict[str, Any]:
+        """Record the end-to-end time and per-stage totals across panels."""
+        self.add_stage("total", time.perf_counter() - self.started)
+        totals: Dict[str, float] = {}
+        for record in self.data["panels"].values():
+            for name in PANEL_STAGES:
+                totals[name] = totals.get(name, 0.0) + record.get(name, 0.0)
+            for attempt in record.get("attempts", []):
+                for name in ATTEMPT_STAGES:
+                    totals[name] = totals.get(name, 0.0) + attempt.get(name, 0.0)
+        self.data["panel_totals"] = {name: _round(value) for name, value in totals.items()}
+        self.data["attempts"] = sum(
+            len(record.get("attempts", [])) for record in self.data["panels"].values()
+        )
+        self.data["finished_at"] = datetime.now(timezone.utc).isoformat()
+        return self.data
+
+
+def summarize(timings: Dict[str, Any]) -> Dict[str, Any]:
+    """Compact view of a chapter's timings (no per-panel detail)."""
+    return {
+        "started_at": timings.get("started_at"),
+        "finished_at": timings.get("finished_at"),
+        "stages": timings.get("stages", {}),
+        "panel_totals": timings.get("panel_totals", {}),
+        "panels": len(timings.get("panels", {})),
+        "attempts": timings.get("attempts"),
+    }
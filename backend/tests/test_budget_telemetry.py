@@ -0,0 +1,60 @@
+import asyncio
+
+import services.comic_creation as comic_creation
+from services.review_telemetry import summarize_reviews
+
+CLASSROOM = {"id": "class-1", "design_style": "manga"}
+# Review score of each render, in render order: panel 1 fails and is retried
+# (10.0 is perfect, so passing panels are not retried)
+SCORES = {"p1": [5.0, 10.0], "p2": [10.0]}
+
+
+def run_chapter(monkeypatch):
+    rendered = []
+    recorded = []
+
+    async def flux(prompt, aspect_ratio="3:2", reference_images=None, **kwargs):
+        key = prompt[:2]
+        rendered.append(key)
+        attempt = sum(1 for r in rendered if r == key)
+        return b"image", f"https://flux/{key}/{attempt}"
+
+    async def review(image_url, panel, **kwargs):
+        key, attempt = image_url.rsplit("/", 2)[-2:]
+        score = SCORES[key][int(attempt) - 1]
+        return {"score": score, "dimensions": {}, "issues": ["x"], "suggested_fix_prompt": "fix", "review_model": "qa"}
+
+    monkeypatch.setattr(comic_creation, "PANEL_PREFILTER_ENABLED", False)
+    monkeypatch.setattr(comic_creation, "PANEL_TEXT_RENDERING", "flux")
+    monkeypatch.setattr(comic_creation, "PANEL_REVIEW_MIN_SCORE", 9.0)
+    monkeypatch.setattr(comic_creation, "PANEL_RETRY_STRATEGY", "regenerate")
+    monkeypatch.setattr(comic_creation, "call_flux_and_download", flux)
+    monkeypatch.setattr(comic_creation, "review_panel_image_async", review)
+    monkeypatch.setattr(comic_creation, "upload_image_and_get_url", lambda **kwargs: kwargs["fallback_url"])
+    monkeypatch.setattr(comic_creation, "create_panel", lambda **kwargs: None)
+    monkeypatch.setattr(comic_creation, "replace_panel", lambda **kwargs: None)
+    monkeypatch.setattr(comic_creation, "record_reviews", lambda rows: recorded.extend(rows))
+
+    script = {"panels": [{"index": i, "featured_students": [], "dialogue": []} for i in (1, 2)]}
+    prompts = [{"index": i, "prompt": f"p{i}", "aspect_ratio": "3:2"} for i in (1, 2)]
+    urls, _ = asyncio.run(
+        comic_creation.generate_panel_images(
+            "chapter-1", CLASSROOM, [], script, prompts, 2, "none", False,
+            budget=comic_creation._ChapterBudget(None, 10),
+        )
+    )
+    return urls, recorded
+
+
+def test_only_the_kept_render_of_a_retried_panel_is_accepted(monkeypatch):
+    urls, rows = run_chapter(monkeypatch)
+
+    assert urls == {1: "https://flux/p1/2", 2: "https://flux/p2/1"}
+    panel_1 = sorted((r["attempt"], r["accepted"]) for r in rows if r["panel_index"] == 1)
+    assert panel_1 == [(1, False), (2, True)]
+
+    [summary] = summarize_reviews(rows)
+    assert summary["reviews"] == 3
+    assert summary["unused_renders"] == 1
+    assert summary["final_pass_rate"] == 1.0
+    assert summary["first_attempt_pass_rate"] == 0.5
@@ -0,0 +1,37 @@
+import base64
+
+import pytest
+
+from database.database import _decode_chapter_cursor, _encode_chapter_cursor
+
+CHAPTER_ID = "6f9619ff-8b86-d011-b42d-00c04fc964ff"
+
+
+def raw_cursor(raw: str) -> str:
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def test_round_trip():
+    cursor = _encode_chapter_cursor({"created_at": "2025-03-01T10:20:30.123456+00:00", "id": CHAPTER_ID})
+    assert _decode_chapter_cursor(cursor) == ("2025-03-01T10:20:30.123456+00:00", CHAPTER_ID)
+
+
+def test_values_are_normalized():
+    cursor = raw_cursor(f"2025-03-01T10:20:30.12+00:00|{CHAPTER_ID.upper()}")
+    assert _decode_chapter_cursor(cursor) == ("2025-03-01T10:20:30.120000+00:00", CHAPTER_ID)
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64!",
+        raw_cursor("no separator"),
+        raw_cursor(f"yesterday|{CHAPTER_ID}"),
+        raw_cursor("2025-03-01T10:20:30+00:00|not-a-uuid"),
+        raw_cursor('2025-03-01T10:20:30+00:00|x",id.gt.(0'),
+        raw_cursor(f'2025-03-01",created_at.gt."2000|{CHAPTER_ID}'),
+    ],
+)
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        _decode_chapter_cursor(cursor)
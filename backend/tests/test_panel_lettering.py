@@ -0,0 +1,92 @@
+import io
+
+from PIL import Image, ImageDraw
+
+from panel_lettering import _layout, letter_panel
+
+SIZE = (1200, 800)
+PANEL = {
+    "narration": "Meanwhile, in the science lab...",
+    "featured_students": ["Lena", "Omar"],
+    "dialogue": [
+        {"speaker": "Lena", "text": "Force equals mass times acceleration!"},
+        {"speaker": "Omar", "text": "So a heavier cart needs a bigger push?"},
+    ],
+}
+
+
+def art(size=SIZE) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", size, (90, 140, 200)).save(out, format="PNG")
+    return out.getvalue()
+
+
+def layout(panel, size=SIZE, font_size=34):
+    draw = ImageDraw.Draw(Image.new("RGB", size))
+    return _layout(draw, panel, size, font_size)
+
+
+def overlaps(a, b):
+    return not (a[2] <= b[0] or b[2] <= a[0] or a[3] <= b[1] or b[3] <= a[1])
+
+
+def test_narration_box_is_in_the_top_left_corner():
+    _, items, _ = layout(PANEL)
+    narration = items[0]
+    assert narration["kind"] == "narration"
+    assert narration["box"][0] < SIZE[0] // 10 and narration["box"][1] < SIZE[1] // 10
+
+
+def test_bubbles_point_at_their_speakers_in_order():
+    _, items, _ = layout(PANEL)
+    bubbles = [item for item in items if item["kind"] == "bubble"]
+    assert [bubble["tail_x"] for bubble in bubbles] == [SIZE[0] // 4, SIZE[0] * 3 // 4]
+
+
+def test_boxes_stay_in_the_frame_and_do_not_overlap():
+    _, items, bottom = layout(PANEL)
+    boxes = [item["box"] for item in items]
+    for box in boxes:
+        assert 0 <= box[0] < box[2] <= SIZE[0]
+        assert 0 <= box[1] < box[3] <= SIZE[1]
+    for i, a in enumerate(boxes):
+        for b in boxes[i + 1:]:
+            assert not overlaps(a, b)
+    assert bottom == max(box[3] for box in boxes)
+
+
+def test_text_is_wrapped_and_uppercased():
+    _, items, _ = layout(PANEL)
+    bubble = items[1]
+    assert "\n" in bubble["text"]
+    assert bubble["text"].replace("\n", " ") == PANEL["dialogue"][0]["text"].upper()
+
+
+def test_unknown_speaker_bubble_has_no_tail():
+    _, items, _ = layout({"dialogue": [{"speaker": "", "text": "Hello?"}]})
+    assert [(item["kind"], item["tail_x"]) for item in items] == [("bubble", None)]
+
+
+def test_letter_panel_keeps_the_art_size():
+    lettered = letter_panel(art(), PANEL)
+    with Image.open(io.BytesIO(lettered)) as img:
+        assert img.format == "PNG"
+        assert img.size == SIZE
+        # The bubbles are drawn in the top half only
+        bottom_half = img.convert("RGB").crop((0, SIZE[1] * 3 // 4, SIZE[0], SIZE[1]))
+        assert bottom_half.getcolors() == [(SIZE[0] * SIZE[1] // 4, (90, 140, 200))]
+
+
+def test_letter_panel_without_text_returns_the_art_unchanged():
+    lettered = letter_panel(art(), {"dialogue": []})
+    with Image.open(io.BytesIO(lettered)) as img:
+        assert img.convert("RGB").getcolors() == [(SIZE[0] * SIZE[1], (90, 140, 200))]
+
+
+def test_overlong_word_is_broken_to_fit_the_frame():
+    word = "SUPERCALIFRAGILISTICEXPIALIDOCIOUS" * 2
+    panel = {"featured_students": ["Lena", "Omar"], "dialogue": [{"speaker": "Omar", "text": word}]}
+    _, [bubble], _ = layout(panel)
+    assert bubble["box"][2] <= SIZE[0]
+    assert bubble["box"][2] - bubble["box"][0] <= SIZE[0] * 0.38 + 34
+    assert bubble["text"].replace("\n", "") == word
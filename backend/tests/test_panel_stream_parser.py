@@ -0,0 +1,62 @@
+import json
+
+from services.comic_creation import _PanelStreamParser
+
+PANELS = [
+    {
+        "index": 1,
+        "narration": "Lena finds {a map} in the [attic].",
+        "dialogue": [{"speaker": "Lena", "text": 'She said "F = m \\u00b7 a", then ran.'}],
+    },
+    {
+        "index": 2,
+        "narration": "A back\\slash and a \"quote\" }]",
+        "dialogue": [{"speaker": "Omar", "text": "Wait for me!"}],
+    },
+]
+SCRIPT = json.dumps({"episode_title": "The Map", "panels": PANELS, "notes": {"panels": []}})
+
+
+def feed_all(chunks):
+    parser = _PanelStreamParser()
+    panels = []
+    for chunk in chunks:
+        panels.extend(parser.feed(chunk))
+    return panels
+
+
+def test_whole_script_in_one_chunk():
+    assert feed_all([SCRIPT]) == PANELS
+
+
+def test_every_split_point():
+    for cut in range(1, len(SCRIPT)):
+        assert feed_all([SCRIPT[:cut], SCRIPT[cut:]]) == PANELS, cut
+
+
+def test_single_character_chunks():
+    assert feed_all(list(SCRIPT)) == PANELS
+
+
+def test_panel_is_returned_as_soon_as_it_closes():
+    parser = _PanelStreamParser()
+    first_end = SCRIPT.index("}]}") + 3
+    assert parser.feed(SCRIPT[:first_end]) == [PANELS[0]]
+    assert parser.feed(SCRIPT[first_end:]) == [PANELS[1]]
+
+
+def test_escaped_quotes_and_brackets_in_dialogue():
+    panel = {"index": 3, "dialogue": [{"speaker": "Ana", "text": 'He yelled "}]{[" \\"twice\\"'}]}
+    text = json.dumps({"panels": [panel]})
+    assert feed_all([text]) == [panel]
+    assert feed_all(list(text)) == [panel]
+
+
+def test_truncated_final_panel_is_not_returned():
+    truncated = SCRIPT[: SCRIPT.index('"Wait for')]
+    assert feed_all([truncated]) == [PANELS[0]]
+
+
+def test_objects_outside_the_panels_array_are_ignored():
+    text = json.dumps({"meta": {"index": 0}, "panels": [{"index": 1}], "extra": [{"index": 9}]})
+    assert feed_all([text]) == [{"index": 1}]
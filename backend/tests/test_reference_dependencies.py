@@ -0,0 +1,25 @@
+from services.comic_creation import _reference_dependencies
+
+
+def test_previous_references_the_panel_before():
+    assert _reference_dependencies([3, 1, 2], "previous") == {1: None, 2: 1, 3: 2}
+
+
+def test_previous_skips_missing_indices():
+    assert _reference_dependencies([1, 4, 6], "previous") == {1: None, 4: 1, 6: 4}
+
+
+def test_keyframe_references_the_keyframe():
+    assert _reference_dependencies([1, 2, 3], "keyframe", keyframe_index=2) == {1: 2, 2: None, 3: 2}
+
+
+def test_missing_keyframe_falls_back_to_the_first_panel():
+    assert _reference_dependencies([4, 5, 6], "keyframe", keyframe_index=1) == {4: None, 5: 4, 6: 4}
+
+
+def test_none_renders_every_panel_independently():
+    assert _reference_dependencies([1, 2, 3], "none") == {1: None, 2: None, 3: None}
+
+
+def test_no_panels():
+    assert _reference_dependencies([], "previous") == {}
@@ -0,0 +1,22 @@
+import panel_review
+from panel_review import _review_cache_key
+
+IMAGE = b"panel image bytes"
+PAYLOAD = {"panel_index": 1, "expected_text": [{"speaker": "Lena", "text": "Hi"}]}
+
+
+def test_key_is_stable():
+    assert _review_cache_key(IMAGE, PAYLOAD) == _review_cache_key(IMAGE, dict(PAYLOAD))
+
+
+def test_single_and_sheet_reviews_do_not_share_entries():
+    assert _review_cache_key(IMAGE, PAYLOAD) != _review_cache_key(IMAGE, PAYLOAD, mode="sheet")
+
+
+def test_image_encoding_is_part_of_the_key(monkeypatch):
+    key = _review_cache_key(IMAGE, PAYLOAD)
+    monkeypatch.setattr(panel_review, "REVIEW_IMAGE_QUALITY", panel_review.REVIEW_IMAGE_QUALITY - 10)
+    lower_quality = _review_cache_key(IMAGE, PAYLOAD)
+    monkeypatch.setattr(panel_review, "REVIEW_IMAGE_FORMAT", "webp" if panel_review.REVIEW_IMAGE_FORMAT != "webp" else "jpeg")
+    other_format = _review_cache_key(IMAGE, PAYLOAD)
+    assert len({key, lower_quality, other_format}) == 3
@@ -0,0 +1,20 @@
+import pytest
+
+import panel_review
+from panel_review import _needs_escalation
+
+
+@pytest.fixture(autouse=True)
+def default_band(monkeypatch):
+    monkeypatch.setattr(panel_review, "REVIEW_CASCADE_BAND", 1.5)
+    monkeypatch.setattr(panel_review, "REVIEW_CASCADE_PASS_MARGIN", 0.5)
+
+
+@pytest.mark.parametrize("score", [7.5, 8.0, 8.9, 9.0, 9.4])
+def test_near_misses_and_marginal_passes_escalate(score):
+    assert _needs_escalation(score, 9.0)
+
+
+@pytest.mark.parametrize("score", [0.0, 5.0, 7.4, 9.5, 9.8, 10.0])
+def test_clear_failures_and_clear_passes_are_decided_by_the_fast_model(score):
+    assert not _needs_escalation(score, 9.0)
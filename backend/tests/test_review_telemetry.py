@@ -0,0 +1,64 @@
+from services.review_telemetry import review_row, summarize_reviews
+
+CLASSROOM = {"id": "class-1", "design_style": "manga"}
+
+
+def row(panel_index, attempt, score, accepted=False, strategy="initial", **extra):
+    review = {"score": score, "dimensions": {}, "review_model": "gpt-4o", **extra}
+    data = review_row("chapter-1", CLASSROOM, panel_index, attempt, 1, review, 1.0, 7.0, strategy, 2.0)
+    data["accepted"] = accepted
+    return data
+
+
+def test_summary_of_one_group():
+    rows = [
+        # Panel 1 passes on the first attempt
+        row(1, 1, 8.0, accepted=True),
+        # Panel 2 fails, is edited and then passes
+        row(2, 1, 5.0),
+        row(2, 2, 9.0, accepted=True, strategy="edit"),
+        # Panel 3 never passes; the best attempt is kept
+        row(3, 1, 4.0, accepted=True),
+        row(3, 2, 3.0, strategy="regenerate"),
+    ]
+    [summary] = summarize_reviews(rows)
+
+    assert summary["classroom_id"] == "class-1"
+    assert summary["design_style"] == "manga"
+    assert summary["threshold"] == 7.0
+    assert summary["reviews"] == 5
+    assert summary["panels"] == 3
+    assert summary["unused_renders"] == 2
+    assert summary["first_attempt_pass_rate"] == 0.333
+    assert summary["final_pass_rate"] == 0.667
+    assert summary["avg_attempts"] == 1.667
+    assert summary["retries"] == 2
+    assert summary["avg_score_by_attempt"] == {"1": 5.667, "2": 6.0}
+    assert summary["retry_strategies"] == {
+        "edit": {"renders": 1, "pass_rate": 1.0, "accepted_rate": 1.0, "avg_render_seconds": 2.0},
+        "regenerate": {"renders": 1, "pass_rate": 0.0, "accepted_rate": 0.0, "avg_render_seconds": 2.0},
+    }
+
+
+def test_prefilter_reviews_are_counted_apart():
+    rows = [
+        row(1, 1, 0.0, prefilter=True),
+        row(1, 2, 8.0, prefilter_duplicate=True, accepted=True),
+        row(2, 1, 8.0, accepted=True),
+    ]
+    [summary] = summarize_reviews(rows)
+
+    assert [r["review_model"] for r in rows] == ["prefilter", "prefilter_duplicate", "gpt-4o"]
+    assert summary["prefilter_rejections"] == 1
+    assert summary["prefilter_duplicates"] == 1
+
+
+def test_groups_by_classroom_style_and_threshold():
+    other = {**row(1, 1, 8.0, accepted=True), "threshold": 8.5}
+    summaries = summarize_reviews([row(1, 1, 8.0, accepted=True), other])
+
+    assert [(s["threshold"], s["final_pass_rate"]) for s in summaries] == [(7.0, 1.0), (8.5, 0.0)]
+
+
+def test_no_rows():
+    assert summarize_reviews([]) == []
@@ -0,0 +1,73 @@
+import json
+
+import services.comic_creation as comic_creation
+
+CLASSROOM = {
+    "id": "class-1",
+    "name": "5A",
+    "subject": "math",
+    "grade_level": "5",
+    "story_theme": "space",
+    "design_style": "manga",
+    "duration": "10 min",
+}
+IDEA = {"id": "idea_1", "title": "Fractions in orbit"}
+
+
+def panel(index, description):
+    return {
+        "index": index,
+        "setting": "ship",
+        "description": description,
+        "narration": "",
+        "dialogue": [],
+        "featured_students": [],
+    }
+
+
+def fake_openai(monkeypatch, script):
+    requests = []
+
+    class Completions:
+        def create(self, **kwargs):
+            requests.append(kwargs)
+            message = type("Message", (), {"content": json.dumps(script)})
+            choice = type("Choice", (), {"message": message})
+            return type("Response", (), {"choices": [choice]})
+
+    chat = type("Chat", (), {"completions": Completions()})
+    monkeypatch.setattr(comic_creation, "openai_client", type("Client", (), {"chat": chat}))
+    return requests
+
+
+def test_continuation_keeps_written_panels(monkeypatch):
+    written = [panel(1, "drawn 1"), panel(2, "drawn 2")]
+    # The model rewrites the panels it was given; only the new ones are used
+    requests = fake_openai(
+        monkeypatch,
+        {"episode_title": "Orbit", "panels": [panel(i, f"new {i}") for i in range(1, 5)]},
+    )
+
+    script = comic_creation.generate_full_script_and_panels(
+        classroom=CLASSROOM,
+        students=[],
+        teacher_outline="fractions",
+        chosen_idea=IDEA,
+        use_cache=False,
+        written_panels=written,
+    )
+
+    assert [p["description"] for p in script["panels"]] == ["drawn 1", "drawn 2", "new 3", "new 4"]
+    assert script["episode_title"] == "Orbit"
+    assert '"written_panels"' in requests[0]["messages"][1]["content"]
+
+
+def test_continuation_has_its_own_cache_key():
+    full_key, full_messages = comic_creation._script_request(CLASSROOM, [], "fractions", IDEA)
+    partial_key, partial_messages = comic_creation._script_request(
+        CLASSROOM, [], "fractions", IDEA, [panel(1, "drawn 1")]
+    )
+
+    assert partial_key != full_key
+    assert "written_panels" not in full_messages[1]["content"]
+    assert "written_panels" in partial_messages[1]["content"]
@@ -369,9 +369,15 @@ export const api = {
         }>;
       }>(`/students/${studentId}/classrooms`),
 
-    getChapters: (studentId: string) =>
-      apiFetch<{
+    getChapters: (studentId: string, params?: { limit?: number; cursor?: string }) => {
+      const query = new URLSearchParams();
+      if (params?.limit) query.append('limit', params.limit.toString());
+      if (params?.cursor) query.append('cursor', params.cursor);
+      const search = query.toString();
+
+      return apiFetch<{
         success: boolean;
+        next_cursor: string | null;
         chapters: Array<{
           id: string;
           classroom_id: string;
@@ -384,7 +390,8 @@ export const api = {
           story_title?: string;
           created_at: string;
         }>;
-      }>(`/students/${studentId}/chapters`),
+      }>(`/students/${studentId}/chapters${search ? `?${search}` : ''}`);
+    },
 
     leaveClassroom: (studentId: string, classroomId: string) =>
       apiFetch<{
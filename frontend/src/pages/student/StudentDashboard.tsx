@@ -33,7 +33,7 @@ const StudentDashboard = () => {
 
         // Fetch the newest chapter across all classrooms
         try {
-          const chaptersResponse = await api.students.getChapters(studentId);
+          const chaptersResponse = await api.students.getChapters(studentId, { limit: 1 });
           const allChapters = chaptersResponse.chapters || [];
 
           // Get the most recent chapter (already sorted by created_at desc from API)
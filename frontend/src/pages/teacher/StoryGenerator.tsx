@@ -111,6 +111,13 @@ const StoryGenerator = () => {
           setTimeout(() => {
             navigate(`/teacher/classroom/${classroomId}`);
           }, 1000);
+        } else if (response.chapter.status === 'failed') {
+          setIsPolling(false);
+          if (pollingIntervalRef.current) {
+            clearInterval(pollingIntervalRef.current);
+          }
+          toast.error("Story generation failed. Please try again.");
+          return;
         }
       }
 